@@ -0,0 +1,275 @@
+"""Микробенчмарк запросов db.py и построителей статистики на разных объёмах данных.
+
+Для каждого масштаба (по умолчанию 10k, 100k и 1M профитов) во временном
+bot.db генерируется правдоподобный набор данных с фиксированным seed:
+
+* профиты ~2000 пользователей с «тяжёлым хвостом» (несколько активных
+  пользователей дают большую долю заявок), суммы — логнормальные, даты —
+  за последний год; 85% подтверждены, 10% отклонены, 5% ждут проверки;
+* 10k участников группы (в основном member, немного left/kicked/admin) и
+  столько же записей users.
+
+Затем замеряются get_approved_profits_between (неделя и всё время),
+get_profits_by_user, build_stats_text, build_my_text (для самого активного
+пользователя) и get_active_members. Функции замеряются по кругу (--rounds),
+всего не меньше --min-time секунд на каждую; в отчёте медиана и минимум.
+
+Результаты можно сохранить в JSON (--json) и сравнить с базовыми
+(--baseline): если время выросло больше чем на --threshold (и больше чем
+на --min-delta-ms), скрипт печатает регрессии и завершается с кодом 1.
+Сравнивается минимум (--metric): он меньше всего зависит от фоновой
+нагрузки машины.
+--write-baseline записывает текущий прогон как базовый.
+
+--baseline без пути сравнивает с bench/db_baseline.json — прогоном дерева до
+свёртки profit_daily (коммит в meta.commit). Базовые значения зависят от
+машины: на другой машине перезапишите файл прогоном того же коммита
+(``git worktree add /tmp/base <commit>``, скопировать туда этот скрипт,
+запустить с --baseline --write-baseline).
+
+    python bench/db_bench.py --scales 10k,100k --json now.json --baseline
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "1:bench")
+
+import db  # noqa: E402
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+GROUP_ID = -1001
+FIRST_USER_ID = 1000
+_INSERT_CHUNK = 50_000
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_baseline.json")
+
+
+# --- данные ---
+
+def seed_database(path: str, profits: int, users: int, members: int, seed: int = 1) -> int:
+    """Заполнить bot.db; вернуть id самого активного пользователя."""
+    rnd = random.Random(seed)
+    db.DB_PATH = path
+    db.init_db()
+    now = datetime.utcnow()
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    # Распределение Парето: у немногих пользователей много заявок
+    weights = [rnd.paretovariate(1.2) for _ in user_ids]
+    conn = sqlite3.connect(path)
+    try:
+        remaining = profits
+        while remaining:
+            chunk = min(remaining, _INSERT_CHUNK)
+            remaining -= chunk
+            rows = []
+            for user_id in rnd.choices(user_ids, weights=weights, k=chunk):
+                amount = round(rnd.lognormvariate(7.5, 0.8), 2)
+                created = now - timedelta(seconds=rnd.uniform(0, 365 * 86400))
+                roll = rnd.random()
+                if roll < 0.85:
+                    status = "approved"
+                    approved_at = (created + timedelta(seconds=rnd.uniform(60, 6 * 3600))).isoformat()
+                else:
+                    status = "rejected" if roll < 0.95 else "pending"
+                    approved_at = None
+                rows.append((
+                    user_id, f"user{user_id}", f"User {user_id}", amount, amount, str(amount),
+                    status, created.isoformat(), approved_at, 1 if approved_at else None,
+                ))
+            conn.executemany(
+                """
+                INSERT INTO profits (user_id, username, first_name, original_amount, final_amount, note,
+                                     status, created_at, approved_at, approver_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            conn.commit()
+
+        member_rows, user_rows = [], []
+        for i in range(members):
+            user_id = FIRST_USER_ID + i
+            roll = rnd.random()
+            status = "member" if roll < 0.93 else "left" if roll < 0.98 else "kicked" if roll < 0.99 else "administrator"
+            changed = (now - timedelta(seconds=rnd.uniform(0, 365 * 86400))).isoformat()
+            first_seen = (now - timedelta(seconds=rnd.uniform(0, 730 * 86400))).isoformat()
+            member_rows.append((GROUP_ID, user_id, f"user{user_id}", f"User {user_id}", status, changed))
+            user_rows.append((user_id, f"user{user_id}", f"User {user_id}", first_seen, changed))
+        conn.executemany("INSERT OR REPLACE INTO chat_members VALUES (?, ?, ?, ?, ?, ?)", member_rows)
+        conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)", user_rows)
+        conn.commit()
+        conn.execute("ANALYZE")
+        heavy = conn.execute(
+            "SELECT user_id FROM profits GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+    # В дереве до свёртки profit_daily (из него снят bench/db_baseline.json) её нет
+    if hasattr(db, "rebuild_rollup"):
+        db.rebuild_rollup()
+    return heavy
+
+
+# --- замеры ---
+
+def _measure(call, min_time: float, min_runs: int = 3, max_runs: int = 200) -> list[float]:
+    timings = []
+    # Как timeit: сборщик мусора не должен срабатывать посреди замеров
+    gc.collect()
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + min_time
+        while len(timings) < min_runs or (time.perf_counter() < deadline and len(timings) < max_runs):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+    finally:
+        gc.enable()
+    return timings
+
+
+def _summary(timings: list[float]) -> dict:
+    return {
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "runs": len(timings),
+    }
+
+
+def run_scale(name: str, profits: int, args) -> dict:
+    import bot
+
+    tmp_dir = tempfile.mkdtemp(prefix="db-bench-")
+    path = os.path.join(tmp_dir, "bot.db")
+    try:
+        started = time.perf_counter()
+        heavy = seed_database(path, profits, args.users, args.members, args.seed)
+        print(f"[{name}] данные: {profits} профитов за {time.perf_counter() - started:.1f} с, "
+              f"самый активный пользователь: {heavy}", flush=True)
+        week_start, _ = bot._period_bounds("week")
+        loop = asyncio.new_event_loop()
+        cases = {
+            "get_approved_profits_between[week]": lambda: db.get_approved_profits_between(week_start, None),
+            "get_approved_profits_between[all]": lambda: db.get_approved_profits_between(None, None),
+            "get_profits_by_user": lambda: db.get_profits_by_user(heavy),
+            "build_stats_text[week]": lambda: loop.run_until_complete(bot.build_stats_text("week")),
+            "build_stats_text[all]": lambda: loop.run_until_complete(bot.build_stats_text("all")),
+            "build_my_text[month]": lambda: loop.run_until_complete(bot.build_my_text(heavy, "month")),
+            "build_my_text[all]": lambda: loop.run_until_complete(bot.build_my_text(heavy, "all")),
+            "get_active_members": lambda: db.get_active_members(GROUP_ID),
+        }
+        timings: dict[str, list[float]] = {case: [] for case in cases}
+        try:
+            for call in cases.values():
+                call()  # прогрев: соединения, кэш страниц
+            # Функции замеряются по кругу: кратковременная фоновая нагрузка
+            # растягивается на все, а не искажает одну
+            for _ in range(args.rounds):
+                for case, call in cases.items():
+                    timings[case] += _measure(call, args.min_time / args.rounds)
+        finally:
+            loop.close()
+        results = {}
+        for case in cases:
+            result = results[f"{name}/{case}"] = _summary(timings[case])
+            print(f"[{name}] {case:<36} медиана {result['median_ms']:>9.2f} мс, минимум {result['min_ms']:>9.2f} мс",
+                  flush=True)
+        return results
+    finally:
+        db.close_connections()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_ms: float,
+            metric: str = "min_ms") -> list[str]:
+    """Строки о регрессиях: время выросло больше порога относительно базового."""
+    regressions = []
+    for key, result in current.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        now_ms, base_ms = result[metric], base[metric]
+        change = (now_ms / base_ms - 1) if base_ms else 0.0
+        line = f"{key:<48} {base_ms:>10.2f} → {now_ms:>10.2f} мс ({change:+.0%})"
+        if now_ms > base_ms * (1 + threshold) and now_ms - base_ms > min_delta_ms:
+            regressions.append(line)
+            line += "  РЕГРЕССИЯ"
+        print(line)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк запросов db.py на наборах данных разного объёма")
+    parser.add_argument("--scales", default=",".join(SCALES), help=f"через запятую из: {', '.join(SCALES)}")
+    parser.add_argument("--users", type=int, default=2000, help="пользователей с профитами")
+    parser.add_argument("--members", type=int, default=10_000, help="участников группы")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-time", type=float, default=1.0, help="секунд замеров на функцию")
+    parser.add_argument("--rounds", type=int, default=5, help="кругов замеров по всем функциям")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--baseline", nargs="?", const=DEFAULT_BASELINE,
+                        help="файл базовых результатов для сравнения (без пути — bench/db_baseline.json)")
+    parser.add_argument("--write-baseline", action="store_true", help="записать прогон в --baseline")
+    parser.add_argument("--threshold", type=float, default=0.5, help="допустимый рост времени (0.5 = 50%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="меньшие изменения не считаются регрессией")
+    parser.add_argument("--metric", choices=("min_ms", "median_ms"), default="min_ms", help="что сравнивать")
+    args = parser.parse_args()
+
+    scales = [s.strip().lower() for s in args.scales.split(",") if s.strip()]
+    unknown = set(scales) - set(SCALES)
+    if unknown:
+        parser.error(f"неизвестные масштабы: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in scales:
+        results.update(run_scale(name, SCALES[name], args))
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "cpu": os.cpu_count(),
+            "seed": args.seed,
+            "users": args.users,
+            "members": args.members,
+        },
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline and args.write_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Базовые результаты записаны в {args.baseline}")
+        return 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        print(f"\nСравнение с {args.baseline} по {args.metric} (порог +{args.threshold:.0%}, "
+              f"не меньше {args.min_delta_ms} мс):")
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms, args.metric)
+        if regressions:
+            print(f"\nРегрессий: {len(regressions)}")
+            return 1
+        print("\nРегрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
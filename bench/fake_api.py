@@ -0,0 +1,171 @@
+"""Поддельный Bot API для нагрузочных тестов: правдоподобные ответы без сети.
+
+fake_result(method, params) строит результат вызова (Message для send*,
+ChatMember для getChatMember и т.д.). FakeApiServer отдаёт его по HTTP —
+бот подключается к нему через TELEGRAM_API_URL — и раздаёт через getUpdates
+заранее подготовленные апдейты. FakeRequest отвечает так же, но внутри
+процесса (подставляется в build_application) и умеет добавлять задержку.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Callable
+from urllib.parse import parse_qs
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+_message_ids = itertools.count(1)
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"group {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+
+def fake_result(method: str, params: dict):
+    method = method.lower()
+    if method == "getme":
+        return BOT_USER
+    if method in ("sendmessage", "sendsticker", "editmessagetext", "senddocument"):
+        chat_id = int(params.get("chat_id", 0))
+        message = {"message_id": next(_message_ids), "date": int(time.time()), "chat": _chat(chat_id), "from": BOT_USER}
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+    if method == "getchatmember":
+        user_id = int(params.get("user_id", 0))
+        return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}}
+    if method == "getchatadministrators":
+        return [{"status": "creator", "is_anonymous": False, "user": {"id": 100, "is_bot": False, "first_name": "admin"}}]
+    if method == "getupdates":
+        return []
+    return True
+
+
+def parse_params(body: bytes, content_type: str) -> dict:
+    """Параметры запроса PTB (form-urlencoded, значения — JSON или строки)."""
+    if not body:
+        return {}
+    if "json" in content_type:
+        return json.loads(body)
+    params = {}
+    for key, values in parse_qs(body.decode("utf-8")).items():
+        value = values[-1]
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+class FakeApiServer:
+    def __init__(self, updates: list[dict] | None = None, batch: int = 100):
+        self.updates = updates or []
+        self.batch = batch
+        self.calls: dict[str, int] = {}
+        self.first_update_served: float | None = None
+        self._server: asyncio.AbstractServer | None = None
+        self.port = 0
+
+    def count(self, method: str) -> int:
+        return self.calls.get(method, 0)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def _result(self, method: str, params: dict):
+        if method.lower() == "getupdates":
+            offset = int(params.get("offset") or 0)
+            # Апдейты нумеруются с 1, поэтому номер совпадает с позицией
+            start = max(offset - 1, 0)
+            chunk = self.updates[start:start + self.batch]
+            if chunk and self.first_update_served is None:
+                self.first_update_served = time.perf_counter()
+            if not chunk:
+                # Имитация long polling, но короткая, чтобы бот быстро останавливался
+                await asyncio.sleep(min(float(params.get("timeout") or 0), 0.5))
+            return chunk
+        return fake_result(method, params)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+                method = target.rstrip("/").rsplit("/", 1)[-1]
+                self.calls[method] = self.calls.get(method, 0) + 1
+                result = await self._result(method, parse_params(body, headers.get("content-type", "")))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            # CancelledError — остановка сервера посреди long polling
+            pass
+        finally:
+            writer.close()
+
+
+class FakeRequest(BaseRequest):
+    """Bot API в процессе: ответы fake_result через latency ± jitter секунд.
+
+    on_call(method, params) вызывается на каждый запрос (до задержки).
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = 1,
+                 on_call: Callable[[str, dict], None] | None = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.on_call = on_call
+        self.calls: dict[str, int] = {}
+        self._random = random.Random(seed)
+
+    def count(self, method: str) -> int:
+        return self.calls.get(method, 0)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.on_call is not None:
+            self.on_call(api_method, params)
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return 200, json.dumps({"ok": True, "result": fake_result(api_method, params)}).encode()
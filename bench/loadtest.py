@@ -0,0 +1,431 @@
+"""Нагрузочный тест графа обработчиков в одном процессе.
+
+Собирает настоящий Application (bot.build_application) с поддельным Bot API
+(fake_api.FakeRequest: ответы без сети, задержка --latency-ms ± --jitter-ms)
+и прогоняет синтетических пользователей:
+
+* profit  — /profit → сумма → админ нажимает «Одобрить» (нажатие создаётся,
+  когда бот присылает админу заявку с кнопками);
+* suggest — /suggest → текст предложения;
+* stats   — /stats и нажатия stats:week|month|all в группах;
+* chatter — сообщения в группах (трекеры участников) и текст в личке;
+* mixed   — всё вместе вперемешку.
+
+Шаги одного пользователя идут по порядку, разные пользователи перемешаны.
+Каждый сценарий выполняется в отдельном процессе на свежей копии проекта с
+засеянной БД (как в shard_bench.py) и с фиксированным seed, поэтому прогоны
+повторяемы. Лимиты Telegram в очереди отправки по умолчанию сняты
+(--telegram-limits включает их), иначе всё упирается в 1 сообщение/с админу.
+
+Отчёт: апдейтов/с, p50/p99 времени обработчиков (от первого до последнего
+обработчика апдейта) и от постановки в очередь до конца обработки, число
+COMMIT в bot.db и bot_state.db, вызовы Bot API.
+
+    python bench/loadtest.py
+    python bench/loadtest.py --scenarios profit,mixed --users 5000 --latency-ms 20 --json out.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import shard_bench
+
+SCENARIOS = ("profit", "suggest", "stats", "chatter", "mixed")
+DEFAULT_SUITE = "profit,stats,chatter,mixed"
+
+ADMIN_ID = 42
+GROUP_ID = -1001
+RESULT_PREFIX = "LOADTEST_RESULT "
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- синтетические апдейты ---
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"group {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _next(self) -> tuple[int, int]:
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def message(self, chat_id: int, user_id: int, text: str) -> dict:
+        update_id, message_id = self._next()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "from": _user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, chat_id: int, user_id: int, data: str) -> dict:
+        update_id, message_id = self._next()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": _user(user_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": _chat(chat_id),
+                    "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                    "text": "…",
+                },
+            },
+        }
+
+
+def make_flows(scenario: str, users: int, groups: int, seed: int = 1) -> tuple[list[list[dict]], int]:
+    """Цепочки апдейтов по пользователям и число ожидаемых одобрений админа."""
+    rnd = random.Random(seed)
+    factory = UpdateFactory()
+    group_ids = [GROUP_ID - i for i in range(groups)]
+    flows, approvals = [], 0
+
+    def profit(uid: int) -> list[dict]:
+        nonlocal approvals
+        approvals += 1
+        return [factory.message(uid, uid, "/profit"), factory.message(uid, uid, str(rnd.randint(100, 5000)))]
+
+    def suggest(uid: int) -> list[dict]:
+        return [factory.message(uid, uid, "/suggest"), factory.message(uid, uid, "Добавьте тёмную тему")]
+
+    def stats(uid: int) -> list[dict]:
+        chat_id = rnd.choice(group_ids)
+        steps = [factory.message(chat_id, uid, "/stats")]
+        for _ in range(3):
+            steps.append(factory.callback(chat_id, uid, "stats:" + rnd.choice(("week", "month", "all"))))
+        return steps
+
+    def chatter(uid: int) -> list[dict]:
+        steps = [factory.message(rnd.choice(group_ids), uid, "всем привет") for _ in range(5)]
+        steps.append(factory.message(uid, uid, "привет"))
+        return steps
+
+    builders = {"profit": profit, "suggest": suggest, "stats": stats, "chatter": chatter}
+    for i in range(users):
+        uid = 1000 + i
+        if scenario == "mixed":
+            kind = rnd.choices(("profit", "suggest", "stats", "chatter"), weights=(20, 10, 30, 40))[0]
+        else:
+            kind = scenario
+        flows.append(builders[kind](uid))
+    return flows, approvals
+
+
+def interleave(flows: list[list[dict]], seed: int = 1) -> list[dict]:
+    """Перемешать цепочки, сохраняя порядок шагов внутри каждой."""
+    rnd = random.Random(seed)
+    pending = [list(reversed(flow)) for flow in flows if flow]
+    ordered = []
+    while pending:
+        i = rnd.randrange(len(pending))
+        ordered.append(pending[i].pop())
+        if not pending[i]:
+            pending[i] = pending[-1]
+            pending.pop()
+    return ordered
+
+
+def _approve_data(params: dict) -> str | None:
+    markup = params.get("reply_markup")
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    for row in (markup or {}).get("inline_keyboard", []):
+        for button in row:
+            data = button.get("callback_data") or ""
+            if data.startswith("approve:"):
+                return data
+    return None
+
+
+# --- прогон в дочернем процессе ---
+
+def _count_commits() -> Counter:
+    """Считать COMMIT по файлам БД: трассировка на каждом новом соединении SQLite."""
+    commits: Counter = Counter()
+    connect = sqlite3.connect
+
+    def traced_connect(database, *args, **kwargs):
+        conn = connect(database, *args, **kwargs)
+        name = os.path.basename(str(database))
+
+        def trace(sql: str) -> None:
+            if sql == "COMMIT":
+                commits[name] += 1
+
+        conn.set_trace_callback(trace)
+        return conn
+
+    sqlite3.connect = traced_connect
+    return commits
+
+
+_MODERATION = ("approve:", "reject:", "edit:")
+
+
+async def drive(name: str, updates: list[dict], args, commits: Counter, times: list[float] | None = None,
+                approvals_expected: int = 0, admin_id: int = ADMIN_ID, auto_approve: bool = True) -> dict:
+    """Прогнать апдейты через настоящий Application с поддельным Bot API.
+
+    times — секунды от начала прогона для каждого апдейта (None — все сразу).
+    auto_approve: админ одобряет каждую заявку, как только она пришла. Иначе
+    (воспроизведение записи) id заявок в нажатиях approve/reject/edit
+    заменяются на id заявок, созданных в этом прогоне, в порядке появления.
+    """
+    import bot
+    import sender
+    import webhook
+    from fake_api import FakeRequest
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    if not args.telegram_limits:
+        sender.scheduler = sender.SendScheduler(global_rate=1e9, chat_buckets=lambda chat_id, clock: [])
+
+    factory = UpdateFactory()
+    factory.update_id = factory.message_id = max((u["update_id"] for u in updates), default=0) + 1_000_000
+    expected = len(updates) + approvals_expected
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    done = asyncio.Event()
+    enqueued: dict[int, float] = {}
+    started: dict[int, float] = {}
+    handler_times: list[float] = []
+    total_times: list[float] = []
+    state = {"first": 0.0, "last": 0.0, "approvals": 0}
+    created: list[str] = []
+    moderation_ids: dict[str, str] = {}
+    application = None
+
+    def remap_moderation(data: dict) -> None:
+        query = data.get("callback_query") or {}
+        value = query.get("data") or ""
+        if not value.startswith(_MODERATION):
+            return
+        action, _, old_id = value.partition(":")
+        new_id = moderation_ids.get(old_id)
+        if new_id is None and len(moderation_ids) < len(created):
+            new_id = moderation_ids[old_id] = created[len(moderation_ids)]
+        if new_id is not None:
+            query["data"] = f"{action}:{new_id}"
+
+    def enqueue(data: dict) -> None:
+        if not auto_approve:
+            remap_moderation(data)
+        update = Update.de_json(data, application.bot)
+        enqueued[update.update_id] = time.perf_counter()
+        application.update_queue.put_nowait(update)
+
+    def on_call(method: str, params: dict) -> None:
+        if method != "sendMessage" or str(params.get("chat_id")) != str(admin_id):
+            return
+        data = _approve_data(params)
+        if not data:
+            return
+        if auto_approve:
+            # Админ одобряет каждую заявку, как только она до него дошла
+            state["approvals"] += 1
+            loop.call_soon(enqueue, factory.callback(admin_id, admin_id, data))
+        else:
+            created.append(data.partition(":")[2])
+
+    async def mark_start(update: Update, context) -> None:
+        started[update.update_id] = time.perf_counter()
+
+    async def mark_end(update: Update, context) -> None:
+        now = time.perf_counter()
+        handler_times.append(now - started.pop(update.update_id, now))
+        total_times.append(now - enqueued.pop(update.update_id, now))
+        state["last"] = now
+        if len(total_times) >= expected:
+            done.set()
+
+    request = FakeRequest(args.latency_ms / 1000, args.jitter_ms / 1000, args.seed, on_call)
+    application = bot.build_application(with_updater=False, request=request)
+    application.add_handler(TypeHandler(Update, mark_start), group=-100)
+    application.add_handler(TypeHandler(Update, mark_end), group=100)
+
+    async def feed() -> None:
+        state["first"] = time.perf_counter()
+        for i, data in enumerate(updates):
+            if times:
+                delay = state["first"] + times[i] - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            enqueue(data)
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        stop_event.set()
+
+    tasks = []
+
+    async def on_started() -> None:
+        tasks.append(asyncio.create_task(feed()))
+
+    await webhook.serve_application(application, stop_event, on_started)
+    await asyncio.gather(*tasks)
+
+    elapsed = (state["last"] or time.perf_counter()) - state["first"]
+    processed = len(total_times)
+    return {
+        "scenario": name,
+        "latency_ms": args.latency_ms,
+        "updates": processed,
+        "expected": expected,
+        "approvals": state["approvals"],
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(processed / elapsed, 1) if elapsed > 0 else 0.0,
+        "handler_p50_ms": round(_percentile(handler_times, 0.50) * 1000, 2),
+        "handler_p99_ms": round(_percentile(handler_times, 0.99) * 1000, 2),
+        "total_p50_ms": round(_percentile(total_times, 0.50) * 1000, 2),
+        "total_p99_ms": round(_percentile(total_times, 0.99) * 1000, 2),
+        "commits": dict(commits),
+        "api_calls": dict(sorted(request.calls.items())),
+    }
+
+
+def child_setup(workdir: str, admin_id: int = ADMIN_ID, group_id: int = GROUP_ID) -> Counter:
+    """Подготовить дочерний процесс к прогону в рабочей копии; вернуть счётчик COMMIT."""
+    # Рабочая копия проекта — первой в sys.path, чтобы bot.db и bot_state.db были её
+    os.chdir(workdir)
+    sys.path.insert(0, workdir)
+    os.environ.update(
+        BOT_TOKEN="1:loadtest",
+        ADMIN_ID=str(admin_id),
+        GROUP_ID=str(group_id),
+        UPDATE_LOG_SAMPLE="0",
+        PERSISTENCE_UPDATE_INTERVAL="5",
+        METRICS_PORT="0",
+        RECORD_UPDATES="",
+    )
+    commits = _count_commits()
+    import bot  # noqa: F401  (настраивает логирование)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    return commits
+
+
+def print_result(result: dict) -> None:
+    print(RESULT_PREFIX + json.dumps(result, ensure_ascii=False), flush=True)
+
+
+def parse_result(proc: subprocess.CompletedProcess, name: str) -> dict:
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"{name}: прогон завершился без результата\n{proc.stderr[-2000:]}")
+
+
+def _child_main(args) -> None:
+    commits = child_setup(args.workdir)
+    flows, approvals_expected = make_flows(args.child, args.users, args.groups, args.seed)
+    updates = interleave(flows, args.seed)
+    times = [i / args.rate for i in range(len(updates))] if args.rate else None
+    result = asyncio.run(drive(args.child, updates, args, commits, times, approvals_expected))
+    result["users"] = args.users
+    print_result(result)
+
+
+# --- набор сценариев ---
+
+def run_scenario(scenario: str, args) -> dict:
+    workdir = shard_bench.prepare_workdir(args.profits, args.users)
+    try:
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "--child", scenario, "--workdir", workdir,
+            "--users", str(args.users), "--groups", str(args.groups), "--seed", str(args.seed),
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--rate", str(args.rate), "--timeout", str(args.timeout),
+        ]
+        if args.telegram_limits:
+            cmd.append("--telegram-limits")
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout + 120)
+        return parse_result(proc, scenario)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота в одном процессе")
+    parser.add_argument("--scenarios", default=DEFAULT_SUITE, help=f"через запятую из: {', '.join(SCENARIOS)}")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--profits", type=int, default=20000, help="профитов в засеянной БД")
+    parser.add_argument("--latency-ms", type=float, default=30, help="задержка ответа Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду на входе (0 — сразу все)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--telegram-limits", action="store_true", help="оставить лимиты отправки Telegram")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child_main(args)
+        return
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    print(f"CPU: {os.cpu_count()}, пользователей: {args.users}, профитов в БД: {args.profits}, "
+          f"задержка API: {args.latency_ms:.0f}±{args.jitter_ms:.0f} мс")
+    print(f"{'сценарий':<9} {'апдейтов':>8} {'апд/с':>8} {'обр. p50':>9} {'обр. p99':>9} "
+          f"{'всего p50':>10} {'всего p99':>10} {'COMMIT bot.db':>14} {'state':>6}")
+    results = []
+    for scenario in scenarios:
+        r = run_scenario(scenario, args)
+        results.append(r)
+        note = "" if r["updates"] == r["expected"] else f"  (обработано {r['updates']} из {r['expected']})"
+        print(f"{r['scenario']:<9} {r['updates']:>8} {r['updates_per_second']:>8.1f} "
+              f"{r['handler_p50_ms']:>7.1f}мс {r['handler_p99_ms']:>7.1f}мс "
+              f"{r['total_p50_ms']:>8.1f}мс {r['total_p99_ms']:>8.1f}мс "
+              f"{r['commits'].get('bot.db', 0):>14} {r['commits'].get('bot_state.db', 0):>6}{note}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Воспроизведение записанного трафика (RECORD_UPDATES, см. recorder.py).
+
+Апдейты из записи прогоняются через настоящий Application с поддельным
+Bot API — тем же способом, что в loadtest.py: отдельный процесс, свежая
+копия проекта (файлы *.py того дерева, откуда запущен скрипт) и засеянная
+bot.db. Сегменты записи (запуски бота) склеиваются подряд.
+
+* --speed 1 — в реальном темпе, как апдейты приходили;
+* --speed N — в N раз быстрее;
+* --speed max — все апдейты сразу, предел пропускной способности.
+
+Админ и группа прогона — обезличенные ADMIN_ID и GROUP_ID из заголовка
+записи. id заявок в нажатиях «Подтвердить/Отклонить/Изменить» заменяются
+на заявки, созданные в этом прогоне, в порядке появления.
+
+Чтобы сравнить две сборки на одном дне трафика, запустите скрипт из обеих
+с одной записью и --json, а вторую — с --baseline от первой:
+
+    python bench/replay.py day.jsonl.gz --speed max --json old.json
+    python bench/replay.py day.jsonl.gz --speed max --baseline old.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import loadtest  # noqa: E402
+import recorder  # noqa: E402
+import shard_bench  # noqa: E402
+
+_ID_KEYS = ("id", "user_id", "chat_id")
+_DATE_KEYS = frozenset({"date", "edit_date", "forward_date", "until_date", "expire_date"})
+
+
+def _rewrite(obj, swap: dict[int, int], date_base: int):
+    """Поменять id местами по swap и перевести относительные даты в абсолютные."""
+    if isinstance(obj, list):
+        return [_rewrite(item, swap, date_base) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    result = {}
+    for key, value in obj.items():
+        if isinstance(value, bool):
+            result[key] = value
+        elif isinstance(value, int) and key in _ID_KEYS:
+            result[key] = swap.get(value, value)
+        elif isinstance(value, int) and key in _DATE_KEYS:
+            result[key] = date_base + value
+        else:
+            result[key] = _rewrite(value, swap, date_base)
+    return result
+
+
+def load_updates(path: str, limit: int = 0) -> tuple[list[dict], list[float], int | None, int | None]:
+    """Апдейты записи подряд по сегментам, их время от начала, ADMIN_ID и GROUP_ID."""
+    segments = recorder.read_capture(path)
+    admin_id = next((h["admin_id"] for h, _ in segments if h.get("admin_id")), None)
+    group_id = next((h["group_id"] for h, _ in segments if h.get("group_id")), None)
+    updates, times = [], []
+    offset = 0.0
+    now = int(time.time())
+    for header, items in segments:
+        # В каждом сегменте свои обезличенные id: админа и группу сводим к первым
+        swap: dict[int, int] = {}
+        for key, target in (("admin_id", admin_id), ("group_id", group_id)):
+            own = header.get(key)
+            if own and target and own != target:
+                swap[own], swap[target] = target, own
+        for t, data in items:
+            data = _rewrite(data, swap, now + int(offset))
+            data["update_id"] = len(updates) + 1
+            updates.append(data)
+            times.append(offset + t)
+            if limit and len(updates) >= limit:
+                return updates, times, admin_id, group_id
+        if items:
+            offset += items[-1][0]
+    return updates, times, admin_id, group_id
+
+
+def _child_main(args) -> None:
+    updates, times, admin_id, group_id = load_updates(args.child, args.limit)
+    commits = loadtest.child_setup(args.workdir, admin_id or loadtest.ADMIN_ID, group_id or loadtest.GROUP_ID)
+    if args.speed == "max":
+        schedule = None
+    else:
+        speed = float(args.speed)
+        schedule = [t / speed for t in times]
+    result = asyncio.run(loadtest.drive(
+        "replay", updates, args, commits, schedule,
+        admin_id=admin_id or loadtest.ADMIN_ID, auto_approve=False,
+    ))
+    result["speed"] = args.speed
+    result["recorded_seconds"] = round(times[-1], 3) if times else 0.0
+    loadtest.print_result(result)
+
+
+def _compare(result: dict, baseline: dict) -> None:
+    print("\nСравнение с базовым прогоном:")
+    for key, better in (("updates_per_second", "больше"), ("handler_p50_ms", "меньше"),
+                        ("handler_p99_ms", "меньше"), ("total_p50_ms", "меньше"), ("total_p99_ms", "меньше")):
+        base, now = baseline.get(key, 0), result.get(key, 0)
+        change = f"{now / base - 1:+.0%}" if base else "—"
+        print(f"  {key:<20} {base:>10} → {now:>10} ({change}, лучше — {better})")
+    for name in sorted(set(result["commits"]) | set(baseline.get("commits", {}))):
+        print(f"  COMMIT {name:<13} {baseline.get('commits', {}).get(name, 0):>10} → {result['commits'].get(name, 0):>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Воспроизвести записанные апдейты на поддельном Bot API")
+    parser.add_argument("capture", help="файл записи (RECORD_UPDATES)")
+    parser.add_argument("--speed", default="max", help="1 — реальный темп, N — в N раз быстрее, max — сразу все")
+    parser.add_argument("--limit", type=int, default=0, help="только первые N апдейтов")
+    parser.add_argument("--profits", type=int, default=20000, help="профитов в засеянной БД")
+    parser.add_argument("--users", type=int, default=1000, help="пользователей в засеянной БД")
+    parser.add_argument("--latency-ms", type=float, default=30, help="задержка ответа Bot API")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="ожидание обработки после подачи всех апдейтов")
+    parser.add_argument("--telegram-limits", action="store_true", help="оставить лимиты отправки Telegram")
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--baseline", help="результат другого прогона (--json) для сравнения")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.speed != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed: положительное число или max")
+    if args.child:
+        _child_main(args)
+        return
+
+    updates, times, admin_id, _ = load_updates(args.capture, args.limit)
+    if not updates:
+        parser.error(f"в {args.capture} нет апдейтов")
+    print(f"Запись: {len(updates)} апдейтов за {times[-1]:.0f} с, скорость: {args.speed}, "
+          f"задержка API: {args.latency_ms:.0f}±{args.jitter_ms:.0f} мс")
+    if admin_id is None:
+        print("В записи нет ADMIN_ID: админские апдейты будут от не-админа")
+
+    workdir = shard_bench.prepare_workdir(args.profits, args.users)
+    try:
+        cmd = [
+            sys.executable, os.path.abspath(__file__), args.capture, "--child", os.path.abspath(args.capture),
+            "--workdir", workdir, "--speed", args.speed, "--limit", str(args.limit),
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--seed", str(args.seed), "--timeout", str(args.timeout),
+        ]
+        if args.telegram_limits:
+            cmd.append("--telegram-limits")
+        feed_seconds = 0.0 if args.speed == "max" else times[-1] / float(args.speed)
+        budget = feed_seconds + args.timeout + 120
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=budget)
+        result = loadtest.parse_result(proc, "replay")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    note = "" if result["updates"] == result["expected"] else f" (обработано {result['updates']} из {result['expected']})"
+    print(f"Обработано за {result['seconds']:.1f} с: {result['updates_per_second']:.1f} апд/с{note}")
+    print(f"Обработчики: p50 {result['handler_p50_ms']:.1f} мс, p99 {result['handler_p99_ms']:.1f} мс; "
+          f"от получения: p50 {result['total_p50_ms']:.1f} мс, p99 {result['total_p99_ms']:.1f} мс")
+    print(f"COMMIT: {result['commits']}, вызовы API: {result['api_calls']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            _compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Кривая масштабирования шардирования (BOT_WORKERS) на локальной машине.
+
+Для каждого числа воркеров бот запускается отдельным процессом в копии
+проекта во временном каталоге (своя bot.db с засеянными профитами) и
+подключается к поддельному Bot API (bench/fake_api.py). Через getUpdates он
+получает смесь апдейтов: /my в личках (чтение из БД и ответ) и обычные
+сообщения в группах (статус участника). Время считается от выдачи первого
+апдейта до последнего ответа на /my.
+
+Запуск: ``python bench/shard_bench.py --workers 1,2,4 --updates 4000``.
+При 1 воркере бот работает без шардирования (run_polling).
+"""
+import argparse
+import asyncio
+import glob
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_api import FakeApiServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED_SCRIPT = """
+import random, db
+db.init_db()
+rnd = random.Random(1)
+for i in range({profits}):
+    uid = 1000 + i % {users}
+    pid = db.create_profit_request(uid, f"user{{uid}}", "U", rnd.randint(100, 5000), None)
+    db.set_status(pid, "approved", approver_id=1)
+"""
+
+
+def make_updates(count: int, users: int, groups: int, seed: int = 1) -> tuple[list[dict], int]:
+    """Смесь апдейтов; возвращает (апдейты, сколько из них /my)."""
+    rnd = random.Random(seed)
+    updates, my_count = [], 0
+    now = int(time.time())
+    for i in range(1, count + 1):
+        uid = 1000 + rnd.randrange(users)
+        user = {"id": uid, "is_bot": False, "first_name": "U", "username": f"user{uid}"}
+        if rnd.random() < 0.5:
+            chat = {"id": uid, "type": "private", "first_name": "U"}
+            text, entities = "/my", [{"type": "bot_command", "offset": 0, "length": 3}]
+            my_count += 1
+        else:
+            gid = -1000 - rnd.randrange(groups)
+            chat = {"id": gid, "type": "supergroup", "title": "g"}
+            text, entities = "всем привет", None
+        message = {"message_id": i, "date": now, "chat": chat, "from": user, "text": text}
+        if entities:
+            message["entities"] = entities
+        updates.append({"update_id": i, "message": message})
+    return updates, my_count
+
+
+def prepare_workdir(profits: int, users: int) -> str:
+    workdir = tempfile.mkdtemp(prefix="shard-bench-")
+    for path in glob.glob(os.path.join(ROOT, "*.py")):
+        shutil.copy(path, workdir)
+    subprocess.run(
+        [sys.executable, "-c", SEED_SCRIPT.format(profits=profits, users=users)],
+        cwd=workdir, check=True,
+    )
+    return workdir
+
+
+async def run_once(workers: int, updates: list[dict], my_count: int, workdir: str, timeout: float) -> float:
+    api = FakeApiServer(updates)
+    await api.start()
+    env = dict(
+        os.environ,
+        BOT_TOKEN="1:bench",
+        ADMIN_ID="1",
+        BOT_WORKERS=str(workers),
+        TELEGRAM_API_URL=api.base_url,
+        PERSISTENCE_UPDATE_INTERVAL="5",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "bot.py"], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.perf_counter() + timeout
+        while api.count("sendMessage") < my_count:
+            if time.perf_counter() > deadline or proc.poll() is not None:
+                raise RuntimeError(
+                    f"workers={workers}: получено {api.count('sendMessage')} из {my_count} ответов"
+                )
+            await asyncio.sleep(0.02)
+        return time.perf_counter() - api.first_update_served
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+        await api.stop()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--profits", type=int, default=20000)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    updates, my_count = make_updates(args.updates, args.users, args.groups)
+    print(f"CPU: {os.cpu_count()}, апдейтов: {len(updates)} (/my: {my_count}), профитов в БД: {args.profits}")
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        workdir = prepare_workdir(args.profits, args.users)
+        try:
+            elapsed = await run_once(workers, updates, my_count, workdir, args.timeout)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        rate = len(updates) / elapsed
+        baseline = baseline or rate
+        print(f"воркеров: {workers:2d}  {elapsed:6.2f} с  {rate:8.0f} апдейтов/с  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
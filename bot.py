@@ -1,9 +1,15 @@
+import asyncio
 import os
 import re
+import signal
+import time
 import warnings
+from collections import OrderedDict
 # Подавляем депрекейшн-предупреждение от pkg_resources как можно раньше
 warnings.filterwarnings("ignore", category=UserWarning, message=".*pkg_resources.*")
 from dotenv import load_dotenv
+# .env загружаем до импорта модулей проекта: они читают настройки при импорте
+load_dotenv()
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -14,26 +20,37 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
     TypeHandler,
-    PicklePersistence,
     ChatMemberHandler,
 )
 
 # Удалено: позднее подавление предупреждений
 
-from db import init_db, create_profit_request, get_profit, update_final_amount, set_status, get_approved_profits_between, get_all_profits, reset_all_to_rejected, delete_all_profits, get_profits_by_user, reset_user_to_rejected, get_user_ids_by_username, ensure_user_seen, get_user_first_seen, set_member_status, get_active_members
+from db import init_db
+import db_async as adb
+from sqlite_persistence import SQLitePersistence
 from datetime import datetime, timedelta, timezone
-from fs_storage import save_pending_profit, save_approved_profit, save_rejected_profit, purge_storage, purge_approved_and_pending, remove_files_for_profit_id
+from fs_storage import purge_approved_and_pending
+import mirror_writer as mirror
+import sender
+import webhook
+from update_processor import KeyedUpdateProcessor
+import sharding
+import metrics
+import profiler
+import recorder
+from mirror_rebuild import rebuild_mirror
+import export
+import tempfile
 from filelock import FileLock
 from zoneinfo import ZoneInfo
 from telegram.constants import ParseMode
+from telegram.request import BaseRequest
 import logging
+import update_log
 
-# Настройка логов — чтобы видеть все апдейты в журнале
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Логи пишутся из очереди отдельным потоком; апдейты — JSON-событиями в логгер updates
+update_log.setup_logging()
 logger = logging.getLogger(__name__)
-
-# Загружаем переменные окружения из .env
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 GROUP_ID_STR = os.getenv("GROUP_ID")
 ADMIN_ID_STR = os.getenv("ADMIN_ID")
@@ -45,6 +62,21 @@ ADMIN_ID = int(ADMIN_ID_STR) if ADMIN_ID_STR else None
 if not BOT_TOKEN:
     raise RuntimeError("Переменная BOT_TOKEN не задана. Установите её в .env")
 
+# Время жизни закэшированного текста /stats (сек): окна «неделя/месяц» скользящие
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+# Способ получения апдейтов: polling (по умолчанию) или webhook (см. webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Число процессов-обработчиков; при 1 бот работает одним процессом, как раньше
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Адрес Bot API (например, локального telegram-bot-api сервера); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+# Сколько секунд доверять закэшированному статусу участника группы без запроса к API
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "900"))
+# /all: упоминаний в одном сообщении, срок кэша админов и окно для продолжения прерванной рассылки
+ALL_BATCH_SIZE = 25
+ALL_ADMIN_FALLBACK_TTL = 600
+ALL_RESUME_WINDOW = 3600
+
 # Состояния диалога /profit
 ASK_AMOUNT = 1
 # Состояния диалога предложений
@@ -102,7 +134,7 @@ def make_admin_moderation_keyboard(req_id: int) -> InlineKeyboardMarkup:
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Фиксируем пользователя в БД (дата присоединения)
     user = update.effective_user
-    ensure_user_seen(user.id, user.username, user.first_name)
+    await adb.ensure_user_seen(user.id, user.username, user.first_name)
 
     is_admin = update.effective_user.id == ADMIN_ID
     intro = (
@@ -156,7 +188,7 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Определяем период по умолчанию — неделю
     period = "week"
-    text = build_stats_text(period)
+    text = await get_stats_text(period)
     keyboard = make_period_keyboard("stats")
     if update.message:
         await update.message.reply_text(text, reply_markup=keyboard)
@@ -178,27 +210,21 @@ def _period_bounds(period: str):
         return None, None
 
 
-def build_stats_text(period: str) -> str:
-    start_iso, end_iso = _period_bounds(period)
-    rows = get_approved_profits_between(start_iso, end_iso)
+@metrics.timed("build_stats_text")
+async def build_stats_text(period: str) -> str:
+    start_iso, _ = _period_bounds(period)
+    # Агрегация по пользователям уже выполнена в БД (свёртка profit_daily)
+    rows = await adb.get_leaderboard(start_iso)
     if not rows:
         title = "Статистика за неделю" if period == "week" else ("Статистика за месяц" if period == "month" else "Статистика за всё время")
         return f"{title}\n\nЗа выбранный период нет подтверждённых профитов."
 
-    # Агрегация по пользователям
     agg = {}
     total = 0.0
-    for user_id, username, first_name, final_amount, approved_at in rows:
-        if final_amount is None:
-            continue
-        total += final_amount
+    for user_id, username, first_name, user_sum, count in rows:
+        total += user_sum
         name = f"@{username}" if username else (first_name or str(user_id))
-        entry = agg.get(user_id)
-        if not entry:
-            agg[user_id] = {"name": name, "sum": final_amount, "count": 1}
-        else:
-            entry["sum"] += final_amount
-            entry["count"] += 1
+        agg[user_id] = {"name": name, "sum": user_sum, "count": count}
 
     # Сортировка по сумме по убыванию
     items = sorted(agg.values(), key=lambda x: x["sum"], reverse=True)
@@ -229,10 +255,61 @@ def build_stats_text(period: str) -> str:
     return "\n".join(lines)
 
 
+# Кэш отрисованной общей статистики: период -> (момент построения, текст).
+# Сбрасывается при любой модерации, меняющей подтверждённые профиты.
+_stats_cache: dict[str, tuple[float, str]] = {}
+_stats_inflight: dict[str, asyncio.Task] = {}
+_stats_cache_generation = 0
+_stats_cache_counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def invalidate_stats_cache() -> None:
+    global _stats_cache_generation
+    _stats_cache_generation += 1
+    _stats_cache.clear()
+    _stats_inflight.clear()
+    _stats_cache_counters["invalidations"] += 1
+
+
+async def get_stats_text(period: str) -> str:
+    """Текст /stats из кэша; при промахе строится один раз на все параллельные запросы."""
+    if period not in ("week", "month", "all"):
+        period = "all"
+    cached = _stats_cache.get(period)
+    if cached and time.monotonic() - cached[0] < STATS_CACHE_TTL:
+        _stats_cache_counters["hits"] += 1
+        return cached[1]
+    task = _stats_inflight.get(period)
+    if task is not None:
+        _stats_cache_counters["hits"] += 1
+        return await asyncio.shield(task)
+    _stats_cache_counters["misses"] += 1
+    generation = _stats_cache_generation
+    built_at = time.monotonic()
+    task = asyncio.ensure_future(build_stats_text(period))
+    _stats_inflight[period] = task
+    try:
+        text = await asyncio.shield(task)
+    finally:
+        if _stats_inflight.get(period) is task:
+            del _stats_inflight[period]
+    # Если пока строили, данные изменились — результат в кэш не кладём
+    if generation == _stats_cache_generation:
+        _stats_cache[period] = (built_at, text)
+    return text
+
+
+def stats_cache_info() -> dict:
+    info = dict(_stats_cache_counters)
+    total = info["hits"] + info["misses"]
+    info["hit_rate"] = info["hits"] / total if total else 0.0
+    return info
+
+
 async def profit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Фиксируем пользователя в БД (дата присоединения)
     user = update.effective_user
-    ensure_user_seen(user.id, user.username, user.first_name)
+    await adb.ensure_user_seen(user.id, user.username, user.first_name)
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("⏰ Поставить текущее время", callback_data="profit_set_time")],
         [InlineKeyboardButton("❌ Отменить", callback_data="profit_cancel")]
@@ -370,6 +447,7 @@ async def profit_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@metrics.timed("profit_receive")
 async def profit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     session_msg_id = context.user_data.get("profit_session_message_id")
@@ -474,7 +552,7 @@ async def profit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
 
     # Создаём заявку в БД
-    profit_id = create_profit_request(
+    profit_id = await adb.create_profit_request(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -483,9 +561,9 @@ async def profit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Сохраняем в файловое хранилище как pending
-    row = get_profit(profit_id)
+    row = await adb.get_profit(profit_id)
     if row:
-        save_pending_profit(row)
+        mirror.save_pending(row)
 
     # Отправляем админу/в группу заявку с кнопками
     admin_keyboard = make_admin_moderation_keyboard(profit_id)
@@ -497,14 +575,14 @@ async def profit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сначала пытаемся отправить в личку админу
     if ADMIN_ID:
         try:
-            await context.bot.send_message(chat_id=ADMIN_ID, text=admin_text, reply_markup=admin_keyboard)
+            await sender.send_message(context.bot, ADMIN_ID, admin_text, sender.PRIORITY_ADMIN, reply_markup=admin_keyboard)
             target_sent = True
         except Exception:
             pass
     # Если не получилось — отправляем в группу (fallback)
     if not target_sent and GROUP_ID:
         try:
-            await context.bot.send_message(chat_id=GROUP_ID, text=admin_text, reply_markup=admin_keyboard)
+            await sender.send_message(context.bot, GROUP_ID, admin_text, sender.PRIORITY_ADMIN, reply_markup=admin_keyboard)
             target_sent = True
         except Exception:
             pass
@@ -541,8 +619,10 @@ async def profit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def admin_edit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Если админ редактирует заявку, мы ожидаем id в контексте
-    editing_id = context.user_data.get("editing_request_id")
+    # Если админ редактирует заявку, её id лежит в БД (см. db.set_editing_request)
+    if update.effective_user.id != ADMIN_ID:
+        return
+    editing_id = await adb.get_editing_request(update.effective_user.id)
     if not editing_id:
         return
     text = update.message.text.strip()
@@ -559,12 +639,13 @@ async def admin_edit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     amount = round(amount, 2)
 
-    update_final_amount(editing_id, amount)
-    row = get_profit(editing_id)
+    await adb.update_final_amount(editing_id, amount)
+    invalidate_stats_cache()
+    row = await adb.get_profit(editing_id)
     if row:
-        save_approved_profit(row)
+        mirror.save_approved(row)
 
-    context.user_data.pop("editing_request_id", None)
+    await adb.clear_editing_request(update.effective_user.id)
 
     keyboard = make_admin_moderation_keyboard(editing_id)
     await update.message.reply_text(
@@ -573,6 +654,7 @@ async def admin_edit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@metrics.timed("handle_callback", variant=metrics.callback_prefix)
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -602,7 +684,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Статистика: периоды
     if data.startswith("stats:"):
         period = data.split(":", 1)[1]
-        text = build_stats_text(period)
+        text = await get_stats_text(period)
         keyboard = make_period_keyboard("stats")
         try:
             await query.edit_message_text(text=text, reply_markup=keyboard)
@@ -615,7 +697,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("my:"):
         period = data.split(":", 1)[1]
         user_id = update.effective_user.id
-        text = build_my_text(user_id, period)
+        text = await build_my_text(user_id, period)
         keyboard = make_period_keyboard("my")
         try:
             await query.edit_message_text(text=text, reply_markup=keyboard)
@@ -642,7 +724,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if action == "edit":
             # Переводим администратора в режим редактирования суммы (в личке)
-            context.user_data["editing_request_id"] = profit_id
+            await adb.set_editing_request(update.effective_user.id, profit_id)
             try:
                 await context.bot.send_message(chat_id=update.effective_user.id, text=f"Введите новую сумму для профита в личном чате.")
             except Exception:
@@ -651,7 +733,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Общие данные заявки
-        row = get_profit(profit_id)
+        row = await adb.get_profit(profit_id)
         if not row:
             await context.bot.send_message(chat_id=query.message.chat.id, text=f"Профит не найден.")
             return
@@ -660,26 +742,14 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if action == "approve":
             # Обновляем статус и файловое хранилище
-            set_status(profit_id, "approved", approver_id=update.effective_user.id)
-            row2 = get_profit(profit_id)
+            await adb.set_status(profit_id, "approved", approver_id=update.effective_user.id)
+            invalidate_stats_cache()
+            row2 = await adb.get_profit(profit_id)
             try:
-                save_approved_profit(row2)
+                mirror.save_approved(row2)
             except Exception:
                 pass
 
-            # Уведомляем пользователя в личке
-            dm_text = f"Ваш профит подтверждён: {fmt_uah(final_amount)} 🎉 Отличная работа!"
-            try:
-                await context.bot.send_message(chat_id=user_id, text=dm_text)
-                if APPROVED_STICKER_ID:
-                    try:
-                        await context.bot.send_sticker(chat_id=user_id, sticker=APPROVED_STICKER_ID)
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-
-
             # Обновляем сообщение для админа/группы
             name = f"@{row[2]}" if row[2] else (row[3] or str(user_id))
             time_str = f" • время: {format_time_local(row[8])}" if row and row[8] else ""
@@ -687,40 +757,36 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await query.edit_message_text(text=admin_text)
             except Exception:
-                await context.bot.send_message(chat_id=query.message.chat.id, text=admin_text)
-            
-            # Публикуем итог в группе
-            try:
-                if GROUP_ID:
-                    name = f"@{row[2]}" if row[2] else (row[3] or str(user_id))
-                    group_text = f"💸 Плюс профит от {name}: {fmt_uah(final_amount)} — красавец!"
-                    await context.bot.send_message(chat_id=GROUP_ID, text=group_text)
-
-                    sticker_id = os.getenv('GROUP_STICKER_ID_MAMONT', '').strip()
-                    if sticker_id:
-                        try:
-                            await context.bot.send_sticker(chat_id=GROUP_ID, sticker=sticker_id)
-                        except Exception as e:
-                            print(f"[warn] Failed to send sticker to group: {e}")
-
-                    follow_up = "🦣 Мамонт в ловушке! Это был отличный залив, но нужно ещё. Продолжаем охоту! 🪤"
-                    await context.bot.send_message(chat_id=GROUP_ID, text=follow_up)
-            except Exception:
-                pass
+                await sender.send_message(context.bot, query.message.chat.id, admin_text, sender.PRIORITY_ADMIN)
+
+            # Уведомления пользователю и в группу рассылаются в фоне: админ не ждёт их отправки
+            bot = context.bot
+            dm_text = f"Ваш профит подтверждён: {fmt_uah(final_amount)} 🎉 Отличная работа!"
+            dm_steps = [("сообщение", lambda: sender.send_message(bot, user_id, dm_text, sender.PRIORITY_DM), False)]
+            if APPROVED_STICKER_ID:
+                dm_steps.append(("стикер", lambda: sender.send_sticker(bot, user_id, APPROVED_STICKER_ID, sender.PRIORITY_DM), True))
+            destinations = {f"ЛС {name}": dm_steps}
+            if GROUP_ID:
+                group_text = f"💸 Плюс профит от {name}: {fmt_uah(final_amount)} — красавец!"
+                group_steps = [("сообщение", lambda: sender.send_message(bot, GROUP_ID, group_text, sender.PRIORITY_GROUP), False)]
+                sticker_id = os.getenv('GROUP_STICKER_ID_MAMONT', '').strip()
+                if sticker_id:
+                    group_steps.append(("стикер", lambda: sender.send_sticker(bot, GROUP_ID, sticker_id, sender.PRIORITY_GROUP), True))
+                follow_up = "🦣 Мамонт в ловушке! Это был отличный залив, но нужно ещё. Продолжаем охоту! 🪤"
+                group_steps.append(("продолжение", lambda: sender.send_message(bot, GROUP_ID, follow_up, sender.PRIORITY_GROUP), False))
+                destinations["группа"] = group_steps
+            context.application.create_task(
+                fan_out_notifications(bot, f"подтверждение профита {fmt_uah(final_amount)} от {name}", destinations),
+                update=update,
+            )
             return
 
         if action == "reject":
-            set_status(profit_id, "rejected", approver_id=update.effective_user.id)
-            row2 = get_profit(profit_id)
+            await adb.set_status(profit_id, "rejected", approver_id=update.effective_user.id)
+            invalidate_stats_cache()
+            row2 = await adb.get_profit(profit_id)
             try:
-                save_rejected_profit(row2)
-            except Exception:
-                pass
-
-            # Уведомляем пользователя в личке об отклонении
-            try:
-                dm_text = f"Ваш профит отклонён: {fmt_uah(final_amount)}."
-                await context.bot.send_message(chat_id=user_id, text=dm_text)
+                mirror.save_rejected(row2)
             except Exception:
                 pass
 
@@ -731,10 +797,53 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await query.edit_message_text(text=admin_text)
             except Exception:
-                await context.bot.send_message(chat_id=query.message.chat.id, text=admin_text)
+                await sender.send_message(context.bot, query.message.chat.id, admin_text, sender.PRIORITY_ADMIN)
+
+            # Уведомляем пользователя в личке об отклонении (в фоне)
+            bot = context.bot
+            dm_text = f"Ваш профит отклонён: {fmt_uah(final_amount)}."
+            destinations = {f"ЛС {name}": [("сообщение", lambda: sender.send_message(bot, user_id, dm_text, sender.PRIORITY_DM), False)]}
+            context.application.create_task(
+                fan_out_notifications(bot, f"отклонение профита {fmt_uah(final_amount)} от {name}", destinations),
+                update=update,
+            )
             return
 
 
+async def _deliver_chain(steps) -> list[str]:
+    """Отправить шаги одного получателя по порядку. Возвращает описания ошибок."""
+    failures = []
+    for label, send, optional in steps:
+        try:
+            await send()
+        except Exception as e:
+            failures.append(f"{label}: {e}")
+            # Без обязательного шага (например, текста) остальное не отправляем
+            if not optional:
+                break
+    return failures
+
+
+async def fan_out_notifications(bot, what: str, destinations: dict) -> None:
+    """Разослать уведомления по получателям параллельно, сохраняя порядок внутри чата.
+
+    destinations: название получателя -> [(шаг, функция отправки, необязательный)].
+    О недоставленных уведомлениях сообщаем админу.
+    """
+    results = await asyncio.gather(*(_deliver_chain(steps) for steps in destinations.values()))
+    failures = [f"• {dest} — {failure}" for dest, items in zip(destinations, results) for failure in items]
+    if not failures:
+        return
+    logger.warning(f"Не все уведомления доставлены ({what}): " + "; ".join(failures))
+    if ADMIN_ID:
+        try:
+            await sender.send_message(
+                bot, ADMIN_ID, f"Не все уведомления доставлены ({what}):\n" + "\n".join(failures), sender.PRIORITY_ADMIN
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось сообщить админу о сбое уведомлений: {e}")
+
+
 async def reset_profits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Только админ
     if update.effective_user.id != ADMIN_ID:
@@ -742,8 +851,9 @@ async def reset_profits_command(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     # Переводим все в rejected
-    changed = reset_all_to_rejected()
-    purge_approved_and_pending()
+    changed = await adb.reset_all_to_rejected()
+    invalidate_stats_cache()
+    mirror.call(purge_approved_and_pending)
     if changed == 0:
         await update.message.reply_text("Не было заявок для изменения.")
     else:
@@ -767,7 +877,7 @@ async def reset_user_profits_command(update: Update, context: ContextTypes.DEFAU
 
     if arg.startswith("@"): 
         target_username = arg[1:]
-        ids = get_user_ids_by_username(target_username)
+        ids = await adb.get_user_ids_by_username(target_username)
         if not ids:
             await update.message.reply_text(f"Не найдено профитов для пользователя @{target_username}.")
             return
@@ -779,22 +889,285 @@ async def reset_user_profits_command(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("Укажите корректный идентификатор пользователя (число) или @username.")
             return
 
-    rows = get_profits_by_user(target_user_id)
-    if not rows:
+    # id и дата подтверждения нужны до сброса: по дате сразу находим месячный каталог файла
+    locations = await adb.get_user_profit_locations(target_user_id)
+    if not locations:
         await update.message.reply_text("У пользователя нет заявок на профит.")
         return
 
     # Переводим всё в rejected в БД
-    changed = reset_user_to_rejected(target_user_id)
+    changed = await adb.reset_user_to_rejected(target_user_id)
+    invalidate_stats_cache()
 
-    # Чистим файловое хранилище
-    for row in rows:
-        profit_id = row[0]
-        remove_files_for_profit_id(profit_id)
+    # Чистим файловое хранилище одним проходом
+    mirror.remove_many(locations)
 
     await update.message.reply_text(f"Профиты пользователя аннулированы. Изменено: {changed} записей.")
 
 
+async def check_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сверить свёртку статистики с таблицей профитов; с аргументом fix — пересобрать."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+
+    args = getattr(context, "args", []) or []
+    diffs = await adb.check_rollup()
+    if not diffs:
+        await update.message.reply_text("Свёртка статистики совпадает с таблицей профитов.")
+        return
+
+    lines = [f"Расхождений в свёртке: {len(diffs)}"]
+    for user_id, day, s_total, s_cnt, a_total, a_cnt in diffs[:10]:
+        lines.append(f"• {user_id} {day}: свёртка {s_total}/{s_cnt}, профиты {a_total}/{a_cnt}")
+    if args and args[0].lower() == "fix":
+        await adb.rebuild_rollup()
+        invalidate_stats_cache()
+        lines.append("")
+        lines.append("Свёртка пересобрана.")
+    else:
+        lines.append("")
+        lines.append("Для пересборки: /check_stats fix")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def rebuild_storage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересобрать файловое зеркало по БД; с аргументом verify — только сверить."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    args = getattr(context, "args", []) or []
+    verify_only = bool(args) and args[0].lower() == "verify"
+    await update.message.reply_text("Сверяю файловое зеркало…" if verify_only else "Пересобираю файловое зеркало…")
+    # Выполняется в очереди зеркала: все ранее поставленные записи будут учтены
+    try:
+        report = await asyncio.wrap_future(mirror.call_with_result(rebuild_mirror, verify_only))
+    except Exception as e:
+        logger.warning(f"Не удалось пересобрать файловое зеркало: {e}")
+        await update.message.reply_text("Не удалось пересобрать файловое зеркало, подробности в логе.")
+        return
+    await update.message.reply_text(report.summary())
+
+
+# Ограничение Bot API на размер отправляемого файла
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка заявок: /export [csv|jsonl] [week|month|all] [pending|approved|rejected] [user_id|@username] [gz]"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+
+    fmt, period, status, user_id, compress = "csv", "all", None, None, False
+    for arg in getattr(context, "args", []) or []:
+        token = arg.strip().lower()
+        if token in export.FORMATS:
+            fmt = token
+        elif token in ("week", "month", "all"):
+            period = token
+        elif token in ("pending", "approved", "rejected"):
+            status = token
+        elif token in ("gz", "gzip"):
+            compress = True
+        elif token.startswith("@"):
+            ids = await adb.get_user_ids_by_username(arg.strip()[1:])
+            if not ids:
+                await update.message.reply_text(f"Не найдено профитов для пользователя {arg.strip()}.")
+                return
+            if len(ids) > 1:
+                # username мог переходить от одного пользователя к другому — не угадываем
+                await update.message.reply_text(
+                    f"Под {arg.strip()} найдено несколько пользователей: {', '.join(map(str, ids))}. "
+                    "Укажите нужный user_id."
+                )
+                return
+            user_id = ids[0]
+        else:
+            try:
+                user_id = int(token)
+            except ValueError:
+                await update.message.reply_text(
+                    "Использование: /export [csv|jsonl] [week|month|all] [pending|approved|rejected] "
+                    "[user_id или @username] [gz]"
+                )
+                return
+
+    start_iso, end_iso = _period_bounds(period)
+    filename = export.export_filename(fmt, compress)
+    tmp_dir = tempfile.mkdtemp(prefix="export_")
+    path = os.path.join(tmp_dir, filename)
+    try:
+        # Выгрузка идёт курсором в потоке чтения БД, цикл событий не блокируется
+        count = await adb.run_read(
+            export.write_export, path, fmt, compress,
+            start_iso=start_iso, end_iso=end_iso, status=status, user_id=user_id,
+        )
+        if not count:
+            await update.message.reply_text("Под фильтр не попало ни одной заявки.")
+            return
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            await update.message.reply_text("Файл выгрузки больше 50 МБ. Сузьте фильтр или добавьте gz.")
+            return
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=filename,
+                caption=f"Выгрузка заявок: {count} шт.",
+            )
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        os.rmdir(tmp_dir)
+
+
+def _webhook_info_text() -> str:
+    info = webhook.latency()
+    if info is None:
+        return ""
+    return (
+        "\n\nWebhook:\n"
+        f"• принято апдейтов: {info['accepted']}, отклонено: {info['rejected']}\n"
+        f"• до начала обработки: p50 {info['p50_ms']:.1f} мс, p99 {info['p99_ms']:.1f} мс"
+    )
+
+
+def _update_processor_info_text(application: Application) -> str:
+    processor = application.update_processor
+    if not isinstance(processor, KeyedUpdateProcessor):
+        return ""
+    in_flight = processor.in_flight()
+    busiest = sorted(in_flight.items(), key=lambda item: item[1], reverse=True)[:3]
+    lines = [
+        "\n\nОбработка апдейтов:",
+        f"• в работе и в очереди: {processor.in_flight_total()} (ключей: {len(in_flight)}, лимит: {processor.max_concurrent_updates})",
+        f"• обработано: {processor.processed}",
+    ]
+    for (chat_id, user_id), count in busiest:
+        lines.append(f"• чат {chat_id}, пользователь {user_id}: {count}")
+    return "\n".join(lines)
+
+
+def _update_log_info_text() -> str:
+    info = update_log.stats()
+    return (
+        "\n\nЖурнал апдейтов:\n"
+        f"• записано: {info['logged']}, отсеяно сэмплированием: {info['sampled_out']}, сверх лимита: {info['rate_limited']}\n"
+        f"• в очереди лога: {info['queue']}, отброшено при переполнении: {info['dropped_records']}"
+    ) + _recorder_info_text()
+
+
+def _recorder_info_text() -> str:
+    info = recorder.stats()
+    if info is None:
+        return ""
+    return (
+        f"\nЗапись апдейтов ({info['path']}): записано {info['recorded']}, "
+        f"в очереди {info['queue']}, отброшено {info['dropped']}"
+    )
+
+
+async def cache_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать счётчики кэша /stats, очереди отправки и кэша участников."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    info = stats_cache_info()
+    send_info = sender.scheduler.stats()
+    await update.message.reply_text(
+        "Кэш статистики:\n"
+        f"• попаданий: {info['hits']}\n"
+        f"• промахов: {info['misses']}\n"
+        f"• сбросов: {info['invalidations']}\n"
+        f"• доля попаданий: {info['hit_rate']:.1%}\n\n"
+        "Очередь отправки:\n"
+        f"• ждут отправки: {send_info['backlog']}\n"
+        f"• отправлено: {send_info['sent']}, повторов после 429: {send_info['retried']}, ошибок: {send_info['failed']}\n\n"
+        "Кэш участников групп:\n"
+        f"• записей: {len(_member_cache)}\n"
+        f"• попаданий: {_member_cache_counters['hits']}, запросов к API: {_member_cache_counters['api_calls']}, "
+        f"записей в БД: {_member_cache_counters['writes']}"
+        + _webhook_info_text()
+        + _update_processor_info_text(context.application)
+        + _update_log_info_text()
+    )
+
+
+_profile_task: asyncio.Task | None = None
+
+
+async def _run_profile(bot, prof: profiler.SamplingProfiler, seconds: float, chat_id: int | None) -> None:
+    """Дождаться конца профилирования, сохранить collapsed stacks и отправить файл админу."""
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        # Профиль, прерванный остановкой бота, тоже сохраняется.
+        # stop() — в потоке цикла событий: там же вызывался start()
+        prof.stop()
+        path = await loop.run_in_executor(None, prof.save)
+        logger.info(f"Профиль сохранён: {path}")
+    if not chat_id:
+        return
+    try:
+        if not prof.stacks:
+            await bot.send_message(chat_id=chat_id, text=prof.summary() + "\nБот простаивал, профиль пуст.")
+            return
+        with open(path, "rb") as f:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=f,
+                filename=os.path.basename(path),
+                caption=prof.summary()[:1024],
+            )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить профиль: {e}")
+
+
+def start_profile(application: Application, seconds: float, chat_id: int | None) -> bool:
+    """Запустить профилирование на seconds секунд; False, если оно уже идёт."""
+    global _profile_task
+    prof = profiler.start()
+    if prof is None:
+        return False
+    _profile_task = asyncio.create_task(_run_profile(application.bot, prof, seconds, chat_id))
+    return True
+
+
+def _profile_on_signal(application: Application) -> None:
+    if start_profile(application, profiler.PROFILE_SIGNAL_SECONDS, ADMIN_ID or None):
+        logger.info(f"SIGUSR1: профилирование на {profiler.PROFILE_SIGNAL_SECONDS:.0f} с")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сэмплирующее профилирование на N секунд: /profile [секунды]"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    seconds = 10.0
+    args = getattr(context, "args", []) or []
+    if args:
+        try:
+            seconds = float(args[0])
+        except ValueError:
+            await update.message.reply_text(f"Использование: /profile [секунды, 1–{profiler.PROFILE_MAX_SECONDS}]")
+            return
+    seconds = min(max(seconds, 1.0), profiler.PROFILE_MAX_SECONDS)
+    if not start_profile(context.application, seconds, update.effective_chat.id):
+        await update.message.reply_text("Профилирование уже идёт, дождитесь результата.")
+        return
+    await update.message.reply_text(f"Профилирую {seconds:.0f} с, затем пришлю файл со стеками.")
+
+
+async def stop_profile() -> None:
+    if _profile_task is not None and not _profile_task.done():
+        _profile_task.cancel()
+        await asyncio.gather(_profile_task, return_exceptions=True)
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_admin = update.effective_user.id == ADMIN_ID
     is_private = update.effective_chat.type == "private"
@@ -815,6 +1188,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Команды администратора:",
                 "• /reset_profits — аннулировать все профиты",
                 "• /reset_user_profits <user_id или @username> — аннулировать профиты пользователя",
+                "• /check_stats [fix] — сверить (и пересобрать) свёртку статистики",
+                "• /cache_stats — счётчики кэшей и очереди отправки",
+                "• /profile [секунды] — профиль обработчиков (collapsed stacks) файлом",
+                "• /rebuild_storage [verify] — пересобрать (или сверить) файловое зеркало по БД",
+                "• /export [csv|jsonl] [week|month|all] [статус] [user_id или @username] [gz] — выгрузка заявок файлом (период — по дате подачи заявки)",
             ]
         lines += [
             "",
@@ -843,7 +1221,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def suggest_start_conv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    ensure_user_seen(user.id, user.username, user.first_name)
+    await adb.ensure_user_seen(user.id, user.username, user.first_name)
     prompt = "Опишите ваше предложение по улучшению одним сообщением. Для отмены — /cancel."
     if update.message:
         await update.message.reply_text(prompt)
@@ -872,7 +1250,7 @@ async def suggest_receive_conv(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     if ADMIN_ID:
         try:
-            await context.bot.send_message(chat_id=ADMIN_ID, text=admin_text)
+            await sender.send_message(context.bot, ADMIN_ID, admin_text, sender.PRIORITY_ADMIN)
         except Exception:
             pass
     await update.message.reply_text("Спасибо! Ваше предложение отправлено администратору.")
@@ -904,7 +1282,7 @@ async def route_private_text_in_profit_dialog(update: Update, context: ContextTy
         )
         if ADMIN_ID:
             try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_text)
+                await sender.send_message(context.bot, ADMIN_ID, admin_text, sender.PRIORITY_ADMIN)
             except Exception:
                 pass
         await update.message.reply_text("Спасибо! Ваше предложение отправлено администратору. Вернёмся к заявке на профит.")
@@ -939,11 +1317,13 @@ def _period_bounds(period: str):
         return None, None
 
 
-def build_my_text(user_id: int, period: str) -> str:
+@metrics.timed("build_my_text")
+async def build_my_text(user_id: int, period: str) -> str:
     start_iso, end_iso = _period_bounds(period)
-    rows = get_profits_by_user(user_id)
+    # Сумма и топ-5 считаются в SQLite по покрывающему индексу
+    total, count = await adb.get_user_period_total(user_id, start_iso, end_iso)
     # Информация о присоединении
-    first_seen_iso = get_user_first_seen(user_id)
+    first_seen_iso = await adb.get_user_first_seen(user_id)
     join_line = None
     if first_seen_iso:
         try:
@@ -953,19 +1333,6 @@ def build_my_text(user_id: int, period: str) -> str:
             join_line = f"Дата присоединения: {date_str} • всего в боте: {days} дн."
         except Exception:
             pass
-    # Фильтруем по подтверждённым и по периоду approved_at
-    approved_rows = []
-    for row in rows:
-        status = row[7]
-        approved_at = row[9]
-        final_amount = row[5]
-        if status != "approved" or final_amount is None:
-            continue
-        if start_iso and approved_at and approved_at < start_iso:
-            continue
-        if end_iso and approved_at and approved_at > end_iso:
-            continue
-        approved_rows.append(row)
     title = (
         "Моя статистика за неделю" if period == "week"
         else ("Моя статистика за месяц" if period == "month" else "Моя статистика за всё время")
@@ -974,19 +1341,15 @@ def build_my_text(user_id: int, period: str) -> str:
     if join_line:
         lines.append(join_line)
         lines.append("")
-    if not approved_rows:
+    if not count:
         lines.append("За выбранный период нет подтверждённых профитов.")
         return "\n".join(lines)
-    total = 0.0
-    for row in approved_rows:
-        total += row[5] or 0.0
     # Топ-5 по сумме
-    top = sorted(approved_rows, key=lambda r: (r[5] or 0.0), reverse=True)[:5]
+    top = await adb.get_user_top_profits(user_id, start_iso, end_iso, limit=5)
     lines.append(f"Итого подтверждено: {fmt_uah(total)}")
     lines.append("Топ-5 профитов:")
-    for idx, r in enumerate(top, start=1):
-        amt = r[5] or 0.0
-        dt = r[9]
+    for idx, (amt, dt) in enumerate(top, start=1):
+        amt = amt or 0.0
         # Форматируем дату: только дата без времени
         date_str = dt
         if dt:
@@ -1002,10 +1365,9 @@ def build_my_text(user_id: int, period: str) -> str:
 async def my_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Фиксируем пользователя в БД (дата присоединения)
     user = update.effective_user
-    ensure_user_seen(user.id, user.username, user.first_name)
+    await adb.ensure_user_seen(user.id, user.username, user.first_name)
     user_id = update.effective_user.id
-    rows = get_profits_by_user(user_id)
-    if not rows:
+    if not await adb.user_has_profits(user_id):
         msg = "У вас пока нет заявок на профит."
         if update.message:
             await update.message.reply_text(msg)
@@ -1020,7 +1382,7 @@ async def my_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     pass
         return
     # По умолчанию показываем за всё время и даём кнопки переключения периода
-    text = build_my_text(user_id, period="all")
+    text = await build_my_text(user_id, period="all")
     keyboard = make_period_keyboard("my")
     if update.message:
         await update.message.reply_text(text, reply_markup=keyboard)
@@ -1066,6 +1428,36 @@ def format_time_local(iso_str: str) -> str:
             return datetime.utcnow().strftime("%d.%m %H:%M") + " UTC"
 
 
+# Кэш статусов участников: (chat_id, user_id) -> (status, username, first_name, истекает).
+# LRU: при переполнении вытесняется давно не встречавшийся участник, за O(1)
+_member_cache: OrderedDict[tuple[int, int], tuple[str, str | None, str | None, float]] = OrderedDict()
+_MEMBER_CACHE_MAX = 100_000
+_member_cache_counters = {"hits": 0, "api_calls": 0, "writes": 0}
+
+
+def _cache_member(key: tuple[int, int], entry: tuple[str, str | None, str | None, float]) -> None:
+    _member_cache[key] = entry
+    _member_cache.move_to_end(key)
+    while len(_member_cache) > _MEMBER_CACHE_MAX:
+        _member_cache.popitem(last=False)
+
+
+async def remember_member(chat_id: int, user_id: int, username: str | None, first_name: str | None, status: str) -> bool:
+    """Обновить кэш участника и записать в БД, только если что-то изменилось."""
+    now = time.monotonic()
+    key = (chat_id, user_id)
+    cached = _member_cache.get(key)
+    entry = (status, username, first_name, now + MEMBER_CACHE_TTL)
+    if cached is not None and cached[:3] == entry[:3]:
+        _cache_member(key, entry)
+        return False
+    await adb.set_member_status(chat_id, user_id, username, first_name, status)
+    _cache_member(key, entry)
+    invalidate_mentions(chat_id)
+    _member_cache_counters["writes"] += 1
+    return True
+
+
 async def track_group_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Сохраняем статусы участников групп по апдейтам chat_member/my_chat_member."""
     cm = update.chat_member or update.my_chat_member
@@ -1078,111 +1470,206 @@ async def track_group_activity(update: Update, context: ContextTypes.DEFAULT_TYP
     user = member.user
     status = member.status
     try:
-        set_member_status(chat.id, user.id, user.username, user.first_name, status)
+        await remember_member(chat.id, user.id, user.username, user.first_name, status)
     except Exception as e:
         logger.warning(f"Не удалось сохранить статус участника: {e}")
-def main() -> None:
-    # Гарантируем один экземпляр через lock-файл
-    lock_path = os.path.join(os.path.dirname(__file__), "bot.lock")
-    with FileLock(lock_path):
-        init_db()
 
-        # Персистентность состояния и диалогов
-        state_path = os.path.join(os.path.dirname(__file__), "bot_state.pkl")
-        persistence = PicklePersistence(filepath=state_path)
-        application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
 
-        # Диалог /profit (persistent)
-        profit_conv = ConversationHandler(
-            entry_points=[
-                CommandHandler("profit", profit_command, filters=filters.ChatType.PRIVATE),
-                CallbackQueryHandler(profit_command, pattern="^start_profit$"),
+def register_metrics_gauges(application: Application) -> None:
+    metrics.register_gauge("bot_update_queue_depth", "Апдейты, ждущие обработки", application.update_queue.qsize)
+    metrics.register_gauge("bot_send_backlog", "Сообщения в очереди отправки", sender.backlog)
+    metrics.register_gauge("bot_mirror_queue_depth", "Задачи записи файлового зеркала", mirror.queue_depth)
+    metrics.register_gauge("bot_mirror_dropped", "Записи зеркала, пропущенные при переполнении очереди", mirror.dropped)
+    metrics.register_gauge("bot_log_queue_depth", "Записи лога, ожидающие вывода", update_log.queue_depth)
+    metrics.register_gauge("bot_db_pending_touches", "Отложенные записи last_seen/статусов", adb.pending_touches)
+    processor = application.update_processor
+    if isinstance(processor, KeyedUpdateProcessor):
+        metrics.register_gauge("bot_updates_in_flight", "Апдейты в обработке и в очереди по ключам", processor.in_flight_total)
+    metrics.register_gauge("bot_stats_cache_hit_ratio", "Доля попаданий кэша /stats", lambda: stats_cache_info()["hit_rate"])
+
+
+async def on_startup(application: Application) -> None:
+    # Периодический сброс отложенных записей (last_seen, статусы участников)
+    adb.start_flusher()
+    # Фоновая запись файлового зеркала профитов
+    mirror.start()
+    # Очередь исходящих сообщений с учётом лимитов Telegram
+    sender.start()
+    # Метрики (/metrics на METRICS_PORT, если задан)
+    register_metrics_gauges(application)
+    await metrics.start()
+    # Запись апдейтов для bench/replay.py (RECORD_UPDATES)
+    recorder.start(ADMIN_ID, GROUP_ID)
+    # kill -USR1 <pid> — профилирование на PROFILE_SIGNAL_SECONDS, файл в profiles/ и админу
+    sigusr1 = getattr(signal, "SIGUSR1", None)
+    if sigusr1 is not None:
+        try:
+            asyncio.get_running_loop().add_signal_handler(sigusr1, _profile_on_signal, application)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+
+async def on_stop(application: Application) -> None:
+    # Вызывается после Application.stop(), пока Bot и персистентность ещё открыты
+    # (post_shutdown идёт уже после их закрытия).
+    # Прерываем /all: прогресс в chat_data сохранит shutdown(), следующий /all продолжит рассылку
+    await stop_all_runs()
+    # Досылаем то, что осталось в очереди отправки
+    await sender.stop()
+
+
+async def on_shutdown(application: Application) -> None:
+    await metrics.stop()
+    await stop_profile()
+    # Дописываем очередь файлового зеркала
+    await asyncio.get_running_loop().run_in_executor(None, mirror.stop)
+    await asyncio.get_running_loop().run_in_executor(None, recorder.stop)
+    # Сбрасываем отложенные записи и дожидаемся незавершённых запросов к БД
+    await adb.shutdown()
+
+
+def build_application(with_updater: bool = True, request: BaseRequest | None = None) -> Application:
+    """Собрать Application со всеми обработчиками (без запуска).
+
+    request подменяет HTTP-клиент Bot API (bench/loadtest.py передаёт поддельный).
+    """
+    # Персистентность состояния и диалогов
+    # Состояние хранится в SQLite построчно; старый bot_state.pkl переносится при первом запуске
+    state_path = os.path.join(os.path.dirname(__file__), "bot_state.db")
+    legacy_state_path = os.path.join(os.path.dirname(__file__), "bot_state.pkl")
+    persistence = SQLitePersistence(
+        filepath=state_path,
+        legacy_pickle_path=legacy_state_path,
+        update_interval=float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "60")),
+    )
+    update_processor = KeyedUpdateProcessor()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Тот же HTTPXRequest, что по умолчанию, но со сбором метрик Bot API
+        .request(request or metrics.MetricsRequest(connection_pool_size=256))
+        .persistence(persistence)
+        # Разные чаты/пользователи — параллельно, один (чат, пользователь) — по порядку
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if not with_updater:
+        # Воркер шардирования: апдейты приходят от ingress-процесса, сам он Telegram не опрашивает
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Диалог /profit (persistent)
+    profit_conv = ConversationHandler(
+        entry_points=[
+            CommandHandler("profit", profit_command, filters=filters.ChatType.PRIVATE),
+            CallbackQueryHandler(profit_command, pattern="^start_profit$"),
+            MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Добавить профит$"), profit_command),
+        ],
+        states={
+            ASK_AMOUNT: [
                 MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Добавить профит$"), profit_command),
-            ],
-            states={
-                ASK_AMOUNT: [
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Добавить профит$"), profit_command),
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Моя статистика$"), my_command),
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Помощь$"), help_command),
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Статистика$"), stats_private_notice),
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Предложения по улучшению$"), suggest_start_inside_profit),
-                    MessageHandler(
-                        filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND,
-                        route_private_text_in_profit_dialog,
-                    ),
-                    CallbackQueryHandler(profit_cancel_button, pattern="^profit_cancel$"),
-                    CallbackQueryHandler(profit_set_time_button, pattern="^profit_set_time$"),
-                ],
-                ConversationHandler.TIMEOUT: [TypeHandler(Update, profit_timeout)],
-            },
-            fallbacks=[
-                CommandHandler("cancel", profit_cancel, filters=filters.ChatType.PRIVATE),
+                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Моя статистика$"), my_command),
+                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Помощь$"), help_command),
+                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Статистика$"), stats_private_notice),
+                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Предложения по улучшению$"), suggest_start_inside_profit),
+                MessageHandler(
+                    filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND,
+                    route_private_text_in_profit_dialog,
+                ),
                 CallbackQueryHandler(profit_cancel_button, pattern="^profit_cancel$"),
+                CallbackQueryHandler(profit_set_time_button, pattern="^profit_set_time$"),
             ],
-            conversation_timeout=600,
-            name="profit",
-            persistent=True,
-            per_chat=True,
-            per_user=True,
-            per_message=False,
-        )
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, profit_timeout)],
+        },
+        fallbacks=[
+            CommandHandler("cancel", profit_cancel, filters=filters.ChatType.PRIVATE),
+            CallbackQueryHandler(profit_cancel_button, pattern="^profit_cancel$"),
+        ],
+        conversation_timeout=600,
+        name="profit",
+        persistent=True,
+        per_chat=True,
+        per_user=True,
+        per_message=False,
+    )
 
-        # Диалог предложений (persistent)
-        suggest_conv = ConversationHandler(
-            entry_points=[
-                CommandHandler("suggest", suggest_start_conv, filters=filters.ChatType.PRIVATE),
-                CallbackQueryHandler(suggest_start_conv, pattern="^start:suggest$"),
-                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Предложения по улучшению$"), suggest_start_conv),
-            ],
-            states={
-                SUGGEST_WAIT_TEXT: [
-                    MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, suggest_receive_conv),
-                    CommandHandler("cancel", suggest_cancel_command),
-                ]
-            },
-            fallbacks=[
+    # Диалог предложений (persistent)
+    suggest_conv = ConversationHandler(
+        entry_points=[
+            CommandHandler("suggest", suggest_start_conv, filters=filters.ChatType.PRIVATE),
+            CallbackQueryHandler(suggest_start_conv, pattern="^start:suggest$"),
+            MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Предложения по улучшению$"), suggest_start_conv),
+        ],
+        states={
+            SUGGEST_WAIT_TEXT: [
+                MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, suggest_receive_conv),
                 CommandHandler("cancel", suggest_cancel_command),
-            ],
-            conversation_timeout=600,
-            name="suggest",
-            persistent=True,
-            per_chat=True,
-            per_user=True,
-            per_message=False,
-        )
+            ]
+        },
+        fallbacks=[
+            CommandHandler("cancel", suggest_cancel_command),
+        ],
+        conversation_timeout=600,
+        name="suggest",
+        persistent=True,
+        per_chat=True,
+        per_user=True,
+        per_message=False,
+    )
+
+    # Регистрируем обработчики команд и сообщений
+    application.add_handler(CommandHandler("start", start, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("stats", stats, filters=filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("all", all_command, filters=filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("reset_profits", reset_profits_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("reset_user_profits", reset_user_profits_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("check_stats", check_stats_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("cache_stats", cache_stats_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("rebuild_storage", rebuild_storage_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("export", export_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("my", my_command, filters=filters.ChatType.PRIVATE))
+    application.add_handler(profit_conv)
+    application.add_handler(suggest_conv)
+    # Reply-кнопки в личке: Моя статистика, Помощь, Статистика
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Моя статистика$"), my_command))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Помощь$"), help_command))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Статистика$"), stats_private_notice))
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, admin_edit_amount))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, echo))
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.Sticker.ALL, sticker_id_helper))
+    application.add_handler(ChatMemberHandler(track_group_activity, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_group_activity, ChatMemberHandler.MY_CHAT_MEMBER))
+    # Фиксировать участников по групповым сообщениям для расширения охвата /all
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, track_message_member_status))
+
+    # Имена сработавших обработчиков для журнала апдейтов
+    update_log.tag_handlers(application)
+    return application
 
-        # Регистрируем обработчики команд и сообщений
-        application.add_handler(CommandHandler("start", start, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler("stats", stats, filters=filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("all", all_command, filters=filters.ChatType.GROUPS))
-        application.add_handler(CommandHandler("reset_profits", reset_profits_command, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler("reset_user_profits", reset_user_profits_command, filters=filters.ChatType.PRIVATE))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("my", my_command, filters=filters.ChatType.PRIVATE))
-        application.add_handler(profit_conv)
-        application.add_handler(suggest_conv)
-        # Reply-кнопки в личке: Моя статистика, Помощь, Статистика
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Моя статистика$"), my_command))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Помощь$"), help_command))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & filters.Regex("^Статистика$"), stats_private_notice))
-        application.add_handler(CallbackQueryHandler(handle_callback))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, admin_edit_amount))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, echo))
-        application.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.Sticker.ALL, sticker_id_helper))
-        application.add_handler(ChatMemberHandler(track_group_activity, ChatMemberHandler.CHAT_MEMBER))
-        application.add_handler(ChatMemberHandler(track_group_activity, ChatMemberHandler.MY_CHAT_MEMBER))
-        # Фиксировать участников по групповым сообщениям для расширения охвата /all
-        application.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, track_message_member_status))
-
-                # Debug-хэндлер для логирования всех апдейтов
-        async def debug_all(update: Update, context):
-            print(f"DEBUG: Получено обновление: {update}")
-            logger.info(f"Получено обновление: {update}")
-
-        application.add_handler(MessageHandler(filters.ALL, debug_all))
+
+def main() -> None:
+    # Гарантируем один экземпляр через lock-файл
+    lock_path = os.path.join(os.path.dirname(__file__), "bot.lock")
+    with FileLock(lock_path):
+        init_db()
+        if BOT_WORKERS > 1:
+            # Несколько процессов-воркеров за одним приёмником апдейтов (см. sharding.py)
+            sharding.run_sharded(BOT_WORKERS, BOT_MODE, BOT_TOKEN, TELEGRAM_API_URL or None)
+            return
+        application = build_application()
 
         print("Бот запущен. Нажмите Ctrl+C для остановки.")
-        application.run_polling(drop_pending_updates=True)
+        if BOT_MODE == "webhook":
+            webhook.run_webhook(application)
+        else:
+            application.run_polling(drop_pending_updates=True)
 
 
 
@@ -1195,9 +1682,19 @@ async def track_message_member_status(update: Update, context: ContextTypes.DEFA
         return
     chat_id = update.effective_chat.id
     try:
-        cm = await context.bot.get_chat_member(chat_id, user.id)
-        status = cm.status
-        set_member_status(chat_id, user.id, user.username, user.first_name, status)
+        cached = _member_cache.get((chat_id, user.id))
+        if cached is not None and cached[3] > time.monotonic():
+            # Статус свежий (его обновляют и апдейты chat_member) — к API не ходим
+            _member_cache_counters["hits"] += 1
+            _member_cache.move_to_end((chat_id, user.id))
+            if cached[1:3] == (user.username, user.first_name):
+                return
+            status = cached[0]
+        else:
+            _member_cache_counters["api_calls"] += 1
+            cm = await context.bot.get_chat_member(chat_id, user.id)
+            status = cm.status
+        await remember_member(chat_id, user.id, user.username, user.first_name, status)
     except Exception as e:
         logger.debug(f"track_message_member_status: skip ({e})")
 
@@ -1209,6 +1706,94 @@ def _format_mention(user_id: int, username: str | None, first_name: str | None)
     return f"<a href=\"tg://user?id={user_id}\">{name}</a>"
 
 
+# Готовые пачки упоминаний для /all: chat_id -> [(последний user_id в пачке, текст)]
+_mention_batches: dict[int, list[tuple[int, str]]] = {}
+_mention_versions: dict[int, int] = {}
+# Админы как запасной список для /all: chat_id -> (истекает, участники)
+_admin_fallback: dict[int, tuple[float, list]] = {}
+# Идущие рассылки /all по чатам
+_all_runs: dict[int, asyncio.Task] = {}
+# Чаты, где /all уже принят, но рассылка ещё не запущена (идёт сбор пачек)
+_all_starting: set[int] = set()
+
+
+def invalidate_mentions(chat_id: int) -> None:
+    _mention_batches.pop(chat_id, None)
+    _mention_versions[chat_id] = _mention_versions.get(chat_id, 0) + 1
+
+
+async def _get_admin_fallback(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> list:
+    cached = _admin_fallback.get(chat_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    members = []
+    try:
+        admins = await context.bot.get_chat_administrators(chat_id)
+        for a in admins:
+            u = a.user
+            members.append((u.id, u.username, u.first_name, 'administrator'))
+    except Exception:
+        return []
+    _admin_fallback[chat_id] = (time.monotonic() + ALL_ADMIN_FALLBACK_TTL, members)
+    return members
+
+
+async def get_mention_batches(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> list[tuple[int, str]]:
+    """Пачки упоминаний для /all (кэшируются до изменения состава чата)."""
+    batches = _mention_batches.get(chat_id)
+    if batches is not None:
+        return batches
+    version = _mention_versions.get(chat_id, 0)
+    members = await adb.get_active_members(chat_id) or []
+    from_db = bool(members)
+    # Фоллбек: если база пустая, попробуем упомянуть админов
+    if not members:
+        members = await _get_admin_fallback(context, chat_id)
+
+    unique = {}
+    for uid, uname, fname, _ in members:
+        unique[uid] = (uname, fname)
+    # Порядок по user_id стабилен, поэтому прерванную рассылку можно продолжить
+    ordered = sorted(unique.items())
+    batches = []
+    for i in range(0, len(ordered), ALL_BATCH_SIZE):
+        chunk = ordered[i:i + ALL_BATCH_SIZE]
+        text = " ".join(_format_mention(uid, uname, fname) for uid, (uname, fname) in chunk)
+        batches.append((chunk[-1][0], text))
+    if from_db and _mention_versions.get(chat_id, 0) == version:
+        _mention_batches[chat_id] = batches
+    return batches
+
+
+async def _run_all(application: Application, chat_data: dict, chat_id: int, batches: list, start: int) -> None:
+    try:
+        for idx in range(start, len(batches)):
+            last_user_id, mentions = batches[idx]
+            prefix = "Призываю всех:" if idx == 0 else "Продолжаю отмечать:"
+            try:
+                await sender.send_message(
+                    application.bot, chat_id, prefix + "\n" + mentions, sender.PRIORITY_GROUP,
+                    parse_mode=ParseMode.HTML, disable_web_page_preview=True,
+                )
+            except Exception as e:
+                # Прогресс не двигаем: следующий /all начнёт с этой же пачки
+                logger.warning(f"Не удалось отправить упоминания, рассылка /all прервана: {e}")
+                return
+            # Прогресс в chat_data: после перезапуска /all продолжит с этого места
+            chat_data["all_progress"] = {
+                "last_user_id": last_user_id,
+                "sent": idx + 1,
+                "total": len(batches),
+                "updated": time.time(),
+            }
+            application.mark_data_for_update_persistence(chat_ids=chat_id)
+        chat_data.pop("all_progress", None)
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+    finally:
+        _all_runs.pop(chat_id, None)
+
+
+@metrics.timed("all_command")
 async def all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отметить (упомянуть) всех известных активных участников группы."""
     if update.effective_chat.type not in ("group", "supergroup"):
@@ -1217,39 +1802,47 @@ async def all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     chat_id = update.effective_chat.id
 
-    members = get_active_members(chat_id) or []
-
-    # Фоллбек: если база пустая, попробуем упомянуть админов
-    if not members:
-        try:
-            admins = await context.bot.get_chat_administrators(chat_id)
-            for a in admins:
-                u = a.user
-                members.append((u.id, u.username, u.first_name, 'administrator'))
-        except Exception:
-            pass
-
-    if not members:
-        await update.message.reply_text("Не удалось получить список участников. Попробуйте позже.")
+    running = _all_runs.get(chat_id)
+    if chat_id in _all_starting or (running and not running.done()):
+        progress = context.chat_data.get("all_progress") or {}
+        await update.message.reply_text(
+            f"Уже отмечаю всех: отправлено {progress.get('sent', 0)} из {progress.get('total', '?')} сообщений."
+        )
         return
+    # Апдейты разных админов одного чата обрабатываются параллельно: занимаем чат
+    # до первого await, иначе два /all пройдут проверку выше одновременно
+    _all_starting.add(chat_id)
+    try:
+        batches = await get_mention_batches(context, chat_id)
+        if not batches:
+            await update.message.reply_text("Не удалось получить список участников. Попробуйте позже.")
+            return
 
-    unique = {}
-    for uid, uname, fname, _ in members:
-        unique[uid] = (uname, fname)
-
-    mentions = [_format_mention(uid, uname, fname) for uid, (uname, fname) in unique.items()]
+        start = 0
+        progress = context.chat_data.get("all_progress")
+        if progress and time.time() - progress.get("updated", 0) < ALL_RESUME_WINDOW:
+            # Продолжаем прерванную рассылку с первой пачки после последнего отмеченного
+            start = next((i for i, (last, _) in enumerate(batches) if last > progress["last_user_id"]), 0)
+        context.chat_data["all_progress"] = {
+            "last_user_id": batches[start - 1][0] if start else 0,
+            "sent": start,
+            "total": len(batches),
+            "updated": time.time(),
+        }
+        # Рассылка идёт в фоне через очередь отправки (20 сообщений в минуту на группу)
+        _all_runs[chat_id] = asyncio.create_task(
+            _run_all(context.application, context.chat_data, chat_id, batches, start)
+        )
+    finally:
+        _all_starting.discard(chat_id)
 
-    # Ограничим длину: отправляем батчами по ~25 упоминаний
-    batch_size = 25
-    chunks = [mentions[i:i+batch_size] for i in range(0, len(mentions), batch_size)]
 
-    for idx, chunk in enumerate(chunks):
-        prefix = "Призываю всех:" if idx == 0 else "Продолжаю отмечать:"
-        text = prefix + "\n" + " ".join(chunk)
-        try:
-            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-        except Exception as e:
-            logger.warning(f"Не удалось отправить упоминания: {e}")
+async def stop_all_runs() -> None:
+    """Прервать идущие /all (прогресс останется в chat_data)."""
+    tasks = list(_all_runs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,72 @@
 import os
 import sqlite3
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "bot.db")
 
-
-def _connect():
-    return sqlite3.connect(DB_PATH)
+# Долгоживущие соединения: по одному на поток, открываются при первом обращении
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+
+def _open(path: str) -> sqlite3.Connection:
+    # check_same_thread=False нужен только для закрытия из close_connections();
+    # в работе каждое соединение используется лишь своим потоком
+    conn = sqlite3.connect(path, timeout=30, cached_statements=256, check_same_thread=False)
+    # WAL: читатели не ждут писателей, а commit не делает fsync журнала отката
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-16000")  # ~16 МБ страничного кэша
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 МБ
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def _connect() -> sqlite3.Connection:
+    """Вернуть соединение текущего потока, открыв его при необходимости."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH or _local.generation != _generation:
+        conn = _open(DB_PATH)
+        _local.conn = conn
+        _local.path = DB_PATH
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections() -> None:
+    """Закрыть все открытые соединения (при остановке бота)."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _connections.clear()
+
+
+@contextmanager
+def _transaction():
+    """Транзакция записи, захватывающая блокировку сразу (для read-modify-write)."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
 
 def init_db():
-    conn = _connect()
-    try:
+    with _connect() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS profits (
@@ -55,6 +110,16 @@ def init_db():
             )
             """
         )
+        # Заявка, сумму которой админ сейчас вводит (кнопка «Изменить»). Не в user_data:
+        # при BOT_WORKERS > 1 нажатие в группе и ответ в личке обрабатывают разные воркеры
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS admin_edits (
+                user_id INTEGER PRIMARY KEY,
+                profit_id INTEGER NOT NULL
+            )
+            """
+        )
         # Индексы для ускорения запросов
         conn.execute(
             """
@@ -80,15 +145,36 @@ def init_db():
             ON users(last_seen)
             """
         )
-        conn.commit()
-    finally:
-        conn.close()
+        # Покрывающий индекс для личной статистики (/my): сумма и топ без чтения таблицы
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_profits_user_status_approved_amount
+            ON profits(user_id, status, approved_at, final_amount)
+            """
+        )
+        # Свёртка подтверждённых профитов по пользователю и дню (UTC) для /stats
+        rollup_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'profit_daily'"
+        ).fetchone()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS profit_daily (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL, -- YYYY-MM-DD по approved_at
+                total REAL NOT NULL,
+                cnt INTEGER NOT NULL,
+                PRIMARY KEY (user_id, day)
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_profit_daily_day ON profit_daily(day)")
+        if not rollup_exists:
+            _rebuild_rollup(conn)
 
 
 def create_profit_request(user_id: int, username: str | None, first_name: str | None,
                           amount: float, note: str | None) -> int:
-    conn = _connect()
-    try:
+    with _connect() as conn:
         now = datetime.utcnow().isoformat()
         cur = conn.execute(
             """
@@ -97,197 +183,478 @@ def create_profit_request(user_id: int, username: str | None, first_name: str |
             """,
             (user_id, username, first_name, amount, amount, note, now),
         )
-        conn.commit()
         return cur.lastrowid
-    finally:
-        conn.close()
 
 
 def get_profit(profit_id: int):
     conn = _connect()
-    try:
-        cur = conn.execute("SELECT * FROM profits WHERE id = ?", (profit_id,))
-        row = cur.fetchone()
-        return row
-    finally:
-        conn.close()
+    cur = conn.execute("SELECT * FROM profits WHERE id = ?", (profit_id,))
+    row = cur.fetchone()
+    return row
 
 
-def update_final_amount(profit_id: int, new_amount: float):
+def get_profits_by_ids(ids) -> dict:
+    """Заявки по списку id: {id: строка}; отсутствующих id в ответе нет."""
     conn = _connect()
-    try:
+    ids = list(ids)
+    rows = {}
+    # Пачками: у SQLite ограничено число параметров запроса
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT * FROM profits WHERE id IN ({placeholders})", chunk):
+            rows[row[0]] = row
+    return rows
+
+
+def update_final_amount(profit_id: int, new_amount: float):
+    with _transaction() as conn:
+        old = conn.execute(
+            "SELECT user_id, status, final_amount, approved_at FROM profits WHERE id = ?",
+            (profit_id,),
+        ).fetchone()
         conn.execute(
             "UPDATE profits SET final_amount = ? WHERE id = ?",
             (new_amount, profit_id),
         )
-        conn.commit()
-    finally:
-        conn.close()
+        if old and old[1] == "approved":
+            _rollup_add(conn, old[0], old[3], old[2], -1)
+            _rollup_add(conn, old[0], old[3], new_amount, 1)
 
 
 def set_status(profit_id: int, status: str, approver_id: int | None = None):
-    conn = _connect()
-    try:
+    with _transaction() as conn:
+        old = conn.execute(
+            "SELECT user_id, status, final_amount, approved_at FROM profits WHERE id = ?",
+            (profit_id,),
+        ).fetchone()
         approved_at = datetime.utcnow().isoformat() if status == "approved" else None
         conn.execute(
             "UPDATE profits SET status = ?, approver_id = ?, approved_at = ? WHERE id = ?",
             (status, approver_id, approved_at, profit_id),
         )
-        conn.commit()
-    finally:
-        conn.close()
+        if old:
+            if old[1] == "approved":
+                _rollup_add(conn, old[0], old[3], old[2], -1)
+            if status == "approved":
+                _rollup_add(conn, old[0], approved_at, old[2], 1)
+
+
+def set_editing_request(user_id: int, profit_id: int) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO admin_edits (user_id, profit_id) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET profit_id = excluded.profit_id",
+            (user_id, profit_id),
+        )
+
+
+def get_editing_request(user_id: int) -> int | None:
+    row = _connect().execute("SELECT profit_id FROM admin_edits WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def clear_editing_request(user_id: int) -> None:
+    with _connect() as conn:
+        conn.execute("DELETE FROM admin_edits WHERE user_id = ?", (user_id,))
 
 
 def get_approved_profits_between(start_iso: str | None, end_iso: str | None):
     conn = _connect()
-    try:
-        base_sql = "SELECT user_id, username, first_name, final_amount, approved_at FROM profits WHERE status = 'approved'"
-        params = []
-        if start_iso:
-            base_sql += " AND approved_at >= ?"
-            params.append(start_iso)
-        if end_iso:
-            base_sql += " AND approved_at <= ?"
-            params.append(end_iso)
-        cur = conn.execute(base_sql, params)
-        return cur.fetchall()
-    finally:
-        conn.close()
+    base_sql = "SELECT user_id, username, first_name, final_amount, approved_at FROM profits WHERE status = 'approved'"
+    params = []
+    if start_iso:
+        base_sql += " AND approved_at >= ?"
+        params.append(start_iso)
+    if end_iso:
+        base_sql += " AND approved_at <= ?"
+        params.append(end_iso)
+    cur = conn.execute(base_sql, params)
+    return cur.fetchall()
 
 
 def get_all_profits():
     conn = _connect()
+    cur = conn.execute("SELECT * FROM profits")
+    return cur.fetchall()
+
+
+def iter_profits(start_iso: str | None = None, end_iso: str | None = None,
+                 status: str | None = None, user_id: int | None = None, batch_size: int = 500):
+    """Построчно отдавать заявки в порядке id, не загружая таблицу в память.
+
+    start_iso/end_iso фильтруют по created_at: дата подачи есть у заявок любого
+    статуса, а approved_at — только у подтверждённых. Остальные — по полям.
+    """
+    sql = "SELECT * FROM profits WHERE 1 = 1"
+    params = []
+    if start_iso:
+        sql += " AND created_at >= ?"
+        params.append(start_iso)
+    if end_iso:
+        sql += " AND created_at <= ?"
+        params.append(end_iso)
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    if user_id is not None:
+        sql += " AND user_id = ?"
+        params.append(user_id)
+    sql += " ORDER BY id"
+    conn = _connect()
+    cur = conn.execute(sql, params)
     try:
-        cur = conn.execute("SELECT * FROM profits")
-        return cur.fetchall()
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
     finally:
-        conn.close()
+        cur.close()
 
 
 def reset_all_to_rejected() -> int:
-    conn = _connect()
-    try:
+    with _connect() as conn:
         cur = conn.execute(
             "UPDATE profits SET status = 'rejected', approved_at = NULL, approver_id = NULL WHERE status != 'rejected'"
         )
-        conn.commit()
+        conn.execute("DELETE FROM profit_daily")
         return cur.rowcount or 0
-    finally:
-        conn.close()
 
 
 def delete_all_profits():
-    conn = _connect()
-    try:
+    with _connect() as conn:
         conn.execute("DELETE FROM profits")
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute("DELETE FROM profit_daily")
+
+
+# --- Свёртка для общей статистики (/stats) ---
+# profit_daily хранит сумму и количество подтверждённых профитов по (user_id, день).
+# Обновляется в той же транзакции, что и изменения profits, поэтому лидерборд
+# строится по O(пользователи × дни) строк, а не по всем профитам.
+
+def _rollup_add(conn: sqlite3.Connection, user_id: int, approved_at: str | None,
+                amount: float | None, sign: int) -> None:
+    if not approved_at or amount is None:
+        return
+    day = approved_at[:10]
+    conn.execute(
+        """
+        INSERT INTO profit_daily (user_id, day, total, cnt) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            total = total + excluded.total,
+            cnt = cnt + excluded.cnt
+        """,
+        (user_id, day, sign * amount, sign),
+    )
+    if sign < 0:
+        conn.execute(
+            "DELETE FROM profit_daily WHERE user_id = ? AND day = ? AND cnt <= 0",
+            (user_id, day),
+        )
+
+
+_ROLLUP_SOURCE_SQL = """
+    SELECT user_id, substr(approved_at, 1, 10) AS day, SUM(final_amount), COUNT(*)
+    FROM profits
+    WHERE status = 'approved' AND final_amount IS NOT NULL AND approved_at IS NOT NULL
+    GROUP BY user_id, day
+"""
+
+
+def _rebuild_rollup(conn: sqlite3.Connection) -> None:
+    conn.execute("DELETE FROM profit_daily")
+    conn.execute(f"INSERT INTO profit_daily (user_id, day, total, cnt) {_ROLLUP_SOURCE_SQL}")
+
+
+def rebuild_rollup() -> None:
+    """Пересобрать свёртку profit_daily из таблицы profits."""
+    with _transaction() as conn:
+        _rebuild_rollup(conn)
+
+
+def check_rollup() -> list[tuple[int, str, float | None, int | None, float | None, int | None]]:
+    """Сравнить свёртку с пересчётом по profits.
+
+    Возвращает расхождения: (user_id, day, total, cnt в свёртке, total, cnt по profits).
+    """
+    conn = _connect()
+    actual = {(r[0], r[1]): (r[2], r[3]) for r in conn.execute(_ROLLUP_SOURCE_SQL)}
+    stored = {(r[0], r[1]): (r[2], r[3]) for r in conn.execute("SELECT user_id, day, total, cnt FROM profit_daily")}
+    diffs = []
+    for key in sorted(actual.keys() | stored.keys()):
+        s_total, s_cnt = stored.get(key, (None, None))
+        a_total, a_cnt = actual.get(key, (None, None))
+        same = (
+            s_cnt == a_cnt
+            and s_total is not None and a_total is not None
+            and round(s_total, 2) == round(a_total, 2)
+        )
+        if not same:
+            diffs.append((key[0], key[1], s_total, s_cnt, a_total, a_cnt))
+    return diffs
+
+
+def get_leaderboard(start_iso: str | None):
+    """Суммы подтверждённых профитов по пользователям начиная с start_iso.
+
+    Возвращает [(user_id, username, first_name, total, cnt)]. Полные дни берутся
+    из свёртки, первый (неполный) день окна — напрямую из profits.
+    """
+    conn = _connect()
+    if start_iso:
+        start_day = start_iso[:10]
+        next_day = (datetime.fromisoformat(start_day) + timedelta(days=1)).strftime("%Y-%m-%d")
+        agg_sql = """
+            SELECT user_id, SUM(total) AS total, SUM(cnt) AS cnt FROM (
+                SELECT user_id, total, cnt FROM profit_daily WHERE day > ?
+                UNION ALL
+                SELECT user_id, final_amount, 1 FROM profits
+                WHERE status = 'approved' AND final_amount IS NOT NULL
+                  AND approved_at >= ? AND approved_at < ?
+            )
+            GROUP BY user_id
+        """
+        params = (start_day, start_iso, next_day)
+    else:
+        agg_sql = "SELECT user_id, SUM(total) AS total, SUM(cnt) AS cnt FROM profit_daily GROUP BY user_id"
+        params = ()
+    # Имя — как до свёртки: из самой ранней подтверждённой заявки пользователя в окне
+    name_filter = "AND approved_at >= ?" if start_iso else ""
+    cur = conn.execute(
+        f"""
+        SELECT agg.user_id, p.username, p.first_name, agg.total, agg.cnt
+        FROM ({agg_sql}) AS agg
+        LEFT JOIN profits AS p ON p.id = (
+            SELECT id FROM profits
+            WHERE user_id = agg.user_id AND status = 'approved' AND final_amount IS NOT NULL {name_filter}
+            ORDER BY approved_at, id LIMIT 1
+        )
+        """,
+        params + ((start_iso,) if start_iso else ()),
+    )
+    return cur.fetchall()
 
 
 # --- Учёт вступления пользователей в группу ---
 
 def get_profits_by_user(user_id: int):
     conn = _connect()
-    try:
-        cur = conn.execute("SELECT * FROM profits WHERE user_id = ?", (user_id,))
-        return cur.fetchall()
-    finally:
-        conn.close()
+    cur = conn.execute("SELECT * FROM profits WHERE user_id = ?", (user_id,))
+    return cur.fetchall()
 
 
-def reset_user_to_rejected(user_id: int) -> int:
+def get_user_profit_locations(user_id: int):
+    """[(id, approved_at)] всех заявок пользователя — для поиска файлов зеркала."""
     conn = _connect()
-    try:
+    cur = conn.execute("SELECT id, approved_at FROM profits WHERE user_id = ?", (user_id,))
+    return cur.fetchall()
+
+
+def user_has_profits(user_id: int) -> bool:
+    conn = _connect()
+    cur = conn.execute("SELECT 1 FROM profits WHERE user_id = ? LIMIT 1", (user_id,))
+    return cur.fetchone() is not None
+
+
+def _user_approved_filter(user_id: int, start_iso: str | None, end_iso: str | None):
+    sql = "FROM profits WHERE user_id = ? AND status = 'approved' AND final_amount IS NOT NULL"
+    params = [user_id]
+    if start_iso:
+        sql += " AND approved_at >= ?"
+        params.append(start_iso)
+    if end_iso:
+        sql += " AND approved_at <= ?"
+        params.append(end_iso)
+    return sql, params
+
+
+def get_user_period_total(user_id: int, start_iso: str | None, end_iso: str | None) -> tuple[float, int]:
+    """Сумма и количество подтверждённых профитов пользователя за период."""
+    where, params = _user_approved_filter(user_id, start_iso, end_iso)
+    conn = _connect()
+    row = conn.execute(f"SELECT COALESCE(SUM(final_amount), 0), COUNT(*) {where}", params).fetchone()
+    return row[0], row[1]
+
+
+def get_user_top_profits(user_id: int, start_iso: str | None, end_iso: str | None, limit: int = 5):
+    """Топ подтверждённых профитов пользователя за период: [(final_amount, approved_at)]."""
+    where, params = _user_approved_filter(user_id, start_iso, end_iso)
+    conn = _connect()
+    cur = conn.execute(
+        f"SELECT final_amount, approved_at {where} ORDER BY final_amount DESC, id LIMIT ?",
+        params + [limit],
+    )
+    return cur.fetchall()
+
+
+def reset_user_to_rejected(user_id: int) -> int:
+    with _connect() as conn:
         cur = conn.execute(
             "UPDATE profits SET status = 'rejected', approved_at = NULL, approver_id = NULL WHERE user_id = ? AND status != 'rejected'",
             (user_id,),
         )
-        conn.commit()
+        conn.execute("DELETE FROM profit_daily WHERE user_id = ?", (user_id,))
         return cur.rowcount or 0
-    finally:
-        conn.close()
 
 
 def get_user_ids_by_username(username: str):
     conn = _connect()
-    try:
-        cur = conn.execute("SELECT DISTINCT user_id FROM profits WHERE username = ?", (username,))
-        return [row[0] for row in cur.fetchall()]
-    finally:
-        conn.close()
+    cur = conn.execute("SELECT DISTINCT user_id FROM profits WHERE username = ?", (username,))
+    return [row[0] for row in cur.fetchall()]
+
+
+_USERS_UPSERT_SQL = """
+    INSERT INTO users (user_id, username, first_name, first_seen, last_seen)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_seen = excluded.last_seen
+"""
 
 
 def ensure_user_seen(user_id: int, username: str | None, first_name: str | None) -> None:
-    conn = _connect()
-    try:
+    with _connect() as conn:
         now = datetime.utcnow().isoformat()
-        cur = conn.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if cur.fetchone():
-            conn.execute(
-                "UPDATE users SET username = ?, first_name = ?, last_seen = ? WHERE user_id = ?",
-                (username, first_name, now, user_id),
-            )
-        else:
-            conn.execute(
-                "INSERT INTO users (user_id, username, first_name, first_seen, last_seen) VALUES (?, ?, ?, ?, ?)",
-                (user_id, username, first_name, now, now),
-            )
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute(_USERS_UPSERT_SQL, (user_id, username, first_name, now, now))
 
 
 # --- Учёт участников чата для команды /all ---
 
+_MEMBERS_UPSERT_SQL = """
+    INSERT INTO chat_members (chat_id, user_id, username, first_name, status, last_changed)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        status = excluded.status,
+        last_changed = excluded.last_changed
+"""
+
+
 def set_member_status(chat_id: int, user_id: int, username: str | None, first_name: str | None, status: str) -> None:
     """Создать/обновить запись участника чата с актуальным статусом."""
-    conn = _connect()
-    try:
+    with _connect() as conn:
         now = datetime.utcnow().isoformat()
-        conn.execute(
-            """
-            INSERT INTO chat_members (chat_id, user_id, username, first_name, status, last_changed)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(chat_id, user_id) DO UPDATE SET
-                username = excluded.username,
-                first_name = excluded.first_name,
-                status = excluded.status,
-                last_changed = excluded.last_changed
-            """,
-            (chat_id, user_id, username, first_name, status, now),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute(_MEMBERS_UPSERT_SQL, (chat_id, user_id, username, first_name, status, now))
 
 
 def get_active_members(chat_id: int):
     """Вернуть список активных участников (member/administrator/creator) для чата."""
+    # Ещё не записанные «касания» свежее всего, что лежит в БД. Берём их до запроса:
+    # то, что успеет записаться между двумя чтениями, запрос уже увидит
+    with _pending_lock:
+        merged = {}
+        for buffer in (_flushing_members, _pending_members):
+            merged.update((key, value) for key, value in buffer.items() if key[0] == chat_id)
+    pending = [
+        (user_id, username, first_name, status)
+        for (_, user_id), (username, first_name, status, _) in merged.items()
+    ]
     conn = _connect()
-    try:
-        cur = conn.execute(
-            """
-            SELECT user_id, username, first_name, status
-            FROM chat_members
-            WHERE chat_id = ? AND status IN ('member','administrator','creator')
-            ORDER BY last_changed DESC
-            """,
-            (chat_id,),
-        )
-        return cur.fetchall()
-    finally:
-        conn.close()
+    cur = conn.execute(
+        """
+        SELECT user_id, username, first_name, status
+        FROM chat_members
+        WHERE chat_id = ? AND status IN ('member','administrator','creator')
+        ORDER BY last_changed DESC
+        """,
+        (chat_id,),
+    )
+    rows = cur.fetchall()
+    if not pending:
+        return rows
+    pending_ids = {row[0] for row in pending}
+    active = [row for row in pending if row[3] in ("member", "administrator", "creator")]
+    return active + [row for row in rows if row[0] not in pending_ids]
 
 
 def get_user_first_seen(user_id: int) -> str | None:
+    with _pending_lock:
+        pending = _flushing_users.get(user_id) or _pending_users.get(user_id)
     conn = _connect()
-    try:
-        cur = conn.execute(
-            "SELECT first_seen FROM users WHERE user_id = ?",
-            (user_id,),
-        )
-        row = cur.fetchone()
-        return row[0] if row and row[0] else None
-    finally:
-        conn.close()
\ No newline at end of file
+    cur = conn.execute(
+        "SELECT first_seen FROM users WHERE user_id = ?",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    if row and row[0]:
+        return row[0]
+    return pending[2] if pending else None
+
+
+# --- Отложенная запись «касаний» (write-behind) ---
+# ensure_user_seen/set_member_status вызываются почти на каждый апдейт и в основном
+# лишь сдвигают last_seen/last_changed. Копим их в памяти, схлопывая повторы по
+# ключу, и сбрасываем одной транзакцией по таймеру или при переполнении буфера.
+
+_pending_users: dict[int, tuple[str | None, str | None, str, str]] = {}
+_pending_members: dict[tuple[int, int], tuple[str | None, str | None, str, str]] = {}
+_pending_lock = threading.Lock()
+# Пачка, которую сейчас записывает flush_touches: читатели видят её до коммита
+_flushing_users: dict[int, tuple[str | None, str | None, str, str]] = {}
+_flushing_members: dict[tuple[int, int], tuple[str | None, str | None, str, str]] = {}
+# Один сброс за раз (таймер в потоке записи и atexit)
+_flush_lock = threading.Lock()
+
+
+def touch_user(user_id: int, username: str | None, first_name: str | None) -> int:
+    """Отложенный ensure_user_seen. Возвращает число ключей в буфере."""
+    now = datetime.utcnow().isoformat()
+    with _pending_lock:
+        prev = _pending_users.get(user_id)
+        first_touch = prev[2] if prev else now
+        _pending_users[user_id] = (username, first_name, first_touch, now)
+        return len(_pending_users) + len(_pending_members)
+
+
+def touch_member(chat_id: int, user_id: int, username: str | None, first_name: str | None, status: str) -> int:
+    """Отложенный set_member_status. Возвращает число ключей в буфере."""
+    now = datetime.utcnow().isoformat()
+    with _pending_lock:
+        _pending_members[(chat_id, user_id)] = (username, first_name, status, now)
+        return len(_pending_users) + len(_pending_members)
+
+
+def pending_touches() -> int:
+    with _pending_lock:
+        return len(_pending_users) + len(_pending_members)
+
+
+def flush_touches() -> int:
+    """Записать накопленные касания одной транзакцией. Возвращает число записанных строк."""
+    global _pending_users, _pending_members, _flushing_users, _flushing_members
+    with _flush_lock:
+        with _pending_lock:
+            users, members = _pending_users, _pending_members
+            _flushing_users, _flushing_members = users, members
+            _pending_users, _pending_members = {}, {}
+        if not users and not members:
+            return 0
+        try:
+            with _connect() as conn:
+                conn.executemany(
+                    _USERS_UPSERT_SQL,
+                    [(uid, uname, fname, first, last) for uid, (uname, fname, first, last) in users.items()],
+                )
+                conn.executemany(
+                    _MEMBERS_UPSERT_SQL,
+                    [(cid, uid, uname, fname, status, ts) for (cid, uid), (uname, fname, status, ts) in members.items()],
+                )
+        except Exception:
+            # Возвращаем несохранённое в буфер, не затирая более свежие касания
+            with _pending_lock:
+                for key, value in users.items():
+                    if key in _pending_users:
+                        uname, fname, _, last = _pending_users[key]
+                        _pending_users[key] = (uname, fname, value[2], last)
+                    else:
+                        _pending_users[key] = value
+                for key, value in members.items():
+                    _pending_members.setdefault(key, value)
+                _flushing_users, _flushing_members = {}, {}
+            raise
+        with _pending_lock:
+            _flushing_users, _flushing_members = {}, {}
+        return len(users) + len(members)
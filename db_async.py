@@ -0,0 +1,150 @@
+"""Асинхронные обёртки над db.py.
+
+Все обращения к SQLite выполняются в отдельных потоках, чтобы обработчики
+бота не блокировали цикл событий на open/execute/commit. Запись идёт через
+один поток (SQLite всё равно сериализует писателей), чтение — через
+небольшой пул: в режиме WAL читатели не ждут писателя.
+"""
+import asyncio
+import atexit
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_READ_THREADS = int(os.getenv("DB_READ_THREADS", "2"))
+# Отложенная запись касаний: период сброса (сек) и порог размера буфера
+TOUCH_FLUSH_INTERVAL = float(os.getenv("DB_TOUCH_FLUSH_INTERVAL", "5"))
+TOUCH_FLUSH_THRESHOLD = int(os.getenv("DB_TOUCH_FLUSH_THRESHOLD", "500"))
+
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+
+
+def _timed(func, args, kwargs):
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.db_duration.observe(time.perf_counter() - started, getattr(func, "__name__", "call"))
+
+
+async def run(func, *args, **kwargs):
+    """Выполнить синхронную функцию в потоке записи и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_write_executor, _timed, func, args, kwargs)
+
+
+async def run_read(func, *args, **kwargs):
+    """Выполнить синхронную функцию только для чтения в пуле читателей."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_executor, _timed, func, args, kwargs)
+
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+def _async_read(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_read(func, *args, **kwargs)
+    return wrapper
+
+
+_flusher_task: asyncio.Task | None = None
+_flush_in_progress: asyncio.Future | None = None
+
+
+def _flush_now() -> None:
+    """Запустить сброс буфера касаний, если он ещё не идёт."""
+    global _flush_in_progress
+    if _flush_in_progress is not None and not _flush_in_progress.done():
+        return
+    _flush_in_progress = asyncio.ensure_future(run(db.flush_touches))
+    _flush_in_progress.add_done_callback(_log_flush_error)
+
+
+def _log_flush_error(fut: asyncio.Future) -> None:
+    if not fut.cancelled() and fut.exception():
+        logger.warning(f"Не удалось сбросить буфер касаний: {fut.exception()}")
+
+
+async def _flusher_loop() -> None:
+    while True:
+        await asyncio.sleep(TOUCH_FLUSH_INTERVAL)
+        if db.pending_touches():
+            _flush_now()
+
+
+def pending_touches() -> int:
+    """Размер буфера касаний (для метрик)."""
+    return db.pending_touches()
+
+
+def start_flusher() -> None:
+    """Запустить периодический сброс буфера касаний (вызывать из работающего цикла)."""
+    global _flusher_task
+    if _flusher_task is None or _flusher_task.done():
+        _flusher_task = asyncio.get_running_loop().create_task(_flusher_loop())
+
+
+async def ensure_user_seen(user_id: int, username: str | None, first_name: str | None) -> None:
+    """Отметить активность пользователя (запись в БД — отложенная)."""
+    if db.touch_user(user_id, username, first_name) >= TOUCH_FLUSH_THRESHOLD:
+        _flush_now()
+
+
+async def set_member_status(chat_id: int, user_id: int, username: str | None, first_name: str | None, status: str) -> None:
+    """Обновить статус участника чата (запись в БД — отложенная)."""
+    if db.touch_member(chat_id, user_id, username, first_name, status) >= TOUCH_FLUSH_THRESHOLD:
+        _flush_now()
+
+
+async def shutdown() -> None:
+    """Сбросить буфер касаний, дождаться поставленных запросов и закрыть соединения."""
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+    await run(db.flush_touches)
+    _read_executor.shutdown(wait=True)
+    _write_executor.shutdown(wait=True)
+    db.close_connections()
+
+
+# Страховка на случай выхода мимо shutdown(): не теряем накопленные касания
+atexit.register(db.flush_touches)
+
+
+init_db = _async(db.init_db)
+create_profit_request = _async(db.create_profit_request)
+get_profit = _async_read(db.get_profit)
+update_final_amount = _async(db.update_final_amount)
+set_editing_request = _async(db.set_editing_request)
+get_editing_request = _async_read(db.get_editing_request)
+clear_editing_request = _async(db.clear_editing_request)
+set_status = _async(db.set_status)
+get_approved_profits_between = _async_read(db.get_approved_profits_between)
+get_all_profits = _async_read(db.get_all_profits)
+reset_all_to_rejected = _async(db.reset_all_to_rejected)
+delete_all_profits = _async(db.delete_all_profits)
+get_profits_by_user = _async_read(db.get_profits_by_user)
+user_has_profits = _async_read(db.user_has_profits)
+get_user_profit_locations = _async_read(db.get_user_profit_locations)
+get_user_period_total = _async_read(db.get_user_period_total)
+get_user_top_profits = _async_read(db.get_user_top_profits)
+reset_user_to_rejected = _async(db.reset_user_to_rejected)
+get_user_ids_by_username = _async_read(db.get_user_ids_by_username)
+get_active_members = _async_read(db.get_active_members)
+get_user_first_seen = _async_read(db.get_user_first_seen)
+get_leaderboard = _async_read(db.get_leaderboard)
+check_rollup = _async_read(db.check_rollup)
+rebuild_rollup = _async(db.rebuild_rollup)
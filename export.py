@@ -0,0 +1,83 @@
+"""Потоковая выгрузка заявок в CSV/JSONL (при желании — со сжатием gzip).
+
+Строки читаются курсором (db.iter_profits) и пишутся в файл порциями по
+EXPORT_CHUNK_ROWS, так что расход памяти не зависит от размера таблицы.
+Функции синхронные — из бота их нужно вызывать в потоке БД.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+
+import db
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "500"))
+
+COLUMNS = [
+    "id",
+    "user_id",
+    "username",
+    "first_name",
+    "original_amount",
+    "final_amount",
+    "note",
+    "status",
+    "created_at",
+    "approved_at",
+    "approver_id",
+]
+
+FORMATS = ("csv", "jsonl")
+
+
+def _chunks(rows, fmt: str):
+    """Разбить поток строк на готовые к записи текстовые порции."""
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    if writer:
+        writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False, separators=(",", ":")))
+            buf.write("\n")
+        count += 1
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    tail = buf.getvalue()
+    if tail:
+        yield tail
+
+
+def export_filename(fmt: str, compress: bool) -> str:
+    return f"profits.{fmt}" + (".gz" if compress else "")
+
+
+def write_export(path: str, fmt: str = "csv", compress: bool = False,
+                 start_iso: str | None = None, end_iso: str | None = None,
+                 status: str | None = None, user_id: int | None = None) -> int:
+    """Выгрузить заявки с фильтрами в файл path. Возвращает число строк."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    rows = db.iter_profits(start_iso=start_iso, end_iso=end_iso, status=status, user_id=user_id)
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    if compress:
+        f = gzip.open(path, "wt", encoding="utf-8", newline="")
+    else:
+        f = open(path, "w", encoding="utf-8", newline="")
+    with f:
+        for chunk in _chunks(counted(), fmt):
+            f.write(chunk)
+    return count
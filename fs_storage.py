@@ -1,5 +1,7 @@
 import os
 import json
+import atexit
+import threading
 from typing import Any, Dict, Tuple
 
 BASE_DIR = os.path.dirname(__file__)
@@ -7,8 +9,45 @@ STORAGE_DIR = os.path.join(BASE_DIR, "storage")
 PENDING_DIR = os.path.join(STORAGE_DIR, "pending")
 APPROVED_DIR = os.path.join(STORAGE_DIR, "approved")
 REJECTED_DIR = os.path.join(STORAGE_DIR, "rejected")
+LOG_DIR = os.path.join(STORAGE_DIR, "log")
 import shutil
 
+# files — файл на каждую заявку (по умолчанию), log — журнал сегментов (log_storage.py)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "files").strip().lower()
+
+_segment_log = None
+_segment_log_lock = threading.Lock()
+
+
+def _log():
+    """Журнал сегментов (создаётся при первом обращении)."""
+    global _segment_log
+    if _segment_log is None:
+        with _segment_log_lock:
+            if _segment_log is None:
+                from log_storage import SegmentLog
+                _segment_log = SegmentLog(LOG_DIR)
+                atexit.register(_segment_log.close)
+    return _segment_log
+
+
+def _use_log() -> bool:
+    return STORAGE_BACKEND == "log"
+
+
+def compact_storage() -> tuple[int, int]:
+    """Сжать журнал сегментов (только для STORAGE_BACKEND=log). Возвращает (байт до, байт после)."""
+    if not _use_log():
+        return 0, 0
+    return _log().compact()
+
+
+def get_stored_profit(profit_id: int) -> Dict[str, Any] | None:
+    """Прочитать сохранённую копию заявки по id из журнала (только для STORAGE_BACKEND=log)."""
+    if not _use_log():
+        return None
+    return _log().get(profit_id)
+
 
 def ensure_dirs() -> None:
     os.makedirs(PENDING_DIR, exist_ok=True)
@@ -50,9 +89,29 @@ def _row_to_dict(row: Tuple[Any, ...]) -> Dict[str, Any]:
     }
 
 
+def render_profit(row: Tuple[Any, ...]) -> bytes:
+    """Содержимое файла заявки ровно в том виде, в каком его пишут save_*_profit."""
+    return json.dumps(_row_to_dict(row), ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def profit_file_path(row: Tuple[Any, ...]) -> str | None:
+    """Где должен лежать файл заявки с учётом её статуса (без создания каталогов)."""
+    status = row[7]
+    if status == "pending":
+        return _file_path(PENDING_DIR, row[0])
+    if status == "approved":
+        approved_dir = _approved_month_dir(row[9]) if row[9] else APPROVED_DIR
+        return _file_path(approved_dir, row[0])
+    if status == "rejected":
+        return _file_path(REJECTED_DIR, row[0])
+    return None
+
+
 def save_pending_profit(row: Tuple[Any, ...]) -> str:
-    ensure_dirs()
     data = _row_to_dict(row)
+    if _use_log():
+        return _log().append(data["id"], "pending", data)
+    ensure_dirs()
     path = _file_path(PENDING_DIR, data["id"])
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
@@ -60,8 +119,10 @@ def save_pending_profit(row: Tuple[Any, ...]) -> str:
 
 
 def save_approved_profit(row: Tuple[Any, ...]) -> str:
-    ensure_dirs()
     data = _row_to_dict(row)
+    if _use_log():
+        return _log().append(data["id"], "approved", data)
+    ensure_dirs()
     # удалить из pending, если был
     pending_path = _file_path(PENDING_DIR, data["id"])
     if os.path.exists(pending_path):
@@ -78,8 +139,10 @@ def save_approved_profit(row: Tuple[Any, ...]) -> str:
 
 
 def save_rejected_profit(row: Tuple[Any, ...]) -> str:
-    ensure_dirs()
     data = _row_to_dict(row)
+    if _use_log():
+        return _log().append(data["id"], "rejected", data)
+    ensure_dirs()
     # удалить из pending, если был
     pending_path = _file_path(PENDING_DIR, data["id"])
     if os.path.exists(pending_path):
@@ -96,6 +159,10 @@ def save_rejected_profit(row: Tuple[Any, ...]) -> str:
 
 def purge_storage() -> None:
     """Полностью очистить хранилище файлов (pending/approved/rejected)."""
+    if _use_log():
+        # Журнал пересоздаёт свой каталог внутри STORAGE_DIR — его не трогаем
+        _log().purge()
+        return
     try:
         shutil.rmtree(STORAGE_DIR, ignore_errors=True)
     except Exception:
@@ -105,6 +172,9 @@ def purge_storage() -> None:
 
 def purge_approved_and_pending() -> None:
     """Очистить approved (включая подкаталоги месяцев) и pending."""
+    if _use_log():
+        _log().remove_with_status(("approved", "pending"))
+        return
     for path in (APPROVED_DIR, PENDING_DIR):
         try:
             shutil.rmtree(path, ignore_errors=True)
@@ -113,27 +183,73 @@ def purge_approved_and_pending() -> None:
     ensure_dirs()
 
 
-def remove_files_for_profit_id(profit_id: int) -> None:
-    """Удалить файлы заявки из pending и approved по её id."""
+def _approved_month_dir(approved_at_iso: str) -> str:
+    return os.path.join(APPROVED_DIR, f"{approved_at_iso[0:4]}-{approved_at_iso[5:7]}")
+
+
+def remove_files_for_profit_id(profit_id: int, approved_at: str | None = None) -> None:
+    """Удалить файлы заявки из pending и approved по её id.
+
+    Если известна дата подтверждения, файл ищется только в её месячном каталоге.
+    """
+    remove_files_for_profit_ids([(profit_id, approved_at)])
+
+
+def remove_files_for_profit_ids(profits) -> int:
+    """Удалить файлы нескольких заявок из pending и approved за один проход.
+
+    profits — id или пары (id, approved_at). Для пар с датой путь вычисляется
+    сразу; для остальных каждый месячный каталог просматривается один раз.
+    Возвращает число удалённых файлов.
+    """
+    items = [p if isinstance(p, tuple) else (p, None) for p in profits]
+    if _use_log():
+        log = _log()
+        removed = 0
+        for profit_id, _ in items:
+            if log.status_of(profit_id) in ("approved", "pending"):
+                log.remove(profit_id)
+                removed += 1
+        return removed
+
     ensure_dirs()
-    # Удаляем из pending
-    try:
-        pending_path = _file_path(PENDING_DIR, profit_id)
-        if os.path.exists(pending_path):
-            os.remove(pending_path)
-    except Exception:
-        pass
-    # Удаляем из approved во всех месячных подкаталогах
-    try:
-        if os.path.exists(APPROVED_DIR):
-            for name in os.listdir(APPROVED_DIR):
-                subdir = os.path.join(APPROVED_DIR, name)
-                if os.path.isdir(subdir):
-                    approved_path = _file_path(subdir, profit_id)
-                    if os.path.exists(approved_path):
-                        try:
-                            os.remove(approved_path)
-                        except Exception:
-                            pass
-    except Exception:
-        pass
\ No newline at end of file
+    # Каталог -> имена файлов, которые нужно удалить
+    known: Dict[str, set] = {PENDING_DIR: set()}
+    unknown: set = set()
+    for profit_id, approved_at in items:
+        name = os.path.basename(_file_path("", profit_id))
+        known[PENDING_DIR].add(name)
+        if approved_at:
+            known.setdefault(_approved_month_dir(approved_at), set()).add(name)
+        else:
+            unknown.add(name)
+
+    removed = 0
+    for dir_path, names in known.items():
+        for name in names:
+            try:
+                os.remove(os.path.join(dir_path, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except Exception:
+                pass
+
+    # Месяц неизвестен — одно чтение каждого месячного каталога вместо проверки по каждому id
+    if unknown:
+        try:
+            subdirs = [e.path for e in os.scandir(APPROVED_DIR) if e.is_dir()]
+        except Exception:
+            subdirs = []
+        for subdir in subdirs:
+            try:
+                present = set(os.listdir(subdir))
+            except Exception:
+                continue
+            for name in unknown & present:
+                try:
+                    os.remove(os.path.join(subdir, name))
+                    removed += 1
+                except Exception:
+                    pass
+    return removed
@@ -0,0 +1,296 @@
+"""Журнальное хранилище профитов: альтернатива файлу на каждую заявку.
+
+Каждый переход статуса дописывается компактной JSON-строкой в сегмент текущего
+месяца (``YYYY-MM.log``). fsync выполняется пачками: раз в FSYNC_EVERY записей
+или FSYNC_INTERVAL секунд (если записей больше нет, хвост досинхронизирует
+таймер). Индекс ``id -> (сегмент, смещение, длина)`` держится
+в памяти и сохраняется в ``index.json``; при открытии хвосты сегментов, не
+попавшие в сохранённый индекс, дочитываются. compact() переписывает сегменты,
+оставляя только актуальную запись по каждому id.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict
+
+FSYNC_EVERY = int(os.getenv("STORAGE_LOG_FSYNC_EVERY", "64"))
+FSYNC_INTERVAL = float(os.getenv("STORAGE_LOG_FSYNC_INTERVAL", "1.0"))
+
+INDEX_FILE = "index.json"
+SEGMENT_SUFFIX = ".log"
+REMOVED = "removed"
+
+
+class SegmentLog:
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.RLock()
+        self._index: Dict[int, tuple[str, int, int]] = {}
+        self._statuses: Dict[int, str] = {}
+        self._sizes: Dict[str, int] = {}
+        self._file = None
+        self._file_segment = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._sync_timer: threading.Timer | None = None
+        self._open()
+
+    # --- служебное ---
+
+    def _segment_path(self, segment: str) -> str:
+        return os.path.join(self.root, segment)
+
+    def _segments(self) -> list[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(n for n in os.listdir(self.root) if n.endswith(SEGMENT_SUFFIX))
+
+    def _open(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        self._index.clear()
+        self._statuses.clear()
+        self._sizes.clear()
+        try:
+            with open(os.path.join(self.root, INDEX_FILE), "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            for key, (segment, offset, length, status) in saved["index"].items():
+                self._index[int(key)] = (segment, offset, length)
+                self._statuses[int(key)] = status
+            self._sizes = {k: v for k, v in saved["sizes"].items()}
+        except Exception:
+            self._index.clear()
+            self._statuses.clear()
+            self._sizes = {}
+        # Дочитываем всё, что было дописано после сохранения индекса
+        for segment in self._segments():
+            self._scan(segment, self._sizes.get(segment, 0))
+
+    def _scan(self, segment: str, start: int) -> None:
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        if start > size:
+            start = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Недописанная строка (падение посреди записи) — отбрасываем
+                    break
+                try:
+                    rec = json.loads(line)
+                    self._apply(int(rec["id"]), rec["status"], segment, offset, len(line))
+                except Exception:
+                    pass
+                offset += len(line)
+        self._sizes[segment] = offset
+        if offset < size:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def _apply(self, profit_id: int, status: str, segment: str, offset: int, length: int) -> None:
+        if status == REMOVED:
+            self._index.pop(profit_id, None)
+            self._statuses.pop(profit_id, None)
+        else:
+            self._index[profit_id] = (segment, offset, length)
+            self._statuses[profit_id] = status
+
+    def _writer(self, segment: str):
+        if self._file_segment != segment:
+            self._close_file()
+            # Каталог мог быть удалён вместе с хранилищем (очистка, purge)
+            os.makedirs(self.root, exist_ok=True)
+            self._file = open(self._segment_path(segment), "ab")
+            self._file_segment = segment
+        return self._file
+
+    def _close_file(self) -> None:
+        self._cancel_sync_timer()
+        if self._file is not None:
+            self._sync(force=True)
+            self._file.close()
+            self._file = None
+            self._file_segment = None
+
+    def _sync(self, force: bool = False) -> None:
+        if self._file is None or not self._unsynced:
+            return
+        now = time.monotonic()
+        if force or self._unsynced >= FSYNC_EVERY or now - self._last_sync >= FSYNC_INTERVAL:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._last_sync = now
+        elif self._sync_timer is None:
+            # Пачка не набралась: без таймера хвост ждал бы следующей записи или close()
+            delay = max(0.0, self._last_sync + FSYNC_INTERVAL - now)
+            self._sync_timer = threading.Timer(delay, self._sync_later)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
+    def _sync_later(self) -> None:
+        with self._lock:
+            self._sync_timer = None
+            self._sync()
+
+    def _cancel_sync_timer(self) -> None:
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+
+    def _save_index(self) -> None:
+        data = {
+            "sizes": self._sizes,
+            "index": {
+                str(k): [seg, off, ln, self._statuses[k]] for k, (seg, off, ln) in self._index.items()
+            },
+        }
+        tmp = os.path.join(self.root, INDEX_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, os.path.join(self.root, INDEX_FILE))
+
+    # --- публичный API ---
+
+    def append(self, profit_id: int, status: str, data: Dict[str, Any] | None) -> str:
+        """Дописать переход статуса. Возвращает адрес записи ``сегмент:смещение``."""
+        rec = {"id": profit_id, "status": status, "ts": datetime.utcnow().isoformat(), "row": data}
+        line = (json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        segment = datetime.utcnow().strftime("%Y-%m") + SEGMENT_SUFFIX
+        with self._lock:
+            f = self._writer(segment)
+            offset = self._sizes.get(segment, 0)
+            f.write(line)
+            f.flush()
+            self._sizes[segment] = offset + len(line)
+            self._apply(profit_id, status, segment, offset, len(line))
+            self._unsynced += 1
+            self._sync()
+        return f"{segment}:{offset}"
+
+    def remove(self, profit_id: int) -> None:
+        if profit_id in self._index:
+            self.append(profit_id, REMOVED, None)
+
+    def remove_with_status(self, statuses: tuple[str, ...]) -> int:
+        """Пометить удалёнными все записи, чей текущий статус входит в statuses."""
+        with self._lock:
+            ids = [pid for pid, st in self._statuses.items() if st in statuses]
+            for pid in ids:
+                self.append(pid, REMOVED, None)
+        return len(ids)
+
+    def get(self, profit_id: int) -> Dict[str, Any] | None:
+        """Актуальная запись по id (или None, если её нет/удалена)."""
+        with self._lock:
+            loc = self._index.get(profit_id)
+            if loc is None:
+                return None
+            if self._file is not None:
+                self._file.flush()
+            segment, offset, length = loc
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                rec = json.loads(f.read(length))
+        row = rec.get("row") or {}
+        row["status"] = rec["status"]
+        return row
+
+    def status_of(self, profit_id: int) -> str | None:
+        with self._lock:
+            return self._statuses.get(profit_id)
+
+    def ids(self) -> list[int]:
+        """id всех заявок в журнале (без удалённых)."""
+        with self._lock:
+            return list(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def flush(self) -> None:
+        """Принудительный fsync и сохранение индекса."""
+        with self._lock:
+            self._sync(force=True)
+            self._save_index()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_file()
+            if os.path.isdir(self.root):
+                self._save_index()
+
+    def purge(self) -> None:
+        """Удалить журнал целиком."""
+        with self._lock:
+            self._close_file()
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._open()
+
+    def compact(self) -> tuple[int, int]:
+        """Переписать сегменты, оставив по одной актуальной записи на id.
+
+        Возвращает (байт до, байт после).
+        """
+        with self._lock:
+            self._close_file()
+            before = sum(self._sizes.values())
+            by_segment: Dict[str, list[tuple[int, int, int]]] = {}
+            for pid, (segment, offset, length) in self._index.items():
+                by_segment.setdefault(segment, []).append((offset, length, pid))
+            new_sizes: Dict[str, int] = {}
+            new_index: Dict[int, tuple[str, int, int]] = {}
+            for segment in self._segments():
+                live = sorted(by_segment.get(segment, []))
+                path = self._segment_path(segment)
+                if not live:
+                    os.remove(path)
+                    continue
+                tmp = path + ".compact"
+                pos = 0
+                with open(path, "rb") as src, open(tmp, "wb") as dst:
+                    for offset, length, pid in live:
+                        src.seek(offset)
+                        dst.write(src.read(length))
+                        new_index[pid] = (segment, pos, length)
+                        pos += length
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.replace(tmp, path)
+                new_sizes[segment] = pos
+            self._index = new_index
+            self._sizes = new_sizes
+            self._save_index()
+            return before, sum(new_sizes.values())
+
+
+if __name__ == "__main__":
+    import sys
+
+    from dotenv import load_dotenv
+    from filelock import FileLock, Timeout
+
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        print("Использование: python log_storage.py compact")
+        sys.exit(1)
+    # STORAGE_BACKEND и пути читаются при импорте fs_storage — сначала .env, как в bot.py
+    load_dotenv()
+    import fs_storage
+
+    if not fs_storage._use_log():
+        print(f"Журнал не используется (STORAGE_BACKEND={fs_storage.STORAGE_BACKEND}), сжимать нечего")
+        sys.exit(1)
+    # Работающий бот держит свой индекс в памяти и при выходе перезапишет index.json:
+    # сжатие под ним испортит хранилище. bot.lock держит бот всё время работы
+    lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.lock")
+    try:
+        with FileLock(lock_path, timeout=0):
+            before, after = fs_storage.compact_storage()
+    except Timeout:
+        print("Бот запущен (bot.lock занят). Остановите бота и повторите сжатие.")
+        sys.exit(1)
+    print(f"Сжатие журнала: {before} -> {after} байт")
@@ -0,0 +1,241 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Если задан METRICS_PORT, на METRICS_LISTEN:METRICS_PORT (по умолчанию
+127.0.0.1) поднимается HTTP-сервер, отдающий /metrics:
+
+* bot_handler_duration_seconds{handler,variant} — время обработчиков
+  (декоратор timed, для handle_callback variant — префикс callback_data);
+* bot_update_duration_seconds — полное время обработки апдейта;
+* bot_db_duration_seconds{func} — время функций db.py в потоках БД
+  (_count — число вызовов);
+* bot_api_request_duration_seconds{method}, bot_api_responses_total{method,code},
+  bot_api_errors_total{method} — вызовы Bot API (через MetricsRequest);
+* bot_*_depth и другие gauges — глубина очередей (апдейты, отправка,
+  файловое зеркало, буфер касаний БД, апдейты в обработке).
+
+Сбор метрик работает и без сервера (дёшево: словарь и несколько сложений
+под блокировкой), поэтому декораторы не зависят от настройки.
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Границы корзин гистограмм (секунды)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_text(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    parts = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # значения меток -> [счётчики по корзинам..., +Inf, сумма]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: list(value) for key, value in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _labels_text(self.labels + ("le",), label_values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_values, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_labels_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значение снимается функцией в момент запроса /metrics."""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self) -> list[str]:
+        try:
+            value = float(self.func())
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+handler_duration = Histogram(
+    "bot_handler_duration_seconds", "Время выполнения обработчиков", ("handler", "variant")
+)
+update_duration = Histogram("bot_update_duration_seconds", "Полное время обработки апдейта")
+db_duration = Histogram("bot_db_duration_seconds", "Время функций db.py в потоках БД", ("func",))
+api_duration = Histogram("bot_api_request_duration_seconds", "Время запросов к Bot API", ("method",))
+api_responses = Counter("bot_api_responses_total", "Ответы Bot API по HTTP-коду", ("method", "code"))
+api_errors = Counter("bot_api_errors_total", "Сетевые ошибки запросов к Bot API", ("method",))
+
+_registry: list = [handler_duration, update_duration, db_duration, api_duration, api_responses, api_errors]
+_gauges: dict[str, Gauge] = {}
+
+
+def register_gauge(name: str, help_text: str, func: Callable[[], float]) -> None:
+    _gauges[name] = Gauge(name, help_text, func)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for gauge in _gauges.values():
+        lines.extend(gauge.render())
+    return "\n".join(lines) + "\n"
+
+
+def timed(handler: str, variant: Callable | None = None):
+    """Декоратор для async-обработчиков: время в bot_handler_duration_seconds.
+
+    variant(*args) возвращает дополнительную метку (например, префикс callback_data).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                label = ""
+                if variant is not None:
+                    try:
+                        label = variant(*args) or ""
+                    except Exception:
+                        pass
+                handler_duration.observe(time.perf_counter() - started, handler, label)
+        return wrapper
+    return decorator
+
+
+def callback_prefix(update, context=None) -> str:
+    """Префикс callback_data до первого ':' (approve, reject, stats, my...)."""
+    query = getattr(update, "callback_query", None)
+    data = query.data if query is not None and isinstance(query.data, str) else ""
+    return data.split(":", 1)[0]
+
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest, который считает время и коды ответов Bot API по методам."""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        except Exception:
+            api_errors.inc(api_method)
+            raise
+        api_duration.observe(time.perf_counter() - started, api_method)
+        api_responses.inc(api_method, str(code))
+        return code, payload
+
+
+# --- HTTP-сервер /metrics ---
+
+_server: asyncio.AbstractServer | None = None
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+            body = render().encode("utf-8")
+            status = "200 OK"
+        else:
+            body, status = b"", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start(port: int | None = None, listen: str = METRICS_LISTEN) -> None:
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return
+    _server = await asyncio.start_server(_handle, listen, port)
+    logger.info(f"Метрики: http://{listen}:{port}/metrics")
+
+
+async def stop() -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,241 @@
+"""Пересборка и сверка файлового зеркала профитов по базе данных.
+
+Заявки читаются из SQLite курсором в порядке id (без загрузки таблицы в
+память) и раздаются пулу потоков-писателей. Шардирование — по каталогу
+назначения (pending, rejected, approved/YYYY-MM), поэтому в один каталог
+пишет ровно один поток. Очереди потоков ограничены, так что расход памяти
+не зависит от размера таблицы.
+
+В режиме сверки (verify) файлы не переписываются: существующий файл
+сравнивается с ожидаемым по sha256, расхождения только подсчитываются.
+
+После прохода по заявкам каталоги зеркала просматриваются ещё раз: файл
+profit_N.json, который не совпадает с profit_file_path ни одной заявки
+(заявку удалили или сменили её статус мимо зеркала), считается лишним и
+удаляется. Заявки для проверки читаются из БД пачками по каталогу.
+
+Запуск из консоли: ``python mirror_rebuild.py [--verify] [--workers N]``.
+"""
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+
+import db
+import fs_storage
+
+REBUILD_WORKERS = int(os.getenv("MIRROR_REBUILD_WORKERS", "4"))
+_QUEUE_SIZE = 1000
+_STOP = object()
+_PROFIT_FILE_RE = re.compile(r"^profit_(\d+)\.json$")
+
+
+@dataclass
+class RebuildReport:
+    verify_only: bool = False
+    rows: int = 0
+    ok: int = 0
+    written: int = 0
+    mismatched: int = 0
+    stale_removed: int = 0
+    orphans: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __getstate__(self) -> dict:
+        # Отчёт пересылается между процессами (BOT_WORKERS > 1), блокировку не передаём
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def files_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> str:
+        action = "Сверка" if self.verify_only else "Пересборка"
+        lines = [
+            f"{action} файлового зеркала: {self.rows} заявок за {self.seconds:.1f} с "
+            f"({self.files_per_second:.0f} файлов/с)",
+            f"• совпадает: {self.ok}",
+        ]
+        if self.verify_only:
+            lines.append(f"• отсутствует или отличается: {self.mismatched}")
+            lines.append(f"• лишних файлов (заявки нет или статус другой): {self.orphans}")
+        else:
+            lines.append(f"• записано: {self.written}")
+            lines.append(f"• удалено устаревших копий: {self.stale_removed}")
+            lines.append(f"• удалено лишних файлов: {self.orphans}")
+        if self.errors:
+            lines.append(f"• ошибок: {self.errors}")
+        return "\n".join(lines)
+
+
+def _sha256_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).digest()
+    except FileNotFoundError:
+        return None
+
+
+def _stale_paths(row, target: str | None) -> list[str]:
+    # Копии заявки в каталогах других статусов (например, pending после подтверждения)
+    candidates = [
+        fs_storage._file_path(fs_storage.PENDING_DIR, row[0]),
+        fs_storage._file_path(fs_storage.REJECTED_DIR, row[0]),
+    ]
+    return [p for p in candidates if p != target]
+
+
+def _process(row, verify_only: bool, report: RebuildReport) -> None:
+    target = fs_storage.profit_file_path(row)
+    if target is None:
+        return
+    expected = fs_storage.render_profit(row)
+    stale = [p for p in _stale_paths(row, target) if os.path.exists(p)]
+    if _sha256_file(target) == hashlib.sha256(expected).digest() and not stale:
+        report.add(ok=1)
+        return
+    if verify_only:
+        report.add(mismatched=1)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(expected)
+    os.replace(tmp, target)
+    for path in stale:
+        try:
+            os.remove(path)
+            report.add(stale_removed=1)
+        except FileNotFoundError:
+            pass
+    report.add(written=1)
+
+
+def _worker(q: "queue.Queue", verify_only: bool, report: RebuildReport) -> None:
+    while True:
+        row = q.get()
+        if row is _STOP:
+            return
+        try:
+            _process(row, verify_only, report)
+        except Exception:
+            report.add(errors=1)
+
+
+def _mirror_dirs() -> list[str]:
+    dirs = [fs_storage.PENDING_DIR, fs_storage.REJECTED_DIR, fs_storage.APPROVED_DIR]
+    with os.scandir(fs_storage.APPROVED_DIR) as it:
+        dirs += sorted(entry.path for entry in it if entry.is_dir())
+    return dirs
+
+
+def _sweep_orphans(verify_only: bool, report: RebuildReport) -> None:
+    """Удалить (или подсчитать) файлы, которые не принадлежат ни одной заявке."""
+    for dir_path in _mirror_dirs():
+        files: dict[int, str] = {}
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                m = _PROFIT_FILE_RE.match(entry.name)
+                if m and entry.is_file():
+                    files[int(m.group(1))] = entry.path
+        rows = db.get_profits_by_ids(files)
+        for profit_id, path in files.items():
+            row = rows.get(profit_id)
+            if row is not None:
+                target = fs_storage.profit_file_path(row)
+                # Копии в pending/rejected у существующей заявки учитывает _process
+                if path == target or path in _stale_paths(row, target):
+                    continue
+            if verify_only:
+                report.add(orphans=1)
+                continue
+            try:
+                os.remove(path)
+                report.add(orphans=1)
+            except FileNotFoundError:
+                pass
+
+
+def _rebuild_log(verify_only: bool, report: RebuildReport) -> None:
+    # Журнал пишется одним потоком, поэтому для него шардирования нет
+    log = fs_storage._log()
+    orphans = set(log.ids())
+    for row in db.iter_profits():
+        orphans.discard(row[0])
+        report.add(rows=1)
+        expected = fs_storage._row_to_dict(row)
+        if log.get(row[0]) == expected:
+            report.add(ok=1)
+        elif verify_only:
+            report.add(mismatched=1)
+        else:
+            log.append(row[0], row[7], expected)
+            report.add(written=1)
+    # Записи заявок, которых в БД уже нет
+    report.add(orphans=len(orphans))
+    if not verify_only:
+        for profit_id in orphans:
+            log.remove(profit_id)
+        log.flush()
+
+
+def rebuild_mirror(verify_only: bool = False, workers: int = REBUILD_WORKERS) -> RebuildReport:
+    """Пересобрать (или только сверить) файловое зеркало по таблице profits."""
+    report = RebuildReport(verify_only=verify_only)
+    started = time.perf_counter()
+    if fs_storage._use_log():
+        _rebuild_log(verify_only, report)
+        report.seconds = time.perf_counter() - started
+        return report
+
+    fs_storage.ensure_dirs()
+    workers = max(1, workers)
+    queues = [queue.Queue(maxsize=_QUEUE_SIZE) for _ in range(workers)]
+    threads = [
+        threading.Thread(target=_worker, args=(q, verify_only, report), name=f"mirror-rebuild-{i}", daemon=True)
+        for i, q in enumerate(queues)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for row in db.iter_profits():
+            report.add(rows=1)
+            target = fs_storage.profit_file_path(row)
+            shard_key = os.path.dirname(target) if target else ""
+            # Стабильный хэш: один каталог всегда обслуживает один поток
+            queues[zlib.crc32(shard_key.encode("utf-8")) % workers].put(row)
+    finally:
+        for q in queues:
+            q.put(_STOP)
+        for t in threads:
+            t.join()
+    _sweep_orphans(verify_only, report)
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Пересборка файлового зеркала профитов из bot.db")
+    parser.add_argument("--verify", action="store_true", help="только сверить, ничего не переписывая")
+    parser.add_argument("--workers", type=int, default=REBUILD_WORKERS)
+    args = parser.parse_args()
+    print(rebuild_mirror(verify_only=args.verify, workers=args.workers).summary())
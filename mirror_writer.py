@@ -0,0 +1,315 @@
+"""Фоновая запись файлового зеркала профитов (fs_storage).
+
+Обработчики только ставят задачу в очередь, а makedirs/remove/json.dump
+выполняет отдельный поток. Несколько переходов одной заявки, ещё не
+записанных на диск, схлопываются до последнего состояния. Групповые операции
+(очистка хранилища) выполняются строго после всего, что было поставлено
+в очередь до них.
+
+Постановка в очередь никогда не блокирует цикл событий: при переполнении
+(MIRROR_QUEUE_SIZE) запись файла заявки пропускается и считается в dropped,
+зеркало потом восстанавливает /rebuild_storage.
+
+При BOT_WORKERS > 1 воркеры сами на диск не пишут: RemoteMirror пересылает
+задачи приёмнику (sharding.py), где работает единственный MirrorWriter.
+Запись по заявке там выполняет sync_profit — она перечитывает строку из БД,
+поэтому «pending» из воркера пользователя, пришедший позже «approved» из
+воркера админа, не оставит устаревший файл.
+"""
+import itertools
+import logging
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Tuple
+
+import db
+import fs_storage
+
+logger = logging.getLogger(__name__)
+
+MIRROR_QUEUE_SIZE = int(os.getenv("MIRROR_QUEUE_SIZE", "10000"))
+
+
+class MirrorWriter:
+    def __init__(self, maxsize: int = MIRROR_QUEUE_SIZE):
+        self.maxsize = maxsize
+        # ключ -> (функция, аргументы); порядок вставки = порядок записи
+        self._items: "OrderedDict[Any, Tuple[Callable, tuple]]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+        self._barrier_seq = itertools.count()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="mirror-writer", daemon=True)
+            self._thread.start()
+
+    def _put(self, key: Any, func: Callable, args: tuple) -> None:
+        # Вызывается из цикла событий, поэтому никогда не ждёт места в очереди
+        dropped = False
+        with self._cond:
+            if key in self._items:
+                # Более новое состояние той же заявки заменяет незаписанное старое
+                del self._items[key]
+                self.coalesced += 1
+            elif key[0] == "profit" and len(self._items) >= self.maxsize and not self._stopping:
+                # Диск не успевает: файл заявки пропускаем, его восстановит /rebuild_storage.
+                # Групповые операции (очистка, перестройка) не отбрасываются никогда
+                self.dropped += 1
+                dropped = True
+            if not dropped:
+                self._items[key] = (func, args)
+                self._cond.notify_all()
+        if dropped:
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(
+                    f"Очередь файлового зеркала переполнена ({self.maxsize}), пропущено записей: {self.dropped}. "
+                    "Восстановить зеркало: /rebuild_storage"
+                )
+            return
+        if self._thread is None:
+            # Поток не запущен (скрипты, тесты) — пишем сразу
+            self._run_pending()
+
+    def submit(self, profit_id: int, func: Callable, *args) -> None:
+        """Поставить запись по заявке profit_id (схлопывается с предыдущей)."""
+        self._put(("profit", profit_id), func, args)
+
+    def call(self, func: Callable, *args) -> None:
+        """Поставить групповую операцию, выполняемую после всех ранее поставленных."""
+        self._put(("barrier", next(self._barrier_seq)), func, args)
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._items) + (1 if self._busy else 0)
+
+    def _take(self, block: bool):
+        with self._cond:
+            while not self._items:
+                if self._stopping or not block:
+                    return None
+                self._cond.wait()
+            _, item = self._items.popitem(last=False)
+            self._busy = True
+            self._cond.notify_all()
+            return item
+
+    def _done(self) -> None:
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+    def _execute(self, item) -> None:
+        func, args = item
+        try:
+            func(*args)
+        except Exception as e:
+            logger.warning(f"Не удалось записать файловое зеркало ({getattr(func, '__name__', func)}): {e}")
+        finally:
+            self._done()
+
+    def _run(self) -> None:
+        while True:
+            item = self._take(block=True)
+            if item is None:
+                return
+            self._execute(item)
+
+    def _run_pending(self) -> None:
+        while True:
+            item = self._take(block=False)
+            if item is None:
+                return
+            self._execute(item)
+
+    def drain(self, timeout: float | None = None) -> bool:
+        """Дождаться, пока очередь опустеет. Возвращает False по таймауту."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._items and not self._busy, timeout)
+
+    def stop(self, timeout: float | None = 30) -> None:
+        """Дописать очередь и остановить поток."""
+        self.drain(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class RemoteMirror:
+    """Замена writer в воркере шардирования: задачи выполняет приёмник.
+
+    outbox — общая очередь задач всех воркеров, replies — очередь ответов
+    этого воркера для call_with_result.
+    """
+
+    def __init__(self, worker: int, outbox, replies):
+        self.worker = worker
+        self.outbox = outbox
+        self.replies = replies
+        self.coalesced = 0
+        self.dropped = 0
+        self._futures: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read_replies, name="mirror-replies", daemon=True)
+            self._thread.start()
+
+    def submit(self, profit_id: int, func: Callable, *args) -> None:
+        # Состояние заявки приёмник прочитает из БД сам (sync_profit)
+        self.outbox.put(("sync", profit_id))
+
+    def call(self, func: Callable, *args) -> None:
+        self.outbox.put(("call", None, func, args))
+
+    def call_with_result(self, func: Callable, *args) -> Future:
+        future: Future = Future()
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            self._futures[request_id] = future
+        self.outbox.put(("call", (self.worker, request_id), func, args))
+        return future
+
+    def _read_replies(self) -> None:
+        while True:
+            request_id, ok, value = self.replies.get()
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            if future is None or not future.set_running_or_notify_cancel():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def depth(self) -> int:
+        return 0
+
+    def drain(self, timeout: float | None = None) -> bool:
+        return True
+
+    def stop(self, timeout: float | None = 30) -> None:
+        # Задачи уже в общей очереди: их дописывает приёмник
+        pass
+
+
+writer: MirrorWriter | RemoteMirror = MirrorWriter()
+
+
+def sync_profit(profit_id: int) -> None:
+    """Привести файл заявки к её текущему состоянию в БД."""
+    row = db.get_profit(profit_id)
+    if row is None:
+        fs_storage.remove_files_for_profit_id(profit_id)
+        return
+    save = {
+        "pending": fs_storage.save_pending_profit,
+        "approved": fs_storage.save_approved_profit,
+        "rejected": fs_storage.save_rejected_profit,
+    }.get(row[7])
+    if save is not None:
+        save(tuple(row))
+
+
+def serve_remote(outbox, replies: list) -> None:
+    """Выполнять задачи воркеров (в потоке приёмника) до None в outbox."""
+    while True:
+        task = outbox.get()
+        if task is None:
+            return
+        if task[0] == "sync":
+            writer.submit(task[1], sync_profit, task[1])
+            continue
+        _, reply_to, func, args = task
+        if reply_to is None:
+            writer.call(func, *args)
+            continue
+        worker, request_id = reply_to
+
+        def runner(func=func, args=args, worker=worker, request_id=request_id):
+            try:
+                result = (request_id, True, func(*args))
+                # Очередь сериализует в своём потоке и ошибку проглотит — проверяем здесь
+                pickle.dumps(result)
+            except Exception as e:
+                result = (request_id, False, RuntimeError(f"{type(e).__name__}: {e}"))
+            replies[worker].put(result)
+
+        runner.__name__ = getattr(func, "__name__", "call")
+        writer.call(runner)
+
+
+def save_pending(row) -> None:
+    writer.submit(row[0], fs_storage.save_pending_profit, row)
+
+
+def save_approved(row) -> None:
+    writer.submit(row[0], fs_storage.save_approved_profit, row)
+
+
+def save_rejected(row) -> None:
+    writer.submit(row[0], fs_storage.save_rejected_profit, row)
+
+
+def remove(profit_id: int, approved_at: str | None = None) -> None:
+    writer.submit(profit_id, fs_storage.remove_files_for_profit_id, profit_id, approved_at)
+
+
+def remove_many(profits) -> None:
+    """Удалить файлы нескольких заявок одним проходом (id или пары (id, approved_at))."""
+    writer.call(fs_storage.remove_files_for_profit_ids, list(profits))
+
+
+def call(func: Callable, *args) -> None:
+    writer.call(func, *args)
+
+
+def call_with_result(func: Callable, *args) -> Future:
+    """Как call(), но с Future для результата (для await — asyncio.wrap_future)."""
+    if isinstance(writer, RemoteMirror):
+        return writer.call_with_result(func, *args)
+    future: Future = Future()
+
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    runner.__name__ = getattr(func, "__name__", "call")
+    writer.call(runner)
+    return future
+
+
+def queue_depth() -> int:
+    return writer.depth()
+
+
+def dropped() -> int:
+    return writer.dropped
+
+
+def start() -> None:
+    writer.start()
+
+
+def stop(timeout: float | None = 30) -> None:
+    writer.stop(timeout)
@@ -0,0 +1,187 @@
+"""Сэмплирующий профайлер для работающего бота.
+
+Раз в PROFILE_INTERVAL_MS процессорного времени (таймер ITIMER_PROF,
+сигнал SIGPROF) снимаются стеки всех потоков: цикла событий (обработчики
+profit_receive, handle_callback, build_stats_text, build_my_text...),
+потоков БД (функции db.py), потока файлового зеркала. Обработчик сигнала
+выполняется в главном потоке между инструкциями байткода, поэтому стек
+цикла событий снимается точно; сэмплер в отдельном потоке видел бы его
+только в моменты отпускания GIL (почти всегда в select). Без setitimer
+(Windows) или вне главного потока используется такой поток-сэмплер.
+
+Ожидание без работы (select цикла событий, пустые очереди потоков) не
+учитывается. Корутина попадает в стек, только пока выполняется, поэтому
+профиль показывает, на что уходит процессорное время; время ожидания сети
+и БД смотрите в metrics.py.
+
+Результат — collapsed stacks (``поток;файл:функция;... число``), который
+понимают flamegraph.pl и speedscope. Накладные расходы — один проход по
+стекам за интервал, поэтому профиль можно включать под реальной нагрузкой.
+
+Запуск: админская команда ``/profile [секунды]`` или сигнал SIGUSR1
+(профиль на PROFILE_SIGNAL_SECONDS секунд сохраняется в profiles/ и
+отправляется админу).
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILES_DIR = os.path.join(BASE_DIR, "profiles")
+
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_SIGNAL_SECONDS = float(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))
+PROFILE_MAX_SECONDS = 300
+
+# Самые внутренние кадры, означающие простой потока
+_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("connection.py", "_recv"),
+    ("connection.py", "poll"),
+}
+
+
+class SamplingProfiler:
+    """Сбор collapsed stacks; stop() вызывается из того же потока, что и start()."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.busy_samples = 0
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self._labels: dict = {}
+        self._names: dict[int, str] = {}
+        self._names_refreshed = 0.0
+        self._active = False
+        self._use_signal = False
+        self._prev_handler = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._active
+
+    def start(self) -> None:
+        """Запустить сбор; в режиме сигнала — только из главного потока."""
+        self.started_at = time.time()
+        self._active = True
+        if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+            self._prev_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            self._use_signal = True
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self._active:
+            return
+        if self._use_signal:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._prev_handler or signal.SIG_DFL)
+        else:
+            self._stop.set()
+            self._thread.join()
+        self._active = False
+        self.stopped_at = time.time()
+
+    def _label(self, code) -> tuple[str, bool]:
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            label = self._labels[code] = (
+                f"{os.path.basename(filename)}:{code.co_name}",
+                filename.startswith(BASE_DIR),
+            )
+        return label
+
+    def _on_signal(self, signum, frame) -> None:
+        frames = sys._current_frames()
+        # Для главного потока берём прерванный кадр, а не кадр этого обработчика
+        frames[threading.main_thread().ident] = frame
+        self._sample(frames)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            frames.pop(own, None)
+            self._sample(frames)
+
+    def _sample(self, frames: dict) -> None:
+        now = time.monotonic()
+        if now - self._names_refreshed > 1:
+            self._names = {t.ident: t.name for t in threading.enumerate()}
+            self._names_refreshed = now
+        self.samples += 1
+        for ident, frame in frames.items():
+            if frame is None:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code)[0])
+                frame = frame.f_back
+            labels.append(self._names.get(ident, "thread"))
+            labels.reverse()
+            self.stacks[";".join(labels)] += 1
+            self.busy_samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 10) -> list[tuple[str, int]]:
+        """Функции проекта по числу сэмплов, в которых они были в стеке."""
+        repo_labels = {label for label, is_repo in self._labels.values() if is_repo}
+        inclusive: Counter = Counter()
+        for stack, count in self.stacks.items():
+            for label in set(stack.split(";")) & repo_labels:
+                inclusive[label] += count
+        return inclusive.most_common(limit)
+
+    def summary(self) -> str:
+        seconds = (self.stopped_at or time.time()) - self.started_at
+        lines = [
+            f"Профиль за {seconds:.0f} с: {self.samples} срезов по {self.interval * 1000:.0f} мс, "
+            f"{self.busy_samples} стеков с работой"
+        ]
+        total = self.busy_samples or 1
+        for label, count in self.top_functions():
+            lines.append(f"• {label}: {count} ({count / total:.0%})")
+        return "\n".join(lines)
+
+    def save(self, path: str | None = None) -> str:
+        if path is None:
+            os.makedirs(PROFILES_DIR, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+            path = os.path.join(PROFILES_DIR, f"profile-{stamp}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        return path
+
+
+_current: SamplingProfiler | None = None
+_lock = threading.Lock()
+
+
+def start() -> SamplingProfiler | None:
+    """Запустить профайлер; None, если он уже работает."""
+    global _current
+    with _lock:
+        if _current is not None and _current.running:
+            return None
+        _current = SamplingProfiler()
+        _current.start()
+        return _current
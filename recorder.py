@@ -0,0 +1,295 @@
+"""Запись входящих апдейтов для воспроизведения (bench/replay.py).
+
+При RECORD_UPDATES=путь.jsonl.gz каждый полученный апдейт дописывается в
+сжатый файл строкой ``{"t": секунды от начала записи, "update": {...}}``.
+Каждый запуск бота начинает новый сегмент со строки-заголовка
+(``{"capture": 1, ...}``) — в нём время начала и обезличенные ADMIN_ID и
+GROUP_ID, чтобы при воспроизведении админские сценарии шли от того же
+«админа».
+
+Обезличивание выполняется до записи на диск:
+
+* id пользователей и чатов заменяются последовательными (1000001, 1000002...;
+  у групп — со знаком минус), одинаково в пределах сегмента; таблица замен
+  нигде не сохраняется;
+* имена, username и названия чатов — заглушки с новым id; file_id,
+  chat_instance и строковые id — хэш со случайной солью; телефоны,
+  координаты и ссылки затираются;
+* во всех остальных строках (текст, подписи, подписи авторов, имена
+  отправителей пересланных сообщений и любые неизвестные поля) буквы
+  заменяются на «x»/«х», цифры — на случайные, длина и разметка
+  сохраняются. Как есть остаются только служебные поля (_SAFE_KEYS: type,
+  callback_data, status...), имя команды и надписи reply-кнопок, чтобы
+  апдейт попал в те же обработчики;
+* даты заменяются на секунды от начала сегмента.
+
+В цикле событий апдейт только кладётся в очередь (при переполнении —
+отбрасывается), обезличивание, JSON и сжатие выполняет отдельный поток.
+При BOT_WORKERS > 1 пишет приёмник, а не воркеры.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "")
+RECORD_QUEUE_SIZE = int(os.getenv("RECORD_QUEUE_SIZE", "10000"))
+# Как часто дописывать сжатый буфер на диск, если апдейтов нет
+RECORD_FLUSH_SECONDS = 5.0
+
+# Надписи reply-кнопок из bot.py: обработчики ищут их целиком
+KEEP_TEXTS = frozenset({
+    "Добавить профит", "Моя статистика", "Помощь", "Статистика", "Предложения по улучшению",
+})
+
+_ID_KEYS = frozenset({"user_id", "chat_id", "sender_chat_id", "migrate_to_chat_id", "migrate_from_chat_id"})
+_DATE_KEYS = frozenset({"date", "edit_date", "forward_date", "until_date", "expire_date"})
+# Строки, которые пишутся как есть: служебные значения, от которых зависит маршрутизация
+# (тип апдейта, сущности и чата, callback_data, статус участника). Все остальные
+# строки, включая неизвестные поля новых версий Bot API, затираются
+_SAFE_KEYS = frozenset({"type", "callback_data", "language_code", "mime_type", "status", "emoji"})
+# Текст сообщений: команды и надписи кнопок сохраняются (см. Anonymizer.text)
+_TEXT_KEYS = frozenset({"text", "caption"})
+_NAME_KEYS = frozenset({"first_name", "last_name", "username", "title"})
+_TOKEN_KEYS = frozenset({"id", "file_id", "file_unique_id", "custom_emoji_id", "emoji_status_custom_emoji_id",
+                         "chat_instance", "inline_message_id"})
+_WIPE_KEYS = {
+    "phone_number": "0000000000",
+    "url": "https://example.com",
+    "invite_link": "https://t.me/+anonymous",
+    "latitude": 0.0,
+    "longitude": 0.0,
+}
+_ID_BASE = 1_000_000
+
+
+class Anonymizer:
+    """Обезличивание словаря апдейта; замены согласованы в пределах одного экземпляра."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._ids: dict[int, int] = {}
+        self._salt = secrets.token_bytes(16)
+        self._rnd = random.Random(secrets.randbits(64))
+
+    def map_id(self, value: int) -> int:
+        mapped = self._ids.get(value)
+        if mapped is None:
+            mapped = _ID_BASE + len(self._ids) + 1
+            mapped = self._ids[value] = -mapped if value < 0 else mapped
+        return mapped
+
+    def text(self, value: str) -> str:
+        if value in KEEP_TEXTS:
+            return value
+        head = ""
+        if value.startswith("/"):
+            # Имя команды (/profit@bot) нужно CommandHandler, аргументы — нет
+            command, sep, value = value.partition(" ")
+            head = command + sep
+        return head + self.scramble(value)
+
+    def scramble(self, value: str) -> str:
+        """Буквы — в «x»/«х», цифры — в случайные; длина и остальные символы те же."""
+        chars = []
+        prev_digit = False
+        for ch in value:
+            if ch.isdigit():
+                # Первая цифра числа — не ноль, чтобы суммы оставались суммами
+                chars.append(str(self._rnd.randint(0 if prev_digit else 1, 9)))
+                prev_digit = True
+                continue
+            prev_digit = False
+            if ch.isalpha() and ord(ch) < 0x10000:
+                chars.append("x" if ch.isascii() else "х")
+            else:
+                # Эмодзи и знаки оставляем: от них зависят смещения entities (UTF-16)
+                chars.append(ch)
+        return "".join(chars)
+
+    def _token(self, value: str) -> str:
+        return hashlib.blake2b(value.encode(), key=self._salt, digest_size=12).hexdigest()
+
+    def _name(self, key: str, peer_id: int) -> str | None:
+        new_id = abs(self.map_id(peer_id))
+        if key == "username":
+            return f"user{new_id}"
+        if key == "first_name":
+            return f"User {new_id}"
+        if key == "title":
+            return f"Group {new_id}"
+        return None
+
+    def anonymize(self, obj):
+        if isinstance(obj, list):
+            return [self.anonymize(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        # User (is_bot) и Chat (type) — объекты с числовым id человека или чата
+        is_peer = isinstance(obj.get("id"), int) and ("is_bot" in obj or "type" in obj)
+        result = {}
+        for key, value in obj.items():
+            if key in _NAME_KEYS and is_peer and isinstance(value, str):
+                name = self._name(key, obj["id"])
+                if name is not None:
+                    result[key] = name
+            elif isinstance(value, bool):
+                result[key] = value
+            elif isinstance(value, int) and ((key == "id" and is_peer) or key in _ID_KEYS):
+                result[key] = self.map_id(value)
+            elif isinstance(value, int) and key in _DATE_KEYS:
+                result[key] = value - int(self.started)
+            elif key in _WIPE_KEYS:
+                result[key] = _WIPE_KEYS[key]
+            elif isinstance(value, str):
+                if key in _SAFE_KEYS or (key == "data" and "chat_instance" in obj):
+                    # data — callback_data нажатой кнопки (у CallbackQuery есть chat_instance)
+                    result[key] = value
+                elif key in _TEXT_KEYS:
+                    result[key] = self.text(value)
+                elif key in _TOKEN_KEYS:
+                    result[key] = self._token(value)
+                else:
+                    result[key] = self.scramble(value)
+            else:
+                result[key] = self.anonymize(value)
+        return result
+
+
+class UpdateRecorder:
+    """Очередь апдейтов и поток, дописывающий их в сжатый JSONL."""
+
+    def __init__(self, path: str, admin_id: int | None = None, group_id: int | None = None,
+                 maxsize: int = RECORD_QUEUE_SIZE):
+        self.path = path
+        self.admin_id = admin_id
+        self.group_id = group_id
+        self.recorded = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self._thread: threading.Thread | None = None
+        self._started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, args=(time.time(),), name="update-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, update: object) -> None:
+        """Поставить апдейт в очередь записи (из цикла событий, без блокировки)."""
+        if self._thread is None or not isinstance(update, Update):
+            return
+        try:
+            # Update неизменяем, поэтому to_dict() можно выполнить в потоке записи
+            self._queue.put_nowait((time.monotonic() - self._started, update))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self, started_wall: float) -> None:
+        anonymizer = Anonymizer(started_wall)
+        header = {
+            "capture": 1,
+            "started": datetime.fromtimestamp(started_wall).isoformat(timespec="seconds"),
+            "admin_id": anonymizer.map_id(self.admin_id) if self.admin_id else None,
+            "group_id": anonymizer.map_id(self.group_id) if self.group_id else None,
+        }
+        update_id = 0
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            while True:
+                try:
+                    item = self._queue.get(timeout=RECORD_FLUSH_SECONDS)
+                except queue.Empty:
+                    f.flush()
+                    continue
+                if item is None:
+                    return
+                offset, update = item
+                try:
+                    data = anonymizer.anonymize(update.to_dict())
+                    update_id += 1
+                    data["update_id"] = update_id
+                    f.write(json.dumps({"t": round(offset, 3), "update": data}, ensure_ascii=False,
+                                       separators=(",", ":")) + "\n")
+                    self.recorded += 1
+                except Exception as e:
+                    logger.warning(f"Не удалось записать апдейт: {e}")
+
+    def stop(self, timeout: float | None = 30) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {"path": self.path, "recorded": self.recorded, "dropped": self.dropped, "queue": self._queue.qsize()}
+
+
+_recorder: UpdateRecorder | None = None
+
+
+def start(admin_id: int | None = None, group_id: int | None = None) -> None:
+    """Начать запись, если задан RECORD_UPDATES."""
+    global _recorder
+    if not RECORD_UPDATES or _recorder is not None:
+        return
+    _recorder = UpdateRecorder(RECORD_UPDATES, admin_id, group_id)
+    _recorder.start()
+    logger.info(f"Запись апдейтов в {RECORD_UPDATES}")
+
+
+def record(update: object) -> None:
+    if _recorder is not None:
+        _recorder.record(update)
+
+
+def stop() -> None:
+    global _recorder
+    if _recorder is not None:
+        _recorder.stop()
+        logger.info(f"Запись апдейтов остановлена: {_recorder.recorded} записано, {_recorder.dropped} отброшено")
+        _recorder = None
+
+
+def stats() -> dict | None:
+    return _recorder.stats() if _recorder is not None else None
+
+
+def read_capture(path: str):
+    """Сегменты записи: [(заголовок, [(t, апдейт), ...]), ...]."""
+    segments: list[tuple[dict, list]] = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # Оборванная строка после аварийной остановки
+                    continue
+                if "capture" in item:
+                    segments.append((item, []))
+                elif segments:
+                    segments[-1][1].append((item["t"], item["update"]))
+        except (EOFError, OSError, zlib.error) as e:
+            # Сегмент, не закрытый при аварийной остановке: дальше файл не читается
+            logger.warning(f"{path}: запись оборвана ({e}), прочитано сегментов: {len(segments)}")
+    return segments
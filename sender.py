@@ -0,0 +1,294 @@
+"""Общая очередь исходящих сообщений с учётом лимитов Telegram.
+
+Все массовые и служебные отправки (уведомления админу, личные сообщения,
+посты в группу, упоминания /all) идут через SendScheduler:
+
+* глобальное ведро токенов — SEND_GLOBAL_RATE сообщений в секунду (~30);
+* на чат — 1 сообщение в секунду, для групп дополнительно не больше 20
+  в любую минуту (скользящее окно);
+* приоритеты: модерация админа и ЛС пользователям уходят раньше праздничных
+  постов в группу;
+* внутри одного чата порядок отправки сохраняется (текст → стикер → текст);
+* на 429 (RetryAfter) чат ставится на паузу, сообщение повторяется.
+
+backlog() показывает, сколько сообщений ждёт отправки.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_ADMIN = 0
+PRIORITY_DM = 1
+PRIORITY_GROUP = 2
+
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float]):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно сейчас)."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class SlidingWindow:
+    """Не больше limit событий в любом окне длиной period секунд."""
+
+    def __init__(self, limit: int, period: float, clock: Callable[[], float]):
+        self.limit = limit
+        self.period = period
+        self._clock = clock
+        self._events: Deque[float] = deque()
+
+    def delay(self) -> float:
+        now = self._clock()
+        while self._events and self._events[0] <= now - self.period:
+            self._events.popleft()
+        if len(self._events) < self.limit:
+            return 0.0
+        return self._events[0] + self.period - now
+
+    def take(self) -> None:
+        self._events.append(self._clock())
+
+    def idle(self) -> bool:
+        self.delay()
+        return not self._events
+
+
+@dataclass
+class _Item:
+    priority: int
+    seq: int
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    attempts: int = 0
+
+
+@dataclass
+class _ChatQueue:
+    buckets: list
+    items: Deque[_Item] = field(default_factory=deque)
+    in_flight: bool = False
+    paused_until: float = 0.0
+
+
+def _chat_buckets(chat_id: int, clock) -> list:
+    # Отрицательные id — группы и каналы
+    if chat_id < 0:
+        return [TokenBucket(1.0, 1, clock), SlidingWindow(20, 60, clock)]
+    return [TokenBucket(1.0, 1, clock)]
+
+
+class SendScheduler:
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, clock: Callable[[], float] = time.monotonic,
+                 chat_buckets: Callable[[int, Callable[[], float]], list] = _chat_buckets):
+        self._clock = clock
+        # Лимиты чата по chat_id (нагрузочный тест подставляет пустые)
+        self._chat_buckets = chat_buckets
+        # Ёмкость 1: без всплесков, в любую секунду уходит не больше global_rate сообщений
+        self._global = TokenBucket(global_rate, 1, clock)
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    # --- публичный API ---
+
+    def start(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Дождаться отправки очереди (не дольше timeout) и остановить обработчик."""
+        deadline = self._clock() + timeout
+        while (self.backlog() or self._tasks) and self._clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for chat in self._chats.values():
+            for item in chat.items:
+                if not item.future.done():
+                    item.future.set_exception(RuntimeError("Очередь отправки остановлена"))
+        self._chats.clear()
+
+    def submit(self, chat_id: int, factory: Callable[[], Awaitable[Any]],
+               priority: int = PRIORITY_GROUP) -> asyncio.Future:
+        """Поставить отправку в очередь. factory() должен вернуть корутину вызова Bot API."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        item = _Item(priority, next(self._seq), factory, loop.create_future())
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(self._chat_buckets(chat_id, self._clock))
+        chat.items.append(item)
+        self._wakeup.set()
+        return item.future
+
+    async def send(self, chat_id: int, factory: Callable[[], Awaitable[Any]],
+                   priority: int = PRIORITY_GROUP) -> Any:
+        """Отправить через очередь и дождаться результата (ошибки пробрасываются)."""
+        return await self.submit(chat_id, factory, priority)
+
+    async def send_message(self, bot, chat_id: int, text: str, priority: int = PRIORITY_GROUP, **kwargs) -> Any:
+        return await self.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
+
+    async def send_sticker(self, bot, chat_id: int, sticker: str, priority: int = PRIORITY_GROUP, **kwargs) -> Any:
+        return await self.send(chat_id, lambda: bot.send_sticker(chat_id=chat_id, sticker=sticker, **kwargs), priority)
+
+    def backlog(self) -> int:
+        return sum(len(chat.items) for chat in self._chats.values())
+
+    def stats(self) -> dict:
+        return {
+            "backlog": self.backlog(),
+            "in_flight": len(self._tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+    # --- обработчик очереди ---
+
+    def _pick(self) -> tuple[int | None, _Item | None, float]:
+        """Выбрать следующее сообщение: (chat_id, item, 0) или (None, None, сколько ждать)."""
+        now = self._clock()
+        best_chat, best_item, wait = None, None, float("inf")
+        idle = []
+        for chat_id, chat in self._chats.items():
+            if chat.in_flight:
+                continue
+            # Отправки, которые уже никто не ждёт (отменённые задачи), выбрасываем
+            while chat.items and chat.items[0].future.cancelled():
+                chat.items.popleft()
+            if not chat.items:
+                # Лимиты чата храним, пока в них есть история, иначе окно «20 в минуту» обнулится
+                if all(b.idle() for b in chat.buckets):
+                    idle.append(chat_id)
+                continue
+            delay = max([chat.paused_until - now] + [b.delay() for b in chat.buckets])
+            if delay > 0:
+                wait = min(wait, delay)
+                continue
+            head = chat.items[0]
+            if best_item is None or (head.priority, head.seq) < (best_item.priority, best_item.seq):
+                best_chat, best_item = chat_id, head
+        for chat_id in idle:
+            del self._chats[chat_id]
+        if best_item is None:
+            return None, None, wait
+        global_delay = self._global.delay()
+        if global_delay > 0:
+            return None, None, global_delay
+        return best_chat, best_item, 0.0
+
+    async def _run(self) -> None:
+        while True:
+            chat_id, item, wait = self._pick()
+            if item is None:
+                self._wakeup.clear()
+                timeout = None if wait == float("inf") else wait
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            chat = self._chats[chat_id]
+            chat.items.popleft()
+            chat.in_flight = True
+            self._global.take()
+            for bucket in chat.buckets:
+                bucket.take()
+            task = asyncio.get_running_loop().create_task(self._deliver(chat_id, chat, item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, chat_id: int, chat: _ChatQueue, item: _Item) -> None:
+        try:
+            result = await item.factory()
+        except RetryAfter as e:
+            item.attempts += 1
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+            if item.attempts <= SEND_MAX_RETRIES:
+                # Чат на паузу, сообщение — обратно в голову очереди, чтобы не нарушить порядок
+                self.retried += 1
+                chat.paused_until = self._clock() + retry_after
+                chat.items.appendleft(item)
+                logger.warning(f"429 для чата {chat_id}: повтор через {retry_after:.0f} с")
+            else:
+                self.failed += 1
+                if not item.future.done():
+                    item.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            chat.in_flight = False
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+
+scheduler = SendScheduler()
+
+
+async def send_message(bot, chat_id: int, text: str, priority: int = PRIORITY_GROUP, **kwargs) -> Any:
+    return await scheduler.send_message(bot, chat_id, text, priority, **kwargs)
+
+
+async def send_sticker(bot, chat_id: int, sticker: str, priority: int = PRIORITY_GROUP, **kwargs) -> Any:
+    return await scheduler.send_sticker(bot, chat_id, sticker, priority, **kwargs)
+
+
+def backlog() -> int:
+    return scheduler.backlog()
+
+
+def start() -> None:
+    scheduler.start()
+
+
+async def stop(timeout: float = 10) -> None:
+    await scheduler.stop(timeout)
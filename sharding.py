@@ -0,0 +1,321 @@
+"""Несколько процессов-обработчиков за одним приёмником апдейтов.
+
+При BOT_WORKERS > 1 main() запускает этот режим:
+
+* ingress-процесс (держит bot.lock) получает апдейты — опросом или через
+  webhook — и раскладывает их по воркерам по chat_id (для апдейтов без
+  чата — по user_id). Все апдейты одного чата всегда попадают в один воркер
+  и передаются через его очередь по порядку, поэтому порядок внутри чата и
+  состояние диалогов (они привязаны к чату) сохраняются;
+* каждый воркер — отдельный процесс со своим Application и всеми
+  обработчиками из bot.py. Запись в bot.db и bot_state.db из разных
+  процессов координирует SQLite (WAL, BEGIN IMMEDIATE, ожидание блокировки).
+
+Файловое зеркало пишет только приёмник: воркеры пересылают ему задачи
+(mirror_writer.RemoteMirror), а запись по заявке перечитывает её из БД,
+поэтому порядок прихода задач из разных воркеров неважен.
+
+Упавший воркер приёмник перезапускает (проверка раз в
+SHARD_WATCHDOG_INTERVAL секунд и при заполненной очереди); апдейты, уже
+лежащие в его очереди, обработает новый процесс, а тот, что обрабатывался в
+момент падения, теряется.
+
+Ограничения режима:
+
+* кэш /stats у каждого воркера свой (после подтверждения профита другие
+  воркеры покажут новые цифры не позже чем через STATS_CACHE_TTL);
+* общий лимит отправки SEND_GLOBAL_RATE делится между воркерами, а лимит
+  1 сообщение/с на чат считается в каждом воркере отдельно: уведомления
+  админу из нескольких воркеров могут превысить его, тогда Telegram
+  отвечает 429 и sender повторяет отправку после паузы;
+* user_data у каждого воркера своя копия: данные пользователя из лички и из
+  групп (разные чаты — разные воркеры) не видны друг другу, а при
+  сохранении в bot_state.db побеждает последняя записанная копия. Бот
+  хранит в user_data только состояние диалогов, которые начинаются и
+  заканчиваются в одном чате (ввод профита, предложение). Состояние,
+  переходящее между чатами, лежит в БД: например, заявка, сумму которой
+  админ вводит в личке после кнопки «Изменить» в группе
+  (db.set_editing_request). Новые обработчики должны поступать так же;
+* журнальное хранилище (STORAGE_BACKEND=log) не поддерживается — в него
+  может писать только один процесс.
+"""
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+from telegram import Bot, Update
+
+import mirror_writer
+import recorder
+from update_processor import update_key
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов может ждать в очереди одного воркера, прежде чем приёмник притормозит
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))
+SHARD_WATCHDOG_INTERVAL = float(os.getenv("SHARD_WATCHDOG_INTERVAL", "5"))
+_WORKER_JOIN_TIMEOUT = 120
+# Сколько ждать места в очереди воркера, прежде чем проверить, жив ли он
+_PUT_TIMEOUT = 1.0
+
+
+def shard_for(update: Update, workers: int) -> int:
+    chat_id, user_id = update_key(update)
+    key = chat_id if chat_id is not None else user_id
+    return (key or 0) % workers
+
+
+# --- воркер ---
+
+def _worker_main(index: int, workers: int, inbox, mirror_outbox, mirror_replies) -> None:
+    # Остановкой управляет приёмник (присылает None), сигналы от Ctrl+C/systemd игнорируем,
+    # чтобы дообработать уже полученные апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import bot
+    import metrics
+    import mirror_writer
+    import sender
+    import webhook
+
+    # У каждого воркера свой порт метрик: METRICS_PORT + номер воркера
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += index + 1
+    # Апдейты записывает приёмник, файловое зеркало — тоже он
+    recorder.RECORD_UPDATES = ""
+    mirror_writer.writer = mirror_writer.RemoteMirror(index, mirror_outbox, mirror_replies)
+
+    # Общий лимит отправки делится между процессами
+    sender.scheduler = sender.SendScheduler(global_rate=sender.SEND_GLOBAL_RATE / workers)
+    application = bot.build_application(with_updater=False)
+    logger.info(f"Воркер {index + 1}/{workers} запущен (pid {os.getpid()})")
+    asyncio.run(_worker_loop(application, inbox, webhook.serve_application))
+
+
+async def _worker_loop(application, inbox, serve_application) -> None:
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+
+    def enqueue(payload: str) -> None:
+        update = Update.de_json(json.loads(payload), application.bot)
+        application.update_queue.put_nowait(update)
+
+    def reader() -> None:
+        while True:
+            payload = inbox.get()
+            if payload is None:
+                # Колбэки выполняются по порядку: все апдейты до None уже в очереди
+                loop.call_soon_threadsafe(stop_event.set)
+                return
+            loop.call_soon_threadsafe(enqueue, payload)
+
+    async def on_started() -> None:
+        threading.Thread(target=reader, name="shard-reader", daemon=True).start()
+
+    await serve_application(application, stop_event, on_started)
+
+
+# --- приёмник ---
+
+def _env_int(name: str) -> int | None:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+class _Workers:
+    """Процессы-воркеры с их очередями; упавший воркер перезапускается на той же очереди."""
+
+    def __init__(self, ctx, count: int):
+        self.ctx = ctx
+        self.queues = [ctx.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(count)]
+        self.mirror_outbox = ctx.Queue()
+        self.mirror_replies = [ctx.Queue() for _ in range(count)]
+        self.processes: list = [None] * count
+        self.restarts = 0
+
+    def start(self, index: int) -> None:
+        p = self.ctx.Process(
+            target=_worker_main,
+            args=(index, len(self.queues), self.queues[index], self.mirror_outbox, self.mirror_replies[index]),
+            name=f"bot-worker-{index + 1}",
+        )
+        p.start()
+        self.processes[index] = p
+
+    def start_all(self) -> None:
+        for index in range(len(self.queues)):
+            self.start(index)
+
+    def ensure_alive(self, index: int) -> None:
+        p = self.processes[index]
+        if p is None or p.is_alive():
+            return
+        self.restarts += 1
+        logger.error(f"{p.name} завершился (код {p.exitcode}), перезапускаем")
+        self.start(index)
+
+    def stop(self) -> None:
+        for index, q in enumerate(self.queues):
+            # Мёртвому воркеру None не нужен, а в заполненную очередь он бы не пролез
+            while self.processes[index].is_alive():
+                try:
+                    q.put(None, timeout=_PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+        for p in self.processes:
+            p.join(_WORKER_JOIN_TIMEOUT)
+            if p.is_alive():
+                logger.warning(f"{p.name} не остановился за {_WORKER_JOIN_TIMEOUT} с, завершаем")
+                p.terminate()
+
+
+class _Dispatcher:
+    def __init__(self, workers: _Workers):
+        self.workers = workers
+        self.queues = workers.queues
+        self.dispatched = [0] * len(self.queues)
+
+    async def __call__(self, update: Update) -> None:
+        recorder.record(update)
+        index = shard_for(update, len(self.queues))
+        payload = json.dumps(update.to_dict(), ensure_ascii=False)
+        q = self.queues[index]
+        try:
+            q.put_nowait(payload)
+        except queue.Full:
+            # Воркер не успевает: ждём место, не обгоняя следующие апдейты. Ждём
+            # порциями, чтобы упавший воркер не держал приёмник вечно
+            loop = asyncio.get_running_loop()
+            while True:
+                self.workers.ensure_alive(index)
+                try:
+                    await loop.run_in_executor(None, functools.partial(q.put, payload, timeout=_PUT_TIMEOUT))
+                    break
+                except queue.Full:
+                    continue
+        self.dispatched[index] += 1
+
+
+async def _watchdog(workers: _Workers, stop_event: asyncio.Event) -> None:
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), SHARD_WATCHDOG_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if stop_event.is_set():
+            return
+        for index in range(len(workers.queues)):
+            workers.ensure_alive(index)
+
+
+async def _poll(bot: Bot, dispatch: _Dispatcher, stop_event: asyncio.Event) -> None:
+    # Как run_polling(drop_pending_updates=True)
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while not stop_event.is_set():
+        fetch = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=30))
+        stopper = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait({fetch, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if not fetch.done():
+            fetch.cancel()
+            break
+        try:
+            updates = fetch.result()
+        except Exception as e:
+            logger.warning(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await dispatch(update)
+            offset = update.update_id + 1
+    if offset is not None:
+        # Подтверждаем Telegram последние полученные апдейты, чтобы не получить их снова
+        try:
+            await bot.get_updates(offset=offset, timeout=0)
+        except Exception:
+            pass
+
+
+async def _ingress(token: str, base_url: str | None, mode: str, dispatch: _Dispatcher) -> None:
+    import webhook
+
+    stop_event = asyncio.Event()
+    webhook.stop_on_signals(stop_event)
+    watchdog = asyncio.create_task(_watchdog(dispatch.workers, stop_event))
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    try:
+        await _receive(bot, mode, dispatch, stop_event)
+    finally:
+        stop_event.set()
+        await watchdog
+
+
+async def _receive(bot: Bot, mode: str, dispatch: _Dispatcher, stop_event: asyncio.Event) -> None:
+    import webhook
+
+    async with bot:
+        if mode == "webhook":
+            if not webhook.WEBHOOK_URL:
+                raise RuntimeError("Для BOT_MODE=webhook задайте WEBHOOK_URL")
+            secret = webhook.check_secret()
+            server = webhook.WebhookServer(None, secret=secret, on_update=dispatch)
+            await server.start()
+            try:
+                await bot.set_webhook(
+                    url=webhook.WEBHOOK_URL,
+                    secret_token=secret,
+                    max_connections=webhook.WEBHOOK_MAX_CONNECTIONS,
+                )
+                await stop_event.wait()
+            finally:
+                await server.stop()
+        else:
+            await _poll(bot, dispatch, stop_event)
+
+
+def run_sharded(workers: int, mode: str, token: str, base_url: str | None = None) -> None:
+    """Запустить приёмник и workers процессов-обработчиков (блокирует до SIGINT/SIGTERM).
+
+    Вызывается из bot.main() под bot.lock после init_db().
+    """
+    import fs_storage
+
+    if fs_storage._use_log():
+        raise RuntimeError("STORAGE_BACKEND=log не поддерживает BOT_WORKERS > 1")
+    ctx = multiprocessing.get_context("spawn")
+    workers_pool = _Workers(ctx, workers)
+    workers_pool.start_all()
+    # Единственный писатель файлового зеркала — приёмник
+    mirror_writer.start()
+    mirror_thread = threading.Thread(
+        target=mirror_writer.serve_remote, args=(workers_pool.mirror_outbox, workers_pool.mirror_replies),
+        name="mirror-remote", daemon=True,
+    )
+    mirror_thread.start()
+    dispatch = _Dispatcher(workers_pool)
+    recorder.start(_env_int("ADMIN_ID"), _env_int("GROUP_ID"))
+    print(f"Бот запущен: приёмник + {workers} воркеров. Нажмите Ctrl+C для остановки.")
+    try:
+        asyncio.run(_ingress(token, base_url, mode, dispatch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        workers_pool.stop()
+        # Воркеры остановлены: всё, что они прислали, уже в очереди задач зеркала
+        workers_pool.mirror_outbox.put(None)
+        mirror_thread.join(_WORKER_JOIN_TIMEOUT)
+        mirror_writer.stop()
+        recorder.stop()
+        logger.info(
+            f"Приёмник остановлен, передано апдейтов по воркерам: {dispatch.dispatched}, "
+            f"перезапусков воркеров: {workers_pool.restarts}"
+        )
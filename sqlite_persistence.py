@@ -0,0 +1,278 @@
+"""Персистентность python-telegram-bot в SQLite вместо PicklePersistence.
+
+PicklePersistence при каждом сбросе заново сериализует и переписывает весь
+файл. Здесь каждая запись user_data/chat_data/диалога хранится отдельной
+строкой, а в БД попадают только реально изменившиеся ключи: изменения за
+один проход Application.update_persistence собираются и пишутся одной
+транзакцией. Значения сериализуются pickle (максимальный протокол), ключи
+диалогов — компактным JSON.
+
+Данные лежат в отдельном файле (по умолчанию bot_state.db), чтобы не
+конкурировать за блокировку записи с bot.db. При первом запуске состояние
+переносится из старого bot_state.pkl, если он есть.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+ConversationKey = Tuple[int | str, ...]
+ConversationDict = Dict[ConversationKey, object]
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS kv (name TEXT PRIMARY KEY, data BLOB NOT NULL)",
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state BLOB NOT NULL,
+        PRIMARY KEY (name, key)
+    )
+    """,
+)
+
+
+def _dumps(value: Any) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=8).digest()
+
+
+def _conv_key(key: ConversationKey) -> str:
+    return json.dumps(list(key), separators=(",", ":"))
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(
+        self,
+        filepath: str,
+        legacy_pickle_path: Optional[str] = None,
+        store_data: Optional[PersistenceInput] = None,
+        update_interval: float = 60,
+    ):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self.legacy_pickle_path = legacy_pickle_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self._conn: Optional[sqlite3.Connection] = None
+        # Отпечатки последних записанных значений: неизменённые ключи не переписываем
+        self._digests: Dict[Tuple[str, Any], bytes] = {}
+        # Изменения текущего прохода: (таблица, ключ) -> blob или None (удалить)
+        self._staged: Dict[Tuple[str, Any], Optional[bytes]] = {}
+        self._commit_task: Optional[asyncio.Task] = None
+        self._pending_commit: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.skipped = 0
+
+    # --- работа с БД (в потоке persistence) ---
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.filepath, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                for stmt in _SCHEMA:
+                    conn.execute(stmt)
+            self._conn = conn
+            self._import_legacy_pickle()
+        return self._conn
+
+    def _import_legacy_pickle(self) -> None:
+        path = self.legacy_pickle_path
+        if not path or not os.path.exists(path):
+            return
+        conn = self._conn
+        has_data = any(
+            conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ("user_data", "chat_data", "kv", "conversations")
+        )
+        if has_data:
+            return
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {path} для переноса состояния: {e}")
+            return
+        with conn:
+            for user_id, value in (data.get("user_data") or {}).items():
+                conn.execute("INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, _dumps(value)))
+            for chat_id, value in (data.get("chat_data") or {}).items():
+                conn.execute("INSERT OR REPLACE INTO chat_data VALUES (?, ?)", (chat_id, _dumps(value)))
+            if data.get("bot_data") is not None:
+                conn.execute("INSERT OR REPLACE INTO kv VALUES ('bot_data', ?)", (_dumps(data["bot_data"]),))
+            if data.get("callback_data") is not None:
+                conn.execute("INSERT OR REPLACE INTO kv VALUES ('callback_data', ?)", (_dumps(data["callback_data"]),))
+            for name, convs in (data.get("conversations") or {}).items():
+                for key, state in convs.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                        (name, _conv_key(key), _dumps(state)),
+                    )
+        logger.info(f"Состояние перенесено из {path} в {self.filepath}")
+
+    def _load_table(self, table: str, key_column: str) -> dict:
+        result = {}
+        for key, blob in self._db().execute(f"SELECT {key_column}, data FROM {table}"):
+            self._digests[(table, key)] = _digest(blob)
+            result[key] = pickle.loads(blob)
+        return result
+
+    def _load_kv(self, name: str):
+        row = self._db().execute("SELECT data FROM kv WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        self._digests[("kv", name)] = _digest(row[0])
+        return pickle.loads(row[0])
+
+    def _load_conversations(self, name: str) -> ConversationDict:
+        result = {}
+        for key, blob in self._db().execute("SELECT key, state FROM conversations WHERE name = ?", (name,)):
+            self._digests[("conversations", (name, key))] = _digest(blob)
+            result[tuple(json.loads(key))] = pickle.loads(blob)
+        return result
+
+    def _write(self, changes: Dict[Tuple[str, Any], Optional[bytes]]) -> None:
+        conn = self._db()
+        with conn:
+            for (table, key), blob in changes.items():
+                if table == "conversations":
+                    name, conv_key = key
+                    if blob is None:
+                        conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, conv_key))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, conv_key, blob))
+                    continue
+                key_column = {"user_data": "user_id", "chat_data": "chat_id", "kv": "name"}[table]
+                if blob is None:
+                    conn.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+                else:
+                    conn.execute(f"INSERT OR REPLACE INTO {table} ({key_column}, data) VALUES (?, ?)", (key, blob))
+
+    # --- пакетная запись изменений ---
+
+    def _stage(self, table: str, key: Any, value: Any, delete: bool = False) -> bool:
+        if delete:
+            if self._digests.pop((table, key), None) is None and (table, key) not in self._staged:
+                return False
+            self._staged[(table, key)] = None
+            return True
+        blob = _dumps(value)
+        digest = _digest(blob)
+        if self._digests.get((table, key)) == digest:
+            self.skipped += 1
+            return False
+        self._digests[(table, key)] = digest
+        self._staged[(table, key)] = blob
+        return True
+
+    async def _commit_soon(self) -> None:
+        # Application.update_persistence запускает все update_* через gather: первый
+        # вызов планирует запись, к её началу остальные уже успевают добавить свои ключи
+        task = self._pending_commit
+        if task is None:
+            task = asyncio.ensure_future(self._commit(self._commit_task))
+            self._pending_commit = task
+            self._commit_task = task
+        await asyncio.shield(task)
+
+    async def _commit(self, previous: Optional[asyncio.Task] = None) -> None:
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        await asyncio.sleep(0)
+        self._pending_commit = None
+        changes, self._staged = self._staged, {}
+        if not changes:
+            return
+        try:
+            await self._run(self._write, changes)
+        except Exception:
+            # Забываем отпечатки, чтобы эти ключи записались при следующем проходе
+            for key in changes:
+                self._digests.pop(key, None)
+            raise
+        self.writes += len(changes)
+
+    # --- API BasePersistence ---
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return await self._run(self._load_table, "user_data", "user_id")
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return await self._run(self._load_table, "chat_data", "chat_id")
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        data = await self._run(self._load_kv, "bot_data")
+        return data if data is not None else {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return await self._run(self._load_kv, "callback_data")
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        # Диалоги грузятся по имени — только когда их запрашивает ConversationHandler
+        return await self._run(self._load_conversations, name)
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        if self._stage("conversations", (name, _conv_key(key)), new_state, delete=new_state is None):
+            await self._commit_soon()
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if self._stage("user_data", user_id, data):
+            await self._commit_soon()
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        if self._stage("chat_data", chat_id, data):
+            await self._commit_soon()
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        if self._stage("kv", "bot_data", data):
+            await self._commit_soon()
+
+    async def update_callback_data(self, data: Any) -> None:
+        if self._stage("kv", "callback_data", data):
+            await self._commit_soon()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        if self._stage("chat_data", chat_id, None, delete=True):
+            await self._commit_soon()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self._stage("user_data", user_id, None, delete=True):
+            await self._commit_soon()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._commit(self._commit_task)
+
+        def close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        await self._run(close)
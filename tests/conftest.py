@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "1:test")
+
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    """Пустая bot.db во временном каталоге."""
+    import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "bot.db"))
+    db.init_db()
+    yield db
+    db.close_connections()
+
+
+@pytest.fixture
+def file_storage(tmp_path, monkeypatch):
+    """Файловое зеркало (STORAGE_BACKEND=files) в каталогах внутри tmp_path."""
+    import fs_storage
+
+    monkeypatch.setattr(fs_storage, "STORAGE_BACKEND", "files")
+    for name in ("PENDING_DIR", "APPROVED_DIR", "REJECTED_DIR"):
+        monkeypatch.setattr(fs_storage, name, str(tmp_path / name.lower()))
+    return fs_storage
@@ -0,0 +1,43 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+ADMIN = 4242
+
+
+def test_edit_pressed_in_group_is_finished_in_private_by_other_worker(tmp_db, monkeypatch):
+    db = tmp_db
+    monkeypatch.setattr(bot, "ADMIN_ID", ADMIN)
+    monkeypatch.setattr(bot.mirror, "save_approved", lambda row: None)
+    profit_id = db.create_profit_request(1, "a", "A", 100, "100")
+    sent, replies = [], []
+
+    async def send_message(**kwargs):
+        sent.append(kwargs)
+
+    async def answer(**kwargs):
+        pass
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    fake_bot = SimpleNamespace(send_message=send_message)
+    admin = SimpleNamespace(id=ADMIN)
+    # Кнопка «Изменить» под сообщением в группе: у этого воркера своя user_data
+    press = SimpleNamespace(
+        callback_query=SimpleNamespace(data=f"edit:{profit_id}", answer=answer,
+                                       message=SimpleNamespace(chat=SimpleNamespace(id=-100))),
+        effective_user=admin,
+    )
+    # Ответ в личке приходит в другой воркер с пустой user_data
+    reply = SimpleNamespace(effective_user=admin, message=SimpleNamespace(text="250", reply_text=reply_text))
+
+    async def scenario():
+        await bot.handle_callback(press, SimpleNamespace(bot=fake_bot, user_data={}))
+        await bot.admin_edit_amount(reply, SimpleNamespace(bot=fake_bot, user_data={}))
+
+    asyncio.run(scenario())
+    assert db.get_profit(profit_id)[5] == 250
+    assert replies and replies[0].startswith(f"Заявка #{profit_id} обновлена")
+    assert db.get_editing_request(ADMIN) is None
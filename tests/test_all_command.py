@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def _update(chat_id: int, replies: list):
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id, type="supergroup"),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+
+
+def test_concurrent_all_starts_one_run(monkeypatch):
+    chat_id = -100500
+    started = []
+
+    async def slow_batches(context, cid):
+        # Сбор пачек ждёт БД: второй /all приходит в это время
+        await asyncio.sleep(0.05)
+        return [(1, "@a"), (2, "@b")]
+
+    async def fake_run_all(application, chat_data, cid, batches, start):
+        started.append(cid)
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            bot._all_runs.pop(cid, None)
+
+    monkeypatch.setattr(bot, "get_mention_batches", slow_batches)
+    monkeypatch.setattr(bot, "_run_all", fake_run_all)
+
+    async def scenario():
+        chat_data: dict = {}
+        context = SimpleNamespace(chat_data=chat_data, application=None)
+        replies_a, replies_b = [], []
+        await asyncio.gather(
+            bot.all_command(_update(chat_id, replies_a), context),
+            bot.all_command(_update(chat_id, replies_b), context),
+        )
+        await asyncio.gather(*bot._all_runs.values())
+        return replies_a + replies_b
+
+    replies = asyncio.run(scenario())
+    assert started == [chat_id]
+    assert len(replies) == 1 and replies[0].startswith("Уже отмечаю всех")
+    assert chat_id not in bot._all_starting
+
+
+def test_failed_batch_is_not_recorded_as_sent(monkeypatch):
+    chat_id = -100501
+    sent = []
+
+    async def send_message(bot_, cid, text, priority, **kwargs):
+        if len(sent) == 1:
+            raise RuntimeError("429: повторы исчерпаны")
+        sent.append(text)
+
+    monkeypatch.setattr(bot.sender, "send_message", send_message)
+    application = SimpleNamespace(bot=None, mark_data_for_update_persistence=lambda **kwargs: None)
+    chat_data: dict = {}
+    batches = [(1, "@a"), (2, "@b"), (3, "@c")]
+    asyncio.run(bot._run_all(application, chat_data, chat_id, batches, 0))
+    assert len(sent) == 1
+    # Следующий /all продолжит со второй пачки, а не пропустит её
+    assert chat_data["all_progress"]["sent"] == 1
+    assert chat_data["all_progress"]["last_user_id"] == 1
+    assert chat_id not in bot._all_runs
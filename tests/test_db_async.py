@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import db_async as adb
+
+# С потоками лаг — десятки мс (разбор строк держит GIL), синхронные вызовы в цикле
+# дают сотни мс; порог с запасом на медленную машину
+MAX_LOOP_LAG = 0.25
+
+
+async def _measure_lag(work) -> float:
+    """Максимальная задержка тикера (каждые 5 мс), пока выполняется work."""
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.perf_counter() - started - 0.005)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    try:
+        await work()
+    finally:
+        done.set()
+        await task
+    return lag
+
+
+def test_concurrent_db_calls_do_not_block_event_loop(tmp_db):
+    db = tmp_db
+    with db._transaction() as conn:
+        conn.executemany(
+            "INSERT INTO profits (user_id, username, first_name, original_amount, final_amount, status, "
+            "created_at, approved_at) VALUES (?, ?, ?, ?, ?, 'approved', '2026-01-01T00:00:00', "
+            "'2026-01-01T00:00:00')",
+            [(i % 500, f"u{i % 500}", "U", 100, 100) for i in range(50_000)],
+        )
+    db.rebuild_rollup()
+
+    async def work():
+        calls = []
+        for i in range(100):
+            calls.append(adb.create_profit_request(i, "a", "A", 100, "100"))
+            calls.append(adb.get_leaderboard(None))
+            calls.append(adb.get_profits_by_user(i % 500))
+            if i % 10 == 0:
+                # Тяжёлое чтение: синхронно одно такое держит цикл сотни миллисекунд
+                calls.append(adb.get_approved_profits_between(None, None))
+        results = await asyncio.gather(*calls)
+        assert len(results) == 310
+
+    async def main():
+        return await _measure_lag(work)
+
+    lag = asyncio.run(main())
+    assert lag < MAX_LOOP_LAG, f"цикл событий стоял {lag * 1000:.0f} мс"
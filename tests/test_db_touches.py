@@ -0,0 +1,32 @@
+import sqlite3
+import threading
+import time
+
+
+def test_touches_stay_visible_while_flush_waits_for_commit(tmp_db):
+    db = tmp_db
+    db.touch_user(7, "u", "U")
+    db.touch_member(-100, 7, "u", "U", "member")
+    # Другой процесс держит блокировку записи: сброс ждёт её между обменом буфера и коммитом
+    blocker = sqlite3.connect(db.DB_PATH)
+    blocker.execute("BEGIN IMMEDIATE")
+    flusher = threading.Thread(target=db.flush_touches)
+    flusher.start()
+    try:
+        deadline = time.monotonic() + 5
+        while db.pending_touches() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert db.pending_touches() == 0 and flusher.is_alive()
+        seen = []
+        reader = threading.Thread(target=lambda: seen.append(
+            ([row[0] for row in db.get_active_members(-100)], db.get_user_first_seen(7))))
+        reader.start()
+        reader.join(5)
+        assert seen[0][0] == [7]
+        assert seen[0][1] is not None
+    finally:
+        blocker.rollback()
+        blocker.close()
+        flusher.join(10)
+    assert [row[0] for row in db.get_active_members(-100)] == [7]
+    assert db._flushing_members == {} and db._flushing_users == {}
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+import export
+
+
+def test_period_filters_by_created_at_for_every_status(tmp_db, tmp_path):
+    db = tmp_db
+    pending = db.create_profit_request(1, "a", "A", 100, "100")
+    rejected = db.create_profit_request(1, "a", "A", 200, "200")
+    approved = db.create_profit_request(2, "b", "B", 300, "300")
+    db.set_status(rejected, "rejected", 42)
+    db.set_status(approved, "approved", 42)
+    old = db.create_profit_request(2, "b", "B", 400, "400")
+    with db._connect() as conn:
+        conn.execute("UPDATE profits SET created_at = ? WHERE id = ?",
+                     ((datetime.utcnow() - timedelta(days=60)).isoformat(), old))
+    week_start = (datetime.utcnow() - timedelta(days=7)).isoformat()
+
+    def ids(**filters):
+        return [row[0] for row in db.iter_profits(start_iso=week_start, **filters)]
+
+    assert ids() == [pending, rejected, approved]
+    assert ids(status="pending") == [pending]
+    assert ids(status="rejected") == [rejected]
+    assert export.write_export(str(tmp_path / "out.csv"), start_iso=week_start) == 3
@@ -0,0 +1,37 @@
+import os
+import time
+
+import fs_storage
+import log_storage
+from log_storage import SegmentLog
+
+
+def test_tail_is_fsynced_after_interval_without_new_appends(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_storage, "FSYNC_EVERY", 1000)
+    monkeypatch.setattr(log_storage, "FSYNC_INTERVAL", 0.1)
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(log_storage.os, "fsync", lambda fd: (synced.append(fd), real_fsync(fd)))
+    log = SegmentLog(str(tmp_path / "log"))
+    try:
+        for profit_id in range(5):
+            log.append(profit_id, "pending", {"id": profit_id})
+        assert not synced
+        time.sleep(0.5)
+        assert len(synced) == 1
+        assert log._unsynced == 0
+    finally:
+        log.close()
+
+
+def test_append_after_purge_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(fs_storage, "STORAGE_BACKEND", "log")
+    monkeypatch.setattr(fs_storage, "STORAGE_DIR", str(tmp_path))
+    monkeypatch.setattr(fs_storage, "_segment_log", SegmentLog(str(tmp_path / "log")))
+    try:
+        fs_storage.save_pending_profit((1, 1, "a", "A", 100, 100, None, "pending", "2026-01-01", None, None))
+        fs_storage.purge_storage()
+        fs_storage.save_pending_profit((2, 1, "a", "A", 100, 100, None, "pending", "2026-01-01", None, None))
+        assert fs_storage._log().ids() == [2]
+    finally:
+        fs_storage._segment_log.close()
@@ -0,0 +1,40 @@
+import os
+
+import fs_storage
+from mirror_rebuild import rebuild_mirror
+
+
+def test_rebuild_removes_files_without_matching_row(tmp_db, tmp_path, file_storage):
+    db = tmp_db
+
+    kept = db.create_profit_request(1, "a", "A", 100, "100")
+    approved = db.create_profit_request(1, "a", "A", 200, "200")
+    db.set_status(approved, "approved", 42)
+    # Что зеркало могло пропустить: файл удалённой заявки, файл в каталоге чужого
+    # месяца и pending-копия отклонённой заявки (её убирает основной проход)
+    deleted = db.create_profit_request(2, "b", "B", 300, "300")
+    fs_storage.save_pending_profit(db.get_profit(deleted))
+    rejected = db.create_profit_request(2, "b", "B", 400, "400")
+    fs_storage.save_approved_profit(db.get_profit(approved)[:7] + ("approved", "2026-01-01T00:00:00",
+                                                                   "2026-01-01T00:00:00", 42))
+    fs_storage.save_pending_profit(db.get_profit(rejected))
+    db.set_status(rejected, "rejected", 42)
+    with db._transaction() as conn:
+        conn.execute("DELETE FROM profits WHERE id = ?", (deleted,))
+    foreign = os.path.join(fs_storage.PENDING_DIR, "notes.txt")
+    with open(foreign, "w") as f:
+        f.write("не трогать")
+
+    report = rebuild_mirror(verify_only=True, workers=2)
+    assert report.orphans == 2
+
+    report = rebuild_mirror(workers=2)
+    assert (report.orphans, report.stale_removed) == (2, 1)
+    files = sorted(
+        os.path.relpath(os.path.join(root, name), tmp_path)
+        for root, _, names in os.walk(tmp_path) if "bot.db" not in names for name in names
+    )
+    expected = sorted(os.path.relpath(fs_storage.profit_file_path(db.get_profit(pid)), tmp_path)
+                      for pid in (kept, approved, rejected))
+    assert files == sorted(expected + [os.path.relpath(foreign, tmp_path)])
+    assert rebuild_mirror(verify_only=True).orphans == 0
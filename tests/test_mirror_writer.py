@@ -0,0 +1,47 @@
+import threading
+import time
+
+from mirror_writer import MirrorWriter
+
+
+def test_full_queue_drops_profit_writes_without_blocking():
+    release = threading.Event()
+    written = []
+    writer = MirrorWriter(maxsize=2)
+    writer.start()
+    try:
+        # Поток записи занят медленной операцией
+        writer.call(release.wait)
+        time.sleep(0.05)
+        started = time.perf_counter()
+        for profit_id in range(10):
+            writer.submit(profit_id, written.append, profit_id)
+        writer.call(written.append, "barrier")
+        assert time.perf_counter() - started < 0.5
+        assert writer.dropped == 8
+        release.set()
+        assert writer.drain(5)
+    finally:
+        release.set()
+        writer.stop(5)
+    # Принятые записи и групповая операция выполнены по порядку
+    assert written == [0, 1, "barrier"]
+
+
+def test_coalesced_write_is_accepted_when_full():
+    release = threading.Event()
+    written = []
+    writer = MirrorWriter(maxsize=1)
+    writer.start()
+    try:
+        writer.call(release.wait)
+        time.sleep(0.05)
+        writer.submit(1, written.append, "old")
+        writer.submit(1, written.append, "new")
+        assert writer.dropped == 0 and writer.coalesced == 1
+        release.set()
+        assert writer.drain(5)
+    finally:
+        release.set()
+        writer.stop(5)
+    assert written == ["new"]
@@ -0,0 +1,81 @@
+import json
+
+from telegram import Update
+
+import recorder
+
+# Ключи, значения которых по замыслу пишутся как есть
+_KEPT = recorder._SAFE_KEYS | {"data"}
+
+FORWARDED = {
+    "update_id": 7001,
+    "message": {
+        "message_id": 55,
+        "date": 1760000000,
+        "chat": {"id": -1001234567890, "type": "supergroup", "title": "Команда Ивана Петрова"},
+        "from": {"id": 987654321, "is_bot": False, "first_name": "Мария", "last_name": "Сидорова",
+                 "username": "maria_sid", "language_code": "ru"},
+        "sender_chat": {"id": -1009876543210, "type": "channel", "title": "Канал Марии", "username": "maria_channel"},
+        "author_signature": "Мария Сидорова",
+        "forward_origin": {"type": "hidden_user", "date": 1759990000, "sender_user_name": "Ivan Petrov"},
+        "forward_sender_name": "Ivan Petrov",
+        "forward_signature": "Иван П.",
+        "forward_from_chat": {"id": -1005555555555, "type": "channel", "title": "Секретный канал"},
+        "text": "Привет от Ивана, перевёл 12500 грн на карту 4149 4993 1234 5678 @ivan_petrov",
+        "entities": [
+            {"type": "mention", "offset": 62, "length": 12},
+            {"type": "text_link", "offset": 0, "length": 6, "url": "https://ivan.example.org/private"},
+        ],
+        "contact": {"phone_number": "+380671234567", "first_name": "Иван", "user_id": 111222333, "vcard": "BEGIN:VCARD"},
+    },
+}
+
+
+def _strings(obj, key=None):
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _strings(v, k)
+    elif isinstance(obj, list):
+        for item in obj:
+            yield from _strings(item, key)
+    elif isinstance(obj, str) and key not in _KEPT:
+        yield obj
+    elif isinstance(obj, int) and not isinstance(obj, bool) and abs(obj) > 100_000_000:
+        # id пользователей и чатов
+        yield str(obj)
+
+
+def _assert_nothing_survives(original: dict, anonymized: dict) -> None:
+    dumped = json.dumps(anonymized, ensure_ascii=False)
+    leaked = [value for value in _strings(original) if len(value) >= 3 and value in dumped]
+    assert leaked == []
+
+
+def test_forwarded_signed_message_is_fully_anonymized():
+    anonymizer = recorder.Anonymizer(1760000000)
+    result = anonymizer.anonymize(FORWARDED)
+    _assert_nothing_survives(FORWARDED, result)
+    message = result["message"]
+    # Длина и разметка сохраняются, служебные поля — тоже
+    assert len(message["text"]) == len(FORWARDED["message"]["text"])
+    assert message["entities"][0] == {"type": "mention", "offset": 62, "length": 12}
+    assert message["forward_origin"]["type"] == "hidden_user"
+    assert message["chat"]["type"] == "supergroup" and message["chat"]["id"] < 0
+
+
+def test_update_to_dict_is_fully_anonymized():
+    # Тот же апдейт после разбора PTB: recorder пишет update.to_dict()
+    data = Update.de_json(FORWARDED, None).to_dict()
+    _assert_nothing_survives(data, recorder.Anonymizer(1760000000).anonymize(data))
+
+
+def test_commands_buttons_and_callback_data_are_kept():
+    anonymizer = recorder.Anonymizer(0)
+    assert anonymizer.text("/profit 1500 за Ивана").startswith("/profit ")
+    assert "Ивана" not in anonymizer.text("/profit 1500 за Ивана")
+    assert anonymizer.text("Моя статистика") == "Моя статистика"
+    query = {"id": "4471", "chat_instance": "-99", "data": "approve:17",
+             "from": {"id": 5, "is_bot": False, "first_name": "Ivan"}}
+    result = anonymizer.anonymize(query)
+    assert result["data"] == "approve:17"
+    assert result["from"]["first_name"] != "Ivan" and result["id"] != "4471"
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from sender import PRIORITY_ADMIN, PRIORITY_DM, PRIORITY_GROUP, SendScheduler, SlidingWindow, TokenBucket
+
+GLOBAL_RATE = 50
+CHAT_RATE = 10
+# Задержка между взятием токена и вызовом send (планирование задач)
+JITTER = 0.01
+ADMIN_CHAT = 42
+
+
+def _buckets(chat_id, clock):
+    # Как sender._chat_buckets, но быстрее, чтобы тест шёл секунду
+    if chat_id < 0:
+        return [TokenBucket(CHAT_RATE, 1, clock), SlidingWindow(3, 0.5, clock)]
+    return [TokenBucket(CHAT_RATE, 1, clock)]
+
+
+async def _drive(chats: dict[int, int]) -> dict[int, list[tuple[float, int]]]:
+    """Отправить chats[chat_id] сообщений в каждый чат; вернуть (время, номер) по чатам."""
+    scheduler = SendScheduler(GLOBAL_RATE, time.monotonic, _buckets)
+    sent = defaultdict(list)
+
+    def factory(chat_id, n):
+        async def send():
+            sent[chat_id].append((time.monotonic(), n))
+            await asyncio.sleep(0.001)
+            return n
+        return send
+
+    futures = []
+    for n in range(max(chats.values())):
+        for chat_id, count in chats.items():
+            if n < count:
+                priority = PRIORITY_GROUP if chat_id < 0 else PRIORITY_DM
+                futures.append(scheduler.submit(chat_id, factory(chat_id, n), priority))
+    await asyncio.wait_for(asyncio.gather(*futures), 10)
+    await scheduler.stop()
+    return sent
+
+
+def test_global_and_per_chat_limits_and_order():
+    chats = {1: 10, 2: 10, 3: 10, 4: 10, 5: 10, 6: 10, -100: 6}
+    sent = asyncio.run(_drive(chats))
+
+    for chat_id, count in chats.items():
+        # Порядок внутри чата — порядок постановки
+        assert [n for _, n in sent[chat_id]] == list(range(count))
+        times = [t for t, _ in sent[chat_id]]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        assert min(gaps) >= 1 / CHAT_RATE - JITTER
+
+    # Группа: не больше 3 сообщений в любом окне 0,5 с
+    group = [t for t, _ in sent[-100]]
+    for i in range(len(group) - 3):
+        assert group[i + 3] - group[i] >= 0.5 - JITTER
+
+    times = sorted(t for items in sent.values() for t, _ in items)
+    assert len(times) == sum(chats.values())
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / GLOBAL_RATE - JITTER
+    # Общий лимит и выдерживается, и используется: 66 сообщений при 50/с — около 1,3 с
+    assert (len(times) - 1) / GLOBAL_RATE - JITTER <= times[-1] - times[0] < 2.5
+
+
+def test_admin_priority_overtakes_queued_group_posts():
+    async def main():
+        # Общий лимит 10/с: посты в группы копятся в очереди
+        scheduler = SendScheduler(10, time.monotonic, _buckets)
+        order = []
+
+        def factory(name):
+            async def send():
+                order.append(name)
+            return send
+
+        group = [scheduler.submit(-100 - i, factory(f"group{i}"), PRIORITY_GROUP) for i in range(6)]
+        await group[0]
+        admin = scheduler.submit(ADMIN_CHAT, factory("admin"), PRIORITY_ADMIN)
+        await asyncio.wait_for(asyncio.gather(admin, *group), 10)
+        await scheduler.stop()
+        return order
+
+    order = asyncio.run(main())
+    # Модерация уходит следующей, раньше пяти постов, поставленных до неё
+    assert order == ["group0", "admin"] + [f"group{i}" for i in range(1, 6)]
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import queue
+import threading
+
+import pytest
+from telegram import Update
+
+import fs_storage
+import mirror_writer
+import sharding
+
+
+@pytest.fixture
+def storage(file_storage):
+    mirror_writer.writer = mirror_writer.MirrorWriter()
+    mirror_writer.start()
+    outbox = queue.Queue()
+    replies = [queue.Queue()]
+    thread = threading.Thread(target=mirror_writer.serve_remote, args=(outbox, replies), daemon=True)
+    thread.start()
+    remote = mirror_writer.RemoteMirror(0, outbox, replies[0])
+    remote.start()
+    yield remote
+    outbox.put(None)
+    thread.join(5)
+    mirror_writer.stop(5)
+    mirror_writer.writer = mirror_writer.MirrorWriter()
+
+
+def test_late_pending_from_other_worker_does_not_leave_stale_file(tmp_db, storage):
+    db = tmp_db
+    profit_id = db.create_profit_request(1, "a", "A", 100, "100")
+    pending_row = db.get_profit(profit_id)
+    db.set_status(profit_id, "approved", 42)
+    # «approved» из воркера админа пришёл раньше «pending» из воркера пользователя
+    storage.submit(profit_id, fs_storage.save_approved_profit, db.get_profit(profit_id))
+    storage.submit(profit_id, fs_storage.save_pending_profit, pending_row)
+    assert storage.call_with_result(lambda: None).result(5) is None
+    assert not os.path.exists(fs_storage.profit_file_path(pending_row))
+    assert os.path.exists(fs_storage.profit_file_path(db.get_profit(profit_id)))
+
+
+def test_call_with_result_returns_value_and_error(storage):
+    assert storage.call_with_result(sum, [1, 2, 3]).result(5) == 6
+    with pytest.raises(RuntimeError, match="ZeroDivisionError"):
+        storage.call_with_result(divmod, 1, 0).result(5)
+
+
+class _FakeWorkers:
+    """Пул из одного воркера, который упал с полной очередью."""
+
+    def __init__(self):
+        self.queues = [queue.Queue(maxsize=1)]
+        self.queues[0].put("old")
+        self.restarts = 0
+
+    def ensure_alive(self, index):
+        if self.restarts:
+            return
+        self.restarts += 1
+        # Новый воркер разбирает очередь
+        threading.Thread(target=lambda: [self.queues[0].get() for _ in range(2)], daemon=True).start()
+
+
+def test_dispatcher_restarts_dead_worker_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(sharding, "_PUT_TIMEOUT", 0.05)
+    workers = _FakeWorkers()
+    dispatch = sharding._Dispatcher(workers)
+    update = Update.de_json({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "hi"}}, None)
+
+    async def main():
+        await asyncio.wait_for(dispatch(update), 5)
+
+    asyncio.run(main())
+    assert workers.restarts == 1
+    assert dispatch.dispatched == [1]
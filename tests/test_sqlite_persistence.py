@@ -0,0 +1,136 @@
+import asyncio
+import pickle
+
+from sqlite_persistence import SQLitePersistence
+
+
+def _reopen(path, legacy=None) -> SQLitePersistence:
+    return SQLitePersistence(filepath=str(path), legacy_pickle_path=str(legacy) if legacy else None)
+
+
+async def _load(persistence: SQLitePersistence, conversation: str = "profit") -> dict:
+    return {
+        "user_data": await persistence.get_user_data(),
+        "chat_data": await persistence.get_chat_data(),
+        "bot_data": await persistence.get_bot_data(),
+        "conversations": await persistence.get_conversations(conversation),
+    }
+
+
+def test_round_trip_across_reopen(tmp_path):
+    path = tmp_path / "state.db"
+
+    async def write():
+        p = _reopen(path)
+        await _load(p)
+        # Как Application.update_persistence: все update_* одним gather
+        await asyncio.gather(
+            p.update_user_data(1, {"profit_chat_id": 10}),
+            p.update_user_data(2, {"awaiting_suggestion": True}),
+            p.update_chat_data(-100, {"all_progress": {"sent": 3, "total": 9}}),
+            p.update_bot_data({"version": 2}),
+            p.update_conversation("profit", (10, 1), 1),
+            p.update_conversation("profit", (-100, 2), 2),
+        )
+        # Повтор без изменений ничего не пишет
+        writes = p.writes
+        await p.update_user_data(1, {"profit_chat_id": 10})
+        assert p.writes == writes and p.skipped == 1
+        await p.flush()
+
+    async def read():
+        p = _reopen(path)
+        data = await _load(p)
+        await p.flush()
+        return data
+
+    asyncio.run(write())
+    assert asyncio.run(read()) == {
+        "user_data": {1: {"profit_chat_id": 10}, 2: {"awaiting_suggestion": True}},
+        "chat_data": {-100: {"all_progress": {"sent": 3, "total": 9}}},
+        "bot_data": {"version": 2},
+        "conversations": {(10, 1): 1, (-100, 2): 2},
+    }
+
+
+def test_legacy_pickle_is_migrated_once(tmp_path):
+    legacy = tmp_path / "bot_state.pkl"
+    with open(legacy, "wb") as f:
+        pickle.dump({
+            "user_data": {1: {"a": 1}},
+            "chat_data": {-100: {"b": 2}},
+            "bot_data": {"c": 3},
+            "callback_data": None,
+            "conversations": {"profit": {(10, 1): 0}},
+        }, f)
+    path = tmp_path / "state.db"
+
+    async def scenario():
+        p = _reopen(path, legacy)
+        data = await _load(p)
+        await p.update_user_data(1, {"a": 5})
+        await p.flush()
+        # Файл не удалён, но в непустую БД повторно не переносится
+        p = _reopen(path, legacy)
+        again = await _load(p)
+        await p.flush()
+        return data, again
+
+    data, again = asyncio.run(scenario())
+    assert data == {
+        "user_data": {1: {"a": 1}},
+        "chat_data": {-100: {"b": 2}},
+        "bot_data": {"c": 3},
+        "conversations": {(10, 1): 0},
+    }
+    assert again["user_data"] == {1: {"a": 5}}
+
+
+def test_flush_after_deletion(tmp_path):
+    path = tmp_path / "state.db"
+
+    async def scenario():
+        p = _reopen(path)
+        await _load(p)
+        await asyncio.gather(
+            p.update_user_data(1, {"a": 1}),
+            p.update_chat_data(-100, {"b": 2}),
+            p.update_conversation("profit", (10, 1), 1),
+        )
+        await p.flush()
+
+        p = _reopen(path)
+        await _load(p)
+        # Ключи, загруженные из файла (не записанные в этом запуске), тоже удаляются
+        await asyncio.gather(
+            p.drop_user_data(1),
+            p.drop_chat_data(-100),
+            p.update_conversation("profit", (10, 1), None),
+        )
+        await p.flush()
+
+        p = _reopen(path)
+        data = await _load(p)
+        await p.flush()
+        return data
+
+    assert asyncio.run(scenario()) == {"user_data": {}, "chat_data": {}, "bot_data": {}, "conversations": {}}
+
+
+def test_drop_and_conversation_end_are_written(tmp_path):
+    path = tmp_path / "state.db"
+
+    async def scenario():
+        p = _reopen(path)
+        await _load(p)
+        await p.update_user_data(1, {"a": 1})
+        await p.update_conversation("profit", (10, 1), 1)
+        await p.drop_user_data(1)
+        await p.update_conversation("profit", (10, 1), None)
+        await p.flush()
+        p = _reopen(path)
+        data = await _load(p)
+        await p.flush()
+        return data
+
+    assert asyncio.run(scenario()) == {"user_data": {}, "chat_data": {}, "bot_data": {}, "conversations": {}}
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram import Update
+
+from update_processor import KeyedUpdateProcessor
+
+CAP = 3
+
+
+def _update(update_id: int, chat_id: int, user_id: int) -> Update:
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "x",
+        "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+    }}, None)
+
+
+def test_serial_within_key_concurrent_across_keys_under_cap():
+    # Два пользователя в одной группе и четыре лички: шесть ключей (chat_id, user_id)
+    keys = [(-100, 1), (-100, 2), (11, 11), (12, 12), (13, 13), (14, 14)]
+    events = []
+    running = 0
+    peak = 0
+
+    async def handler(key, n):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        events.append(("start", key, n))
+        # Первый апдейт первого ключа медленный: следующие с тем же ключом не должны его обогнать
+        await asyncio.sleep(0.1 if (key, n) == (keys[0], 0) else 0.01)
+        events.append(("end", key, n))
+        running -= 1
+
+    async def main():
+        processor = KeyedUpdateProcessor(CAP)
+        tasks = []
+        update_id = 0
+        # Как Application: апдейты запускаются задачами в порядке поступления
+        for n in range(3):
+            for key in keys:
+                update_id += 1
+                tasks.append(asyncio.create_task(
+                    processor.process_update(_update(update_id, *key), handler(key, n))))
+        await asyncio.wait_for(asyncio.gather(*tasks), 10)
+        return processor
+
+    processor = asyncio.run(main())
+
+    for key in keys:
+        own = [(kind, n) for kind, k, n in events if k == key]
+        # По порядку и без наложения: start0 end0 start1 end1 ...
+        assert own == [(kind, n) for n in range(3) for kind in ("start", "end")]
+    # Разные ключи выполнялись одновременно, но не больше CAP сразу
+    assert peak == CAP
+    assert processor.processed == 18
+    assert processor.in_flight_total() == 0 and not processor._locks
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import pytest
+
+import webhook
+
+SECRET = "test-secret_1"
+UPDATE = json.dumps({"update_id": 5, "message": {
+    "message_id": 1, "date": 0, "text": "hi", "chat": {"id": 1, "type": "private"}}}).encode()
+
+
+async def _post(port: int, secret: str | None) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = f"POST {webhook.WEBHOOK_PATH} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(UPDATE)}\r\n"
+    if secret is not None:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write((headers + "Connection: close\r\n\r\n").encode("latin-1") + UPDATE)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+def test_secret_header_is_required():
+    received = []
+
+    async def on_update(update):
+        received.append(update.update_id)
+
+    async def main():
+        server = webhook.WebhookServer(None, secret=SECRET, on_update=on_update)
+        await server.start("127.0.0.1", 0)
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            statuses = [await _post(port, secret) for secret in (None, "wrong", SECRET.upper(), SECRET)]
+        finally:
+            await server.stop()
+        return statuses, server
+
+    statuses, server = asyncio.run(main())
+    assert statuses == [403, 403, 403, 200]
+    assert received == [5]
+    assert (server.rejected, server.accepted) == (3, 1)
+
+
+@pytest.mark.parametrize("secret", ["", "has space", "x" * 257])
+def test_server_refuses_to_start_without_valid_secret(secret):
+    server = webhook.WebhookServer(None, secret=secret, on_update=None)
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        asyncio.run(server.start("127.0.0.1", 0))
@@ -0,0 +1,239 @@
+"""Структурированный журнал апдейтов и запись логов вне цикла событий.
+
+setup_logging() направляет все логи через очередь: в цикле событий запись
+только кладётся в очередь, а форматирование и вывод в stdout (и LOG_FILE,
+если задан) выполняет отдельный поток QueueListener. При переполнении
+очереди (LOG_QUEUE_SIZE) записи отбрасываются, а не блокируют бота.
+
+После обработки каждого апдейта update_processor.py вызывает log_update():
+в логгер ``updates`` пишется компактное JSON-событие — тип апдейта, чат,
+пользователь, команда или префикс callback_data, сработавшие обработчики и
+время обработки. Словарь собирается в цикле событий, JSON — в потоке записи.
+
+* UPDATE_LOG_SAMPLE — доля апдейтов в журнале (1 — все, 0 — выключено);
+* UPDATE_LOG_RATE — не больше стольких событий в секунду, остальные
+  отбрасываются (их число попадает в поле ``dropped`` следующего события);
+* UPDATE_LOG_SLOW_MS — апдейты медленнее порога пишутся всегда, без
+  сэмплирования (но с ограничением частоты).
+
+LOG_FORMAT=json переводит в JSON и остальные логи.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+import metrics
+from sender import TokenBucket
+
+UPDATE_LOG_SAMPLE = float(os.getenv("UPDATE_LOG_SAMPLE", "1"))
+UPDATE_LOG_RATE = float(os.getenv("UPDATE_LOG_RATE", "20"))
+UPDATE_LOG_SLOW_MS = float(os.getenv("UPDATE_LOG_SLOW_MS", "1000"))
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+logger = logging.getLogger("updates")
+
+
+class Event:
+    """Сообщение лога из полей; в JSON превращается только при записи."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return json.dumps(self.fields, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        if isinstance(record.msg, Event):
+            data.update(record.msg.fields)
+        else:
+            data["msg"] = record.getMessage()
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # События форматируются в потоке записи; поля — свежий словарь, копировать не нужно
+        if isinstance(record.msg, Event):
+            return record
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: _QueueHandler | None = None
+_listener: logging.handlers.QueueListener | None = None
+
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """Настроить корневой логгер: очередь + поток записи (вызывать после load_dotenv)."""
+    global _handler, _listener
+    if _listener is not None:
+        return
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    outputs: list[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+    log_file = os.getenv("LOG_FILE", "")
+    if log_file:
+        outputs.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    _handler = _QueueHandler(queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000"))))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    # httpx пишет INFO на каждый запрос к Bot API; время и коды запросов есть в metrics.py
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(_handler.queue, *outputs, respect_handler_level=True)
+    _listener.start()
+    # Дописываем очередь при выходе из процесса
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def queue_depth() -> int:
+    return _handler.queue.qsize() if _handler is not None else 0
+
+
+def dropped_records() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+# --- журнал апдейтов ---
+
+# Имена обработчиков, сработавших на текущий апдейт (список заводит log_context)
+_handlers_var: contextvars.ContextVar[list | None] = contextvars.ContextVar("update_handlers", default=None)
+
+_bucket = TokenBucket(UPDATE_LOG_RATE, max(UPDATE_LOG_RATE, 1.0), time.monotonic)
+_counters = {"logged": 0, "sampled_out": 0, "rate_limited": 0}
+_rate_limited_since_last = 0
+
+
+def _tagged(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        handlers = _handlers_var.get()
+        if handlers is not None:
+            handlers.append(name)
+        return await callback(update, context)
+    return wrapper
+
+
+def _tag(handler) -> None:
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _tag(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _tag(inner)
+        return
+    callback = getattr(handler, "callback", None)
+    if callback is not None:
+        handler.callback = _tagged(callback, getattr(callback, "__name__", type(handler).__name__))
+
+
+def tag_handlers(application) -> None:
+    """Обернуть колбэки всех обработчиков, чтобы событие знало, какие из них сработали."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _tag(handler)
+
+
+def log_context() -> list:
+    """Завести список обработчиков для апдейта в текущей задаче."""
+    handlers: list = []
+    _handlers_var.set(handlers)
+    return handlers
+
+
+def _update_type(update: Update) -> str:
+    for name in Update.ALL_TYPES:
+        if getattr(update, name, None) is not None:
+            return str(name)
+    return "unknown"
+
+
+def log_update(update: object, handlers: list, duration: float) -> None:
+    """Записать событие обработки апдейта с учётом сэмплирования и лимита частоты."""
+    global _rate_limited_since_last
+    if not isinstance(update, Update) or not logger.isEnabledFor(logging.INFO):
+        return
+    latency_ms = duration * 1000
+    if latency_ms < UPDATE_LOG_SLOW_MS and (UPDATE_LOG_SAMPLE <= 0 or random.random() >= UPDATE_LOG_SAMPLE):
+        _counters["sampled_out"] += 1
+        return
+    if _bucket.delay() > 0:
+        _counters["rate_limited"] += 1
+        _rate_limited_since_last += 1
+        return
+    _bucket.take()
+
+    chat = update.effective_chat
+    user = update.effective_user
+    fields = {
+        "event": "update",
+        "update_id": update.update_id,
+        "type": _update_type(update),
+        "chat": chat.id if chat else None,
+        "chat_type": chat.type if chat else None,
+        "user": user.id if user else None,
+        "handlers": list(handlers),
+        "latency_ms": round(latency_ms, 2),
+    }
+    message = update.effective_message
+    text = message.text if message is not None and update.callback_query is None else None
+    if text and text.startswith("/"):
+        # Только имя команды, без аргументов и текста сообщений
+        fields["command"] = text.split(None, 1)[0].split("@", 1)[0]
+    if update.callback_query is not None:
+        fields["callback"] = metrics.callback_prefix(update)
+    if _rate_limited_since_last:
+        fields["dropped"] = _rate_limited_since_last
+        _rate_limited_since_last = 0
+    _counters["logged"] += 1
+    logger.info(Event(fields))
+
+
+def stats() -> dict:
+    return {**_counters, "queue": queue_depth(), "dropped_records": dropped_records()}
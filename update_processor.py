@@ -0,0 +1,84 @@
+"""Параллельная обработка апдейтов с сохранением порядка внутри (чат, пользователь).
+
+Апдейты разных чатов/пользователей обрабатываются одновременно (не больше
+UPDATE_CONCURRENCY сразу), а апдейты с одним ключом (chat_id, user_id) —
+строго по очереди, в порядке поступления. Это тот же ключ, по которому
+ConversationHandler хранит состояние диалогов /profit и /suggest, поэтому
+диалоги не видят гонок, а медленный обработчик у одного пользователя не
+задерживает остальных.
+"""
+import asyncio
+import os
+import time
+from collections import Counter
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+import recorder
+import update_log
+
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+
+def update_key(update: object) -> tuple:
+    """Ключ упорядочивания: (chat_id, user_id); у апдейтов без чата/пользователя — None."""
+    if not isinstance(update, Update):
+        return (None, None)
+    chat = update.effective_chat
+    user = update.effective_user
+    return (chat.id if chat else None, user.id if user else None)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        # Апдейты по ключу: ожидающие своей очереди + выполняющийся
+        self._in_flight: Counter = Counter()
+        self.processed = 0
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Момент получения апдейта, до ожидания очереди своего ключа
+        recorder.record(update)
+        key = update_key(update)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._in_flight[key] += 1
+        try:
+            # Сначала очередь своего ключа, потом общий лимит: ждущие апдейты одного
+            # пользователя не занимают слоты, нужные другим
+            async with lock:
+                handlers = update_log.log_context()
+                started = time.perf_counter()
+                try:
+                    await super().process_update(update, coroutine)
+                finally:
+                    duration = time.perf_counter() - started
+                    metrics.update_duration.observe(duration)
+                    update_log.log_update(update, handlers, duration)
+        finally:
+            self.processed += 1
+            self._in_flight[key] -= 1
+            if not self._in_flight[key]:
+                del self._in_flight[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def in_flight(self) -> dict[tuple, int]:
+        """Число апдейтов в обработке/очереди по ключам (chat_id, user_id)."""
+        return dict(self._in_flight)
+
+    def in_flight_total(self) -> int:
+        return sum(self._in_flight.values())
@@ -0,0 +1,295 @@
+"""Режим webhook: встроенный асинхронный HTTP-сервер вместо run_polling.
+
+Telegram присылает апдейты POST-запросами на WEBHOOK_URL; сервер проверяет
+заголовок X-Telegram-Bot-Api-Secret-Token, разбирает JSON в Update и кладёт
+его в application.update_queue. Каждое соединение обслуживается отдельной
+задачей, поэтому одновременные запросы принимаются параллельно. При
+перезапуске очередь апдейтов на стороне Telegram не сбрасывается.
+
+Сервер слушает обычный HTTP (по умолчанию 127.0.0.1:8080): TLS завершает
+обратный прокси (nginx и т.п.), который пересылает запросы с WEBHOOK_URL.
+
+Задержка от получения запроса до начала обработки апдейта считается
+обработчиком в группе -100 (p50/p99 — в /cache_stats и в логе при остановке).
+
+Проверка на localhost: ``python webhook.py post updates.jsonl`` отправляет
+сохранённые апдейты (по одному JSON в строке) на запущенный сервер.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import re
+import signal
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+_MAX_BODY = 1024 * 1024
+_IDLE_TIMEOUT = 75
+_LATENCY_SAMPLES = 10000
+
+# Допустимый secret_token Bot API: 1–256 символов A-Z, a-z, 0-9, _ и -
+_SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def check_secret(secret: str = WEBHOOK_SECRET) -> str:
+    """Проверить WEBHOOK_SECRET: без него любой, кто знает адрес, может слать апдейты от имени админа."""
+    if not secret:
+        raise RuntimeError("Для BOT_MODE=webhook задайте WEBHOOK_SECRET")
+    if not _SECRET_RE.match(secret):
+        raise RuntimeError("WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -")
+    return secret
+
+
+class WebhookServer:
+    def __init__(self, application: Application | None, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 on_update: Callable[[Update], Awaitable[None]] | None = None):
+        # Без application апдейты отдаются в on_update (приёмник в sharding.py)
+        self.application = application
+        self.on_update = on_update
+        self.path = path
+        self.secret = secret
+        self._server: asyncio.AbstractServer | None = None
+        # update_id -> момент получения запроса (perf_counter)
+        self._received: dict[int, float] = {}
+        self._latencies: deque = deque(maxlen=_LATENCY_SAMPLES)
+        self.accepted = 0
+        self.rejected = 0
+
+    async def start(self, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT) -> None:
+        check_secret(self.secret)
+        if self.application is not None:
+            # Группа -100 срабатывает раньше всех остальных обработчиков
+            self.application.add_handler(TypeHandler(Update, self._mark_handler_start), group=-100)
+        self._server = await asyncio.start_server(self._handle_connection, listen, port)
+        logger.info(f"Webhook-сервер слушает {listen}:{port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def latency(self) -> dict:
+        """Задержка от получения запроса до начала обработки, мс."""
+        values = list(self._latencies)
+        return {
+            "count": len(values),
+            "p50_ms": _percentile(values, 0.50) * 1000,
+            "p99_ms": _percentile(values, 0.99) * 1000,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+    async def _mark_handler_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        received = self._received.pop(update.update_id, None)
+        if received is not None:
+            self._latencies.append(time.perf_counter() - received)
+
+    async def _process(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        # Без секрета сервер не принимает ничего (start() его и не запустит)
+        if not self.secret or not hmac.compare_digest(token.encode(), self.secret.encode()):
+            self.rejected += 1
+            return 403
+        received = time.perf_counter()
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot if self.application else None)
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт в webhook: {e}")
+            return 400
+        if update is None:
+            return 400
+        if self.on_update is not None:
+            await self.on_update(update)
+            self.accepted += 1
+            return 200
+        if len(self._received) < _LATENCY_SAMPLES:
+            self._received[update.update_id] = received
+        await self.application.update_queue.put(update)
+        self.accepted += 1
+        return 200
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), _IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), _IDLE_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > _MAX_BODY:
+                    status, keep_alive = 413, False
+                else:
+                    body = await asyncio.wait_for(reader.readexactly(length), _IDLE_TIMEOUT) if length else b""
+                    status = await self._process(method, target, headers, body)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+server: WebhookServer | None = None
+
+
+def latency() -> dict | None:
+    return server.latency() if server is not None else None
+
+
+def stop_on_signals(stop_event: asyncio.Event, signals=(signal.SIGINT, signal.SIGTERM)) -> None:
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+
+async def serve_application(application: Application, stop_event: asyncio.Event,
+                            on_started: Callable[[], Awaitable[None]] | None = None) -> None:
+    """Жизненный цикл Application без встроенного Updater: работает до stop_event."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        if on_started is not None:
+            await on_started()
+        await stop_event.wait()
+    finally:
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def _serve(application: Application, url: str, listen: str, port: int) -> None:
+    global server
+    stop_event = asyncio.Event()
+    stop_on_signals(stop_event)
+    server = WebhookServer(application)
+
+    async def on_started() -> None:
+        await server.start(listen, port)
+        # Без drop_pending_updates: накопленные за время перезапуска апдейты не теряются
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=server.secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+    try:
+        await serve_application(application, stop_event, on_started)
+    finally:
+        await server.stop()
+        stats = server.latency()
+        logger.info(
+            f"Webhook: принято {stats['accepted']}, отклонено {stats['rejected']}, "
+            f"задержка до обработчика p50={stats['p50_ms']:.1f} мс, p99={stats['p99_ms']:.1f} мс"
+        )
+
+
+def run_webhook(application: Application, url: str = WEBHOOK_URL, listen: str = WEBHOOK_LISTEN,
+                port: int = WEBHOOK_PORT) -> None:
+    """Запустить бота в режиме webhook (блокирует до SIGINT/SIGTERM)."""
+    if not url:
+        raise RuntimeError("Для BOT_MODE=webhook задайте WEBHOOK_URL")
+    check_secret()
+    try:
+        asyncio.run(_serve(application, url, listen, port))
+    except KeyboardInterrupt:
+        pass
+
+
+async def post_updates(path: str, url: str, secret: str = WEBHOOK_SECRET, concurrency: int = 20) -> dict:
+    """Отправить сохранённые апдейты (JSONL) на webhook-сервер, вернуть время ответа."""
+    import httpx
+
+    with open(path, "r", encoding="utf-8") as f:
+        bodies = [line.strip() for line in f if line.strip()]
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    semaphore = asyncio.Semaphore(concurrency)
+    timings, failed = [], 0
+
+    async with httpx.AsyncClient(headers=headers, timeout=30) as client:
+        async def post(body: str) -> None:
+            nonlocal failed
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, content=body)
+                timings.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    failed += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in bodies))
+        elapsed = time.perf_counter() - started
+    return {
+        "sent": len(bodies),
+        "failed": failed,
+        "updates_per_second": len(bodies) / elapsed if elapsed else 0.0,
+        "response_p50_ms": _percentile(timings, 0.50) * 1000,
+        "response_p99_ms": _percentile(timings, 0.99) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Отправка сохранённых апдейтов на webhook-сервер бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+    post_parser = sub.add_parser("post", help="отправить апдейты из JSONL-файла")
+    post_parser.add_argument("file")
+    post_parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    post_parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    post_parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(post_updates(args.file, args.url, args.secret, args.concurrency)), ensure_ascii=False))